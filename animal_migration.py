@@ -1,11 +1,181 @@
+import os
+from functools import partial
 import numpy as np
 import pandas as pd
 from sklearn.preprocessing import StandardScaler
-from non_dl import clean_df, train_gb_model
-from script_lstm import final_train, final_predict
+from sklearn.metrics import mean_absolute_error
+from non_dl import make_gb_model, train_gb_model, train_coord_model, update_tree_model, COORD_MODEL_PARAMS
+from data_loader import load_clean_survey
+from script_lstm import final_train, final_update, get_final_windows, final_predict_windows, LSTMPredictor, SEQUENCE_WINDOW
+from feature_schema import FeatureSchema, LAG_COLUMNS
+from model_store import STORE_DIR, data_fingerprint, model_fingerprint, scaler_fingerprint, make_artifact, save_artifact, load_artifact
+from training import train_in_parallel
+from sequences import get_group_tails, append_group_tails
+from forecast_writer import BinarySink, ForecastWriter, IndexedPartitionSink, MultiSink, make_sink, OUTPUT_COLUMNS
+from spatial import GridSummarySink
+from survey_store import load_store, read_state, get_store_means, get_store_scaler
 from sklearn.preprocessing import LabelEncoder
 
-def get_future_predictions(df, models, last_year=2022):
+def get_lag_state(matrix, species_idx, schema):
+    '''
+    Builds the lag state for each species from its last 2 rows of the previous year
+
+    Inputs:
+        - matrix (np.Array) - The rows of the year to use as a baseline, built by schema.to_matrix, optionally with leading batch
+                              dimensions (such as one per scenario) that share the same rows and species
+        - species_idx (np.Array) - The index into schema.species_names of the species of each row
+        - schema (FeatureSchema) - The schema of the matrix
+
+    Returns:
+        - lag_state (np.Array) - An array of shape (..., num_species, 6) with the values for each of the LAG_COLUMNS (0 for the
+                                 second lag of a species with only 1 row)
+    '''
+    num_species = len(schema.species_names)
+
+    # find the positions of the last and second to last rows of each species while keeping the row order within a species
+    order = np.argsort(species_idx, kind='stable')
+    starts = np.searchsorted(species_idx[order], np.arange(num_species), side='left')
+    ends = np.searchsorted(species_idx[order], np.arange(num_species), side='right') - 1
+    has_1 = ends >= starts
+    has_2 = ends > starts
+
+    # the last row of each species is lag 1 and the second to last is lag 2
+    lag_state = np.zeros(matrix.shape[:-2] + (num_species, len(LAG_COLUMNS)), dtype=matrix.dtype)
+    lag_state[..., has_1, :3] = matrix[..., order[ends[has_1]], :][..., schema.lag_source_idx]
+    lag_state[..., has_2, 3:] = matrix[..., order[ends[has_2] - 1], :][..., schema.lag_source_idx]
+
+    return lag_state
+
+def get_species_history(df, schema, length):
+    '''
+    Gets the last rows of every species in the dataframe, which sequence models read before the rows of the next year
+
+    Inputs:
+        - df (pd.Dataframe) - The dataframe to generate the predictions from
+        - schema (FeatureSchema) - The schema of df
+        - length (int) - The number of rows to keep for each species
+
+    Returns:
+        - history (tuple) - The model inputs of the last rows of each species with shape (species, length, features) front padded with
+                            zeros, and the number of real rows for each species
+    '''
+    matrix = schema.to_matrix(df)
+    return get_group_tails(schema.features(matrix), schema.get_species(matrix), len(schema.species_names), length)
+
+def predict_targets(features, models, schema, history=None, species_idx=None):
+    '''
+    Predicts the number of animals, the latitude and the longitude for a batch of rows
+
+    Inputs:
+        - features (np.Array) - The model inputs for every row to predict, in the column order of schema.feature_columns
+        - models (dict) - A dictionary for the model (or LSTMPredictor) to predict the number of animals and either one model for the
+                          latitude and longitude together ('coord_model') or one model for each ('lat_model' and 'long_model'), each
+                          with their own scaler
+        - schema (FeatureSchema) - The schema of the model inputs
+        - history (tuple) - The optional history of each species from get_species_history() for a sequence number model
+        - species_idx (np.Array) - The index into schema.species_names of the species of each row, needed with history
+
+    Returns:
+        - num_pred (np.Array) - The predicted number of animals rounded to the nearest whole number
+        - lat_pred (np.Array) - The predicted latitudes
+        - long_pred (np.Array) - The predicted longitudes
+    '''
+    # scale the inputs once for every distinct scaler since models may share the same scaler
+    scaled = {}
+    def get_scaled(scaler):
+        if id(scaler) not in scaled:
+            scaled[id(scaler)] = schema.scale(features, scaler)
+        return scaled[id(scaler)]
+
+    # predict the number of animals for every row in one pass and round to the nearest whole number
+    num_model = models['num_model'][0]
+    if not isinstance(num_model, LSTMPredictor):
+        num_model = LSTMPredictor(num_model, models['num_model'][1])
+    if history is None:
+        num_pred = num_model.predict_scaled(get_scaled(models['num_model'][1]))
+    else:
+        # scale the history of each species with the scaler of the number model, the padding is masked by the history lengths
+        history_rows, history_lengths = history
+        num_pred = num_model.predict_scaled(get_scaled(models['num_model'][1]), schema.scale(history_rows, models['num_model'][1]),
+                                            history_lengths, species_idx)
+    num_pred = np.round(num_pred[:, 0])
+
+    if 'coord_model' in models:
+        # predict the latitude and longitude together
+        coord_pred = models['coord_model'][0].predict(get_scaled(models['coord_model'][1]))
+        return num_pred, coord_pred[:, 0], coord_pred[:, 1]
+
+    # predict the latitude
+    lat_pred = models['lat_model'][0].predict(get_scaled(models['lat_model'][1]))
+
+    # predict the longitude
+    long_pred = models['long_model'][0].predict(get_scaled(models['long_model'][1]))
+
+    return num_pred, lat_pred, long_pred
+
+def start_next_year(past_year, id_offsets, schema):
+    '''
+    Copies the rows of a year into the rows of the following year and builds the lag state of each species, before the lags are
+    written and the targets predicted
+
+    Inputs:
+        - past_year (np.Array) - The rows of the previous year, built by schema.to_matrix, optionally with leading batch dimensions
+                                 that share the same rows and species
+        - id_offsets (np.Array) - How far past the last ID of the previous year the ID of each new row is, minus 1
+        - schema (FeatureSchema) - The schema of the rows
+
+    Returns:
+        - matrix (np.Array) - The rows of the new year with the targets and lags of the previous year
+        - species_idx (np.Array) - The index into schema.species_names of the species of each row
+        - lag_state (np.Array) - The lag state of each species from get_lag_state()
+    '''
+    # copy the rows of the previous year which become the future rows after being updated in place
+    matrix = past_year.copy()
+    matrix[..., schema.count_idx] += 1
+
+    # increment the ID appropriately
+    matrix[..., schema.id_idx] = id_offsets + 1 + past_year[..., schema.id_idx].max()
+
+    # build the lag state for each species from the previous year, the species of the rows are the same in every batch
+    species_idx = schema.get_species(matrix.reshape(-1, matrix.shape[-1])[:matrix.shape[-2]])
+    lag_state = get_lag_state(matrix, species_idx, schema)
+
+    return matrix, species_idx, lag_state
+
+def forecast_next_year(past_year, id_offsets, models, schema, history=None):
+    '''
+    Generates the rows of the year following a year of rows using that year's timesteps as a baseline
+
+    Every row of a species is seeded with the lags from the last 2 rows of that species in the previous year, so the whole
+    year is predicted with one batched call per model instead of one call per row. A sequence number model reads the window of
+    every row from the end of the history of its species followed by the earlier rows of its species in the new year, the same
+    window it was trained on.
+
+    Inputs:
+        - past_year (np.Array) - The rows of the previous year, built by schema.to_matrix
+        - id_offsets (np.Array) - How far past the last ID of the previous year the ID of each new row is, minus 1
+        - models (dict) - A dictionary for the model to predict the number of animals, the latitude and the longitude each with ther
+                          own scaler
+        - schema (FeatureSchema) - The schema of the rows
+        - history (tuple) - The history of each species before the new year from get_species_history(), only used by a sequence
+                            number model
+
+    Returns:
+        - matrix (np.Array) - The rows of the new year in the layout of schema.to_matrix
+    '''
+    # start the new year from the previous year and copy the lag state of each species to every row of that species
+    matrix, species_idx, lag_state = start_next_year(past_year, id_offsets, schema)
+    matrix[:, schema.lag_idx] = lag_state[species_idx]
+
+    # predict every row of the year at once from a view of the model inputs and write the predictions in place
+    num_pred, lat_pred, long_pred = predict_targets(schema.features(matrix), models, schema, history, species_idx)
+    matrix[:, schema.col_idx['NUMBER']] = num_pred
+    matrix[:, schema.col_idx['LATITUDE']] = lat_pred
+    matrix[:, schema.col_idx['LONGITUDE']] = long_pred
+
+    return matrix
+
+def get_future_predictions(df, models, last_year=2022, schema=None):
     '''
     Generates synthetic data for the year following last_year using the previous year's timesteps as a baseline
 
@@ -14,108 +184,194 @@ def get_future_predictions(df, models, last_year=2022):
         - models (dict) - A dictionary for the model to predict the number of animals, the latitude and the longitude each with ther
                           own scaler
         - last_year (int) - The previous year to use as a baseline and create synthetic data from
+        - schema (FeatureSchema) - The optional schema of df, built from df if not given
     
     Returns:
         - combined_df (pd.Dataframe) - The original dataframe that also contains the synthetic data
     '''
-    # get the rows for the last year
-    past_year = df[df['COUNT'] == last_year].copy()
+    if schema is None:
+        schema = FeatureSchema.from_df(df)
 
-    # Create a column for a datetime from the individual month, day, year and time columns
-    past_year['timestamp'] = pd.to_datetime(past_year['TIME'], unit='s').dt.strftime('%H:%M:%S')
+    # the IDs of the new rows follow the positions of the rows of the last year in df
+    past_year = df[df['COUNT'] == last_year]
+    id_offsets = np.asarray(past_year.index - past_year.index[0])
 
-    past_year['timestamp'] = pd.to_datetime(
-        past_year['COUNT'].astype(int).astype(str) + '-' + 
-        past_year['MONTH'].astype(int).astype(str).str.zfill(2) + '-' +
-        past_year['DATE'].astype(float).astype(int).astype(str).str.zfill(2) + ' ' +
-        past_year['timestamp']
-    )
+    # a sequence number model reads the last rows of each species before the new year
+    history = None
+    window = getattr(models['num_model'][0], 'window', 1)
+    if window > 1:
+        history = get_species_history(df, schema, window - 1)
 
-    # combine the one-hot encoded species columns back into one species column
-    species_columns = [col for col in df.columns if col.startswith('SPECIES_')]
-    past_year['species'] = past_year[species_columns].idxmax(axis=1).str.replace('SPECIES_', '')
-    
-    # create the future rows dataframe using the past year's data as the baseline
-    future_rows = past_year.copy()
-    future_rows['COUNT'] = last_year + 1
+    matrix = forecast_next_year(schema.to_matrix(past_year), id_offsets, models, schema, history)
 
-    # increment the ID appropriately
-    last_id = past_year['ID'].max()
-    future_rows['ID'] = (future_rows.index - future_rows.index[0]) + 1 + last_id
+    # add the synthetic data to the original dataframe and return
+    combined_df = pd.concat([df, schema.to_df(matrix)], ignore_index=True)
+    return combined_df
+
+def prepare_forecast_models(models, schema):
+    '''
+    Makes sure each scaler was fit on the feature columns of the schema and builds the inference engine of the number model once so
+    every year reuses it
 
-    # group by species to ensure we are not predicted data for the wrong animals
-    grouped = future_rows.groupby('species')
+    Inputs:
+        - models (dict) - A dictionary for the model to predict the number of animals, the latitude and the longitude each with ther
+                          own scaler
+        - schema (FeatureSchema) - The schema of the model inputs
 
-    # create a copy for the out_df without the timestamp and species columns to be able to properly pass the data into the models
-    out_df = future_rows.copy()
-    out_df = out_df.drop(columns=['timestamp', 'species'])
-    
-    # for each animal
-    for _, group in grouped:
-        last_lat, last_long, last_count = 0, 0, 0
-        last_lat_2, last_long_2, last_count_2 = 0, 0, 0
-
-        # set the lag values to the last value (or last 2) from the previous year 
-        if len(group) >= 1:
-            last_lat = group.iloc[-1]['LATITUDE']
-            last_long = group.iloc[-1]['LONGITUDE']
-            last_count = group.iloc[-1]['NUMBER']
-
-            if len(group) >= 2:
-                last_lat_2 = group.iloc[-2]['LATITUDE']
-                last_long_2 = group.iloc[-2]['LONGITUDE']
-                last_count_2 = group.iloc[-2]['NUMBER']
-        
-        # go through each row for each animal to generate synthetic predictions and update the lags 
-        i = 0
-        for row_idx, row in group.iterrows():
-            #update lag values 
-            if i == 0:
-                row['lat_lag1'] = last_lat
-                row['lon_lag1'] = last_long
-                row['count_lag1'] = last_count
-                row['lat_lag2'] = last_lat_2
-                row['lon_lag2'] = last_long_2
-                row['count_lag2'] = last_count_2
-            else:
-                row['lat_lag1'] = future_rows.loc[row_idx-1, 'LATITUDE']
-                row['lon_lag1'] = future_rows.loc[row_idx-1, 'LONGITUDE']
-                row['count_lag1'] = future_rows.loc[row_idx-1, 'NUMBER']
-                row['lat_lag2'] = future_rows.loc[row_idx-1, 'lat_lag1']
-                row['lon_lag2'] = future_rows.loc[row_idx-1, 'lon_lag1']
-                row['count_lag2'] = future_rows.loc[row_idx-1, 'count_lag1']
-            
-            row['LATITUDE'] = np.nan
-            row['LONGITUDE'] = np.nan
-            row['NUMBER'] = np.nan
-
-            # drop the rows that shouldn't be used for predictions
-            curr_row_df = row.to_frame().T 
-            curr_row = curr_row_df.drop(columns=['ID', 'timestamp', 'species', 'LATITUDE', 'LONGITUDE', 'NUMBER'])
-            
-            # predict the number of animals
-            num_pred = final_predict(models['num_model'][0], models['num_model'][1], curr_row)
-
-            # predict the latitude
-            lat_row_scaled = models['lat_model'][1].transform(curr_row)
-            lat_pred = models['lat_model'][0].predict(lat_row_scaled)
-
-            # predict the longitude
-            long_row_scaled = models['long_model'][1].transform(curr_row)
-            long_pred = models['long_model'][0].predict(long_row_scaled)
-            
-            # round the number of animals to the nearest whole number and assign the predictions to the appropriate column
-            row['NUMBER'] = np.round(num_pred)
-            row['LATITUDE'] = lat_pred[0]
-            row['LONGITUDE'] = long_pred[0]
-
-            # add the row to the out dataframe without timestamp or species
-            row = row.drop(labels=['timestamp', 'species'])
-            out_df.loc[row_idx] = row
+    Returns:
+        - models (dict) - The models with the number model replaced by its LSTMPredictor
+    '''
+    for _, scaler in models.values():
+        schema.check_scaler(scaler)
 
-    # add the synthetic data to the original dataframe and return
-    combined_df = pd.concat([df, out_df], ignore_index=True)
-    return combined_df
+    num_model, num_scaler = models['num_model']
+    if not isinstance(num_model, LSTMPredictor):
+        num_model = LSTMPredictor(num_model, num_scaler)
+    return {**models, 'num_model': [num_model, num_scaler]}
+
+def get_forecast_state(df, schema, window, last_year=2022):
+    '''
+    Gets the state a forecast starts from: the rows of the last year, how their IDs follow the last ID and, for a sequence number
+    model, the last rows of each species
+
+    Inputs:
+        - df (pd.Dataframe) - The original dataframe to use for generating synthetic data
+        - schema (FeatureSchema) - The schema of df
+        - window (int) - The number of rows the number model reads for each prediction
+        - last_year (int) - The last_year to use as a baseline
+
+    Returns:
+        - past_year (np.Array) - The rows of the last year, built by schema.to_matrix
+        - id_offsets (np.Array) - How far past the last ID of the last year the ID of each new row is, minus 1
+        - history (tuple) - The history of each species from get_species_history(), None if the number model reads single rows
+    '''
+    past_rows = df[df['COUNT'] == last_year]
+    past_year = schema.to_matrix(past_rows)
+    id_offsets = np.asarray(past_rows.index - past_rows.index[0])
+
+    # a sequence number model also needs the last rows of each species, which are updated with each new year
+    history = None
+    if window > 1:
+        history = get_species_history(df, schema, window - 1)
+
+    return past_year, id_offsets, history
+
+# the directory the checkpoint of each forecast year is cached in
+FORECAST_CACHE_DIR = './data/cache/forecast'
+
+# increase when the forecast recursion changes so older checkpoints are ignored
+FORECAST_VERSION = 2
+
+def forecast_fingerprint(df, models, last_year=2022):
+    '''
+    Returns a fingerprint of everything a forecast depends on: the dataframe it starts from, the year it starts after, the
+    weights of the models and the version of the forecast recursion
+
+    Inputs:
+        - df (pd.Dataframe) - The original dataframe to use for generating synthetic data
+        - models (dict) - The models used by the forecast, each with their own scaler
+        - last_year (int) - The last_year to use as a baseline
+
+    Returns:
+        - fingerprint (str) - The hex digest of the fingerprint
+    '''
+    return data_fingerprint(df, extra={'last_year': last_year, 'models': model_fingerprint(models), 'version': FORECAST_VERSION})
+
+def get_checkpoint_path(cache_dir, fingerprint, year):
+    '''
+    Returns the path of the checkpoint of a forecast year
+    '''
+    return os.path.join(cache_dir, fingerprint[:16], f'{year}.npz')
+
+def save_forecast_checkpoint(path, fingerprint, past_year, history=None):
+    '''
+    Saves the state of a forecast at the end of a year: the rows of the year (which are also its output) and the history of each
+    species. The file is written under a temporary name and then renamed so a partially written checkpoint is never loaded.
+
+    Inputs:
+        - path (str) - The path of the checkpoint
+        - fingerprint (str) - The fingerprint of the forecast from forecast_fingerprint()
+        - past_year (np.Array) - The rows of the year, built by schema.to_matrix
+        - history (tuple) - The history of each species after the year, None if the number model reads single rows
+    '''
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    state = {'fingerprint': np.array(fingerprint), 'past_year': past_year}
+    if history is not None:
+        state['tails'], state['lengths'] = history
+
+    tmp_path = f'{path}.{os.getpid()}.tmp.npz'
+    np.savez(tmp_path, **state)
+    os.replace(tmp_path, path)
+
+def load_forecast_checkpoint(path, fingerprint):
+    '''
+    Loads the state of a forecast at the end of a year saved by save_forecast_checkpoint()
+
+    Inputs:
+        - path (str) - The path of the checkpoint
+        - fingerprint (str) - The fingerprint of the forecast from forecast_fingerprint()
+
+    Returns:
+        - past_year (np.Array) - The rows of the year, or None if no checkpoint of this forecast is saved
+        - history (tuple) - The history of each species after the year, None if the number model reads single rows
+    '''
+    if not os.path.exists(path):
+        return None, None
+
+    with np.load(path) as state:
+        # ignore a checkpoint of a different forecast that shares the fingerprint prefix
+        if str(state['fingerprint']) != fingerprint:
+            return None, None
+        history = (state['tails'], state['lengths']) if 'tails' in state else None
+        return state['past_year'], history
+
+def iter_future_predictions(df, models, num_years_to_pred=1, last_year=2022, cache_dir=None):
+    '''
+    Generates synthetic data one year at a time, keeping only the rows of the last generated year (and the last rows of each species
+    for a sequence number model) between years instead of the whole history. With a cache directory the state at the end of every
+    year is checkpointed, and the years already checkpointed for the same data and models are loaded instead of predicted, so
+    extending the horizon only predicts the new years.
+
+    Inputs:
+        - df (pd.Dataframe) - The original dataframe to use for generating synthetic data
+        - models (dict) - A dictionary for the model to predict the number of animals, the latitude and the longitude each with ther
+                          own scaler
+        - num_years_to_pred (int) - The number of years past the last year to create synthetic data for
+        - last_year (int) - The last_year to use as a baseline
+        - cache_dir (str) - The optional directory to checkpoint each year in (e.g. FORECAST_CACHE_DIR)
+
+    Returns:
+        - year_df (pd.Dataframe) - Yields the synthetic data of each year in order
+    '''
+    # the checkpoints of a forecast are only valid for the same starting data and models
+    fingerprint = forecast_fingerprint(df, models, last_year) if cache_dir is not None else None
+
+    # build the schema once for every year
+    schema = FeatureSchema.from_df(df)
+    models = prepare_forecast_models(models, schema)
+    past_year, id_offsets, history = get_forecast_state(df, schema, models['num_model'][0].window, last_year)
+
+    for year in range(last_year + 1, last_year + num_years_to_pred + 1):
+        checkpoint = None
+        if cache_dir is not None:
+            path = get_checkpoint_path(cache_dir, fingerprint, year)
+            checkpoint, checkpoint_history = load_forecast_checkpoint(path, fingerprint)
+
+        if checkpoint is not None:
+            print(f'Loaded predictions for year: {year}')
+            past_year, history = checkpoint, checkpoint_history
+        else:
+            print(f'Generating predictions for year: {year}')
+            past_year = forecast_next_year(past_year, id_offsets, models, schema, history)
+            if history is not None:
+                history = append_group_tails(*history, schema.features(past_year), schema.get_species(past_year))
+            if cache_dir is not None:
+                save_forecast_checkpoint(path, fingerprint, past_year, history)
+
+        # the rows of the new year are contiguous so their IDs follow on from each other
+        id_offsets = np.arange(len(past_year))
+
+        yield schema.to_df(past_year)
 
 def get_predictions_for_mult_yrs(df, models, num_years_to_pred=1, last_year=2022):
     '''
@@ -127,95 +383,407 @@ def get_predictions_for_mult_yrs(df, models, num_years_to_pred=1, last_year=2022
                           own scaler
         - num_years_to_pred (int) - The number of years past the last year to create synthetic data for
         - last_year (int) - The last_year to use as a baseline
-    '''
-    # the returned dataframe
-    out_df = df.copy()
 
-    # iterable year
-    next_year = last_year
+    Returns:
+        - out_df (pd.Dataframe) - The original dataframe followed by the synthetic data of every year
+    '''
+    # combine the years once at the end instead of copying the whole history every year
+    return pd.concat([df, *iter_future_predictions(df, models, num_years_to_pred, last_year)], ignore_index=True)
 
-    # generate data for years in the specified range
-    for i in range(num_years_to_pred):
-        # create the synthetic data and use that as the new last year to continue generating more synthetic data
-        print(f'Generating predictions for year: {next_year + 1}')
-        out_df = get_future_predictions(out_df, models, next_year)
-        next_year += 1
-    
-    return out_df
+# the gradient boosting backend of the latitude and longitude models as specified in make_gb_model()
+GB_BACKEND = 'exact'
 
-def main():
-    print('Reading in dataframe')
-    df = pd.read_excel('./data/GNP_Aerial_counting_1969_2022.xlsx') # read in the dataframe
-    print('Successfuly loaded dataframe')
+# the hyperparameters of the dl model that predicts the number of animals
+NUM_MODEL_PARAMS = {'num_epochs': 100, 'window': SEQUENCE_WINDOW, 'batch_size': 32, 'hidden_size': 64, 'num_layers': 2}
 
-    print('Cleaning dataframe')
-    cleaned_df = clean_df(df) # pre-process the data
-    print('Cleaning complete')
+def scale_inputs(train_df, scaler=None):
+    '''
+    Fits a StandardScaler on the model inputs of the training data, or scales them with a scaler that was already fit
 
-    # fill Nan values with the mean of the data
-    train_df = cleaned_df.fillna(cleaned_df.mean()) 
+    Inputs:
+        - train_df (pd.Dataframe) - The cleaned training data with no Nan values
+        - scaler (StandardScaler) - Optional scaler already fit on the model inputs (e.g. from survey_store.get_store_scaler())
 
+    Returns:
+        - X_train (np.Array) - The scaled model inputs
+        - scaler (StandardScaler) - The fitted scaler
+    '''
     # create the training data
-    X_train = train_df.drop(columns=['ID', 'LATITUDE', 'LONGITUDE', 'NUMBER']) 
+    X_train = train_df.drop(columns=['ID', 'LATITUDE', 'LONGITUDE', 'NUMBER'])
 
     # scale the training data
-    scaler = StandardScaler()
-    X_train = scaler.fit_transform(X_train)
-
-    print('Starting dl model training')
-    print('Training number model')
-    num_model, num_scaler = final_train(train_df, ['NUMBER']) # train the model that predicts the number of animals
-    print('Number model training complete')
-    print('Successfully trained dl model')
-
-    print('Starting non-dl model training')
-    print('Training latitude model')
-    lat_model = train_gb_model(X_train, y_train=train_df['LATITUDE']) # train the model that predicts the latitude
-    print('Latitude model training complete')
-
-    print('Training longitude model')
-    long_model = train_gb_model(X_train, y_train=train_df['LONGITUDE']) # train the model that predicts the longitude
-    print('Longitude model training complete')
-
-    # create the dictionary for the trained models and their respective scalers
-    trained_models = {
-        'num_model': [num_model, num_scaler],
-        'lat_model': [lat_model, scaler],
-        'long_model': [long_model, scaler]
-    }
-
-    print('Successfully trained non-dl model')
-
-    # generate the synthetic data
-    last_year = 2022
-    num_years = 2030 - last_year
-    if num_years == 1:
-        print(f'Producing predictions for: {last_year + 1}')
+    if scaler is None:
+        scaler = StandardScaler()
+        X_train = scaler.fit_transform(X_train)
     else:
-        print(f'Producing predictions for years: {last_year + 1} to {last_year + num_years}')
+        X_train = scaler.transform(X_train)
 
-    predicted_df = get_predictions_for_mult_yrs(train_df, trained_models, num_years_to_pred=num_years, last_year=last_year)
-    print('Completed generating predictions')
+    return X_train, scaler
+
+def train_num_model(train_df, scaler=None):
+    '''
+    Trains the dl model that predicts the number of animals and returns it with its scaler
+    '''
+    return final_train(train_df, ['NUMBER'], scaler=scaler, **NUM_MODEL_PARAMS)
+
+def train_lat_model(train_df, scaler=None):
+    '''
+    Trains the non-dl model that predicts the latitude and returns it with its scaler
+    '''
+    X_train, scaler = scale_inputs(train_df, scaler)
+    return train_gb_model(X_train, y_train=train_df['LATITUDE'], backend=GB_BACKEND), scaler
+
+def train_long_model(train_df, scaler=None):
+    '''
+    Trains the non-dl model that predicts the longitude and returns it with its scaler
+    '''
+    X_train, scaler = scale_inputs(train_df, scaler)
+    return train_gb_model(X_train, y_train=train_df['LONGITUDE'], backend=GB_BACKEND), scaler
+
+def train_lat_long_model(train_df, scaler=None):
+    '''
+    Trains the non-dl model that predicts the latitude and longitude together and returns it with its scaler
+    '''
+    X_train, scaler = scale_inputs(train_df, scaler)
+    return train_coord_model(X_train, y_train=train_df[['LATITUDE', 'LONGITUDE']]), scaler
+
+def get_model_trainers(joint_coords=False, scaler=None):
+    '''
+    Returns the function used to train each of the models used for forecasting
+
+    Inputs:
+        - joint_coords (bool) - Whether to predict the latitude and longitude with one multi-output model instead of one model each
+        - scaler (StandardScaler) - Optional scaler already fit on the model inputs that every model uses instead of fitting its own
+
+    Returns:
+        - trainers (dict) - The name of each model mapped to the function that trains it
+    '''
+    if joint_coords:
+        trainers = {'num_model': train_num_model, 'coord_model': train_lat_long_model}
+    else:
+        trainers = {'num_model': train_num_model, 'lat_model': train_lat_model, 'long_model': train_long_model}
+
+    if scaler is None:
+        return trainers
+    return {name: partial(train, scaler=scaler) for name, train in trainers.items()}
+
+def get_model_params(name):
+    '''
+    Returns the hyperparameters a model is trained with
+    '''
+    if name == 'num_model':
+        return NUM_MODEL_PARAMS
+    if name == 'coord_model':
+        return COORD_MODEL_PARAMS
+    return make_gb_model(GB_BACKEND).get_params()
+
+def get_store_fingerprint(name, train_df, scaler=None):
+    '''
+    Returns the fingerprint a model trained on train_df is stored under, from the training data, the hyperparameters of the model
+    and the scaler it is trained with, so a change to any of them trains the model again instead of loading a version trained with
+    the old ones
+
+    Inputs:
+        - name (str) - The name of the model
+        - train_df (pd.Dataframe) - The cleaned training data with no Nan values
+        - scaler (StandardScaler) - The scaler the model is given, or None if it fits its own on train_df
+
+    Returns:
+        - fingerprint (str) - The fingerprint of the model
+    '''
+    return data_fingerprint(train_df, extra={'model': name, 'gb_backend': GB_BACKEND, 'params': get_model_params(name),
+                                             'scaler': scaler_fingerprint(scaler)})
+
+def load_or_train_models(train_df, store_dir=STORE_DIR, retrain=False, max_workers=None, joint_coords=False, scaler=None):
+    '''
+    Loads each forecasting model from the model store if a version trained on train_df exists, otherwise trains the model and saves
+    it to the store so later runs can skip training. Models that need training are trained concurrently in separate processes.
+
+    Inputs:
+        - train_df (pd.Dataframe) - The cleaned training data with no Nan values
+        - store_dir (str) - The directory of the model store
+        - retrain (bool) - Whether to train every model even if a matching version is stored
+        - max_workers (int) - The maximum number of models to train at once, one process per model if not given
+        - joint_coords (bool) - Whether to predict the latitude and longitude with one multi-output model instead of one model each
+        - scaler (StandardScaler) - Optional scaler already fit on train_df (e.g. from the running statistics of the survey store)
+                                    that the models are trained with instead of each fitting its own
+
+    Returns:
+        - trained_models (dict) - A dictionary for the model to predict the number of animals, the latitude and the longitude each
+                                  with their own scaler
+    '''
+    model_trainers = get_model_trainers(joint_coords, scaler)
+    schema = FeatureSchema.from_df(train_df)
+    artifacts = {}
+    jobs = {}
+
+    for name, train in model_trainers.items():
+        # the fingerprint of the training data and settings for this model
+        fingerprint = get_store_fingerprint(name, train_df, scaler)
+        artifact = None if retrain else load_artifact(name, fingerprint, store_dir)
+
+        if artifact is None:
+            jobs[name] = (train, train_df, fingerprint, schema)
+        else:
+            print(f'Loaded {name} from the model store')
+            artifacts[name] = artifact
 
-    # add the synthetic data to the original dataframe
-    predictions_from_2023 = predicted_df[predicted_df['COUNT'] >= 2023]
-    output_df = pd.concat([cleaned_df, predictions_from_2023], ignore_index=True)
+    # train the missing models at the same time and save them to the store
+    if jobs:
+        print(f"Training {', '.join(jobs)}")
+        for name, artifact in train_in_parallel(jobs, max_workers=max_workers).items():
+            save_artifact(name, artifact, store_dir)
+            artifacts[name] = artifact
+        print('Training complete')
+
+    return {name: [artifacts[name]['model'], artifacts[name]['scaler']] for name in model_trainers}
+
+# the number of trees grown and the number of epochs fine-tuned by an incremental update
+UPDATE_TREES = 50
+UPDATE_EPOCHS = 5
+
+# the number of earlier rows replayed for every new row in an incremental update
+REPLAY_RATIO = 2
+
+# the number of incremental updates in a row before a model is trained from scratch again
+FULL_RETRAIN_EVERY = 4
+
+# the relative increase of the error on the replayed earlier rows an update may cause before the model is trained from scratch
+UPDATE_TOLERANCE = 0.1
+
+# the targets of each model
+MODEL_TARGETS = {'num_model': ['NUMBER'], 'lat_model': ['LATITUDE'], 'long_model': ['LONGITUDE'], 'coord_model': ['LATITUDE', 'LONGITUDE']}
+
+def get_replay_rows(num_rows, num_new_rows, replay_ratio=REPLAY_RATIO, seed=0):
+    '''
+    Returns the rows an incremental update trains on: every new row (the last num_new_rows) and a random sample of replay_ratio
+    earlier rows for each of them, so the update doesn't forget the earlier surveys
+
+    Inputs:
+        - num_rows (int) - The number of rows of the training data
+        - num_new_rows (int) - The number of new rows at the end of the training data
+        - replay_ratio (int) - The number of earlier rows sampled for every new row
+        - seed (int) - The seed of the sample
+
+    Returns:
+        - rows (np.Array) - The sorted positions of the rows
+    '''
+    num_old_rows = num_rows - num_new_rows
+    rng = np.random.default_rng(seed)
+    old_rows = rng.choice(num_old_rows, size=min(num_old_rows, replay_ratio * num_new_rows), replace=False)
+    return np.sort(np.concatenate([old_rows, np.arange(num_old_rows, num_rows)]))
+
+def update_num_model(model, scaler, train_df, rows):
+    '''
+    Fine-tunes the dl model that predicts the number of animals on the given rows
+    '''
+    return final_update(model, scaler, train_df, ['NUMBER'], rows, num_epochs=UPDATE_EPOCHS)
+
+def update_lat_model(model, scaler, train_df, rows):
+    '''
+    Grows more trees of the non-dl model that predicts the latitude on the given rows
+    '''
+    X_train = scaler.transform(train_df.drop(columns=['ID', 'LATITUDE', 'LONGITUDE', 'NUMBER']).iloc[rows])
+    return update_tree_model(model, X_train, train_df['LATITUDE'].iloc[rows], num_trees=UPDATE_TREES)
+
+def update_long_model(model, scaler, train_df, rows):
+    '''
+    Grows more trees of the non-dl model that predicts the longitude on the given rows
+    '''
+    X_train = scaler.transform(train_df.drop(columns=['ID', 'LATITUDE', 'LONGITUDE', 'NUMBER']).iloc[rows])
+    return update_tree_model(model, X_train, train_df['LONGITUDE'].iloc[rows], num_trees=UPDATE_TREES)
+
+def update_lat_long_model(model, scaler, train_df, rows):
+    '''
+    Grows more trees of the non-dl model that predicts the latitude and longitude together on the given rows
+    '''
+    X_train = scaler.transform(train_df.drop(columns=['ID', 'LATITUDE', 'LONGITUDE', 'NUMBER']).iloc[rows])
+    return update_tree_model(model, X_train, train_df[['LATITUDE', 'LONGITUDE']].iloc[rows], num_trees=UPDATE_TREES)
+
+def get_model_updaters(joint_coords=False):
+    '''
+    Returns the function used to incrementally update each of the models used for forecasting, matching get_model_trainers()
+    '''
+    if joint_coords:
+        return {'num_model': update_num_model, 'coord_model': update_lat_long_model}
+
+    return {'num_model': update_num_model, 'lat_model': update_lat_model, 'long_model': update_long_model}
+
+def get_model_error(name, model, scaler, train_df, rows):
+    '''
+    Returns the mean absolute error of a model on the given rows, averaged over its targets
+
+    Inputs:
+        - name (str) - The name of the model
+        - model (nn.Module or sklearn estimator) - The trained model
+        - scaler (StandardScaler) - The scaler of the model
+        - train_df (pd.Dataframe) - The cleaned training data with no Nan values
+        - rows (np.Array) - The positions of the rows
+
+    Returns:
+        - error (float) - The mean absolute error
+    '''
+    if name == 'num_model':
+        # the dl model reads the survey history before each row
+        predicted = final_predict_windows(model, get_final_windows(train_df, scaler), rows)
+    else:
+        predicted = model.predict(scaler.transform(train_df.drop(columns=['ID', 'LATITUDE', 'LONGITUDE', 'NUMBER']).iloc[rows]))
+
+    return mean_absolute_error(train_df[MODEL_TARGETS[name]].iloc[rows], predicted)
+
+def update_models(previous_df, train_df, store_dir=STORE_DIR, max_workers=None, joint_coords=False, full_retrain_every=FULL_RETRAIN_EVERY,
+                  tolerance=UPDATE_TOLERANCE, scaler=None, previous_scaler=None):
+    '''
+    Updates the stored models trained on previous_df with the new rows of train_df instead of training them from scratch: the
+    gradient boosting models grow more trees and the dl model is fine-tuned for a few epochs, both on the new rows and a sample of
+    the earlier ones. An update that makes a model worse on the earlier rows by more than tolerance is dropped for a full retrain,
+    and every full_retrain_every updates in a row the model is trained from scratch and compared with the updated one so the drift
+    of the updates is measured. Models already stored for train_df are loaded and models with no stored version for previous_df are
+    trained from scratch.
+
+    Inputs:
+        - previous_df (pd.Dataframe) - The cleaned training data the stored models were trained on
+        - train_df (pd.Dataframe) - The cleaned training data with no Nan values, the rows of previous_df followed by the new rows
+        - store_dir (str) - The directory of the model store
+        - max_workers (int) - The maximum number of models to train from scratch at once
+        - joint_coords (bool) - Whether to predict the latitude and longitude with one multi-output model instead of one model each
+        - full_retrain_every (int) - The number of updates in a row before a model is trained from scratch
+        - tolerance (float) - The relative increase of the error on the earlier rows an update may cause
+        - scaler (StandardScaler) - Optional scaler already fit on train_df that the models trained from scratch are trained with
+        - previous_scaler (StandardScaler) - The scaler the stored models were trained with if they were given one, to find them
+
+    Returns:
+        - trained_models (dict) - A dictionary for the model to predict the number of animals, the latitude and the longitude each
+                                  with their own scaler
+    '''
+    model_trainers = get_model_trainers(joint_coords, scaler)
+    model_updaters = get_model_updaters(joint_coords)
+    schema = FeatureSchema.from_df(train_df)
+    rows = get_replay_rows(len(train_df), len(train_df) - len(previous_df))
+    old_rows = rows[rows < len(previous_df)]
+    artifacts = {}
+    jobs = {}
+    updated = {}
+
+    for name, train in model_trainers.items():
+        fingerprint = get_store_fingerprint(name, train_df, scaler)
+        artifact = load_artifact(name, fingerprint, store_dir)
+        if artifact is not None:
+            print(f'Loaded {name} from the model store')
+            artifacts[name] = artifact
+            continue
+
+        # the version of the model trained on the earlier rows
+        base = load_artifact(name, get_store_fingerprint(name, previous_df, previous_scaler), store_dir)
+        if base is None:
+            print(f'No stored version of {name} to update')
+            jobs[name] = (train, train_df, fingerprint, schema)
+            continue
+
+        print(f'Updating {name}')
+        model = model_updaters[name](base['model'], base['scaler'], train_df, rows)
+        num_updates = base['meta']['extra'].get('num_updates', 0) + 1
+
+        # the update must not make the model forget the earlier rows
+        base_error = get_model_error(name, base['model'], base['scaler'], train_df, old_rows)
+        update_error = get_model_error(name, model, base['scaler'], train_df, old_rows)
+        if update_error > base_error * (1 + tolerance):
+            print(f'Updating {name} increased its error on the earlier rows from {base_error:.4f} to {update_error:.4f}, training it from scratch')
+            jobs[name] = (train, train_df, fingerprint, schema)
+        elif num_updates >= full_retrain_every:
+            print(f'{name} was updated {num_updates} times in a row, training it from scratch')
+            jobs[name] = (train, train_df, fingerprint, schema)
+            updated[name] = [model, base['scaler']]
+        else:
+            artifacts[name] = make_artifact(model, base['scaler'], fingerprint, schema,
+                                            extra={'num_updates': num_updates, 'base_fingerprint': base['meta']['fingerprint']})
+            save_artifact(name, artifacts[name], store_dir)
+
+    # train the models that couldn't be updated from scratch
+    if jobs:
+        print(f"Training {', '.join(jobs)}")
+        for name, artifact in train_in_parallel(jobs, max_workers=max_workers).items():
+            # compare the updated model with the full retrain on the rows of the update
+            if name in updated:
+                update_error = get_model_error(name, *updated[name], train_df, rows)
+                retrain_error = get_model_error(name, artifact['model'], artifact['scaler'], train_df, rows)
+                print(f'{name} error of the updates: {update_error:.4f}, of the full retrain: {retrain_error:.4f}')
+                artifact['meta']['extra'] = {'update_error': update_error, 'retrain_error': retrain_error}
+            save_artifact(name, artifact, store_dir)
+            artifacts[name] = artifact
+        print('Training complete')
+
+    return {name: [artifacts[name]['model'], artifacts[name]['scaler']] for name in model_trainers}
+
+def main(retrain=False, joint_coords=False, output_path='animal_migration.csv', export_dir='animal_migration',
+         binary_path='animal_migration.bin', grid_path='animal_migration_grid.parquet', forecast_cache_dir=FORECAST_CACHE_DIR,
+         survey_store_dir=None, update=False):
+    print('Reading in dataframe')
+    if survey_store_dir is None:
+        cleaned_df = load_clean_survey() # read in the pre-processed dataframe from the cache (built from the workbook on the first run)
+        means = cleaned_df.mean()
+        scaler = None
+    else:
+        # read the surveys ingested into the store, and the column means and the scaler of the model inputs from its running
+        # statistics instead of a pass over every row
+        cleaned_df = load_store(survey_store_dir)
+        state = read_state(survey_store_dir)
+        means = get_store_means(state)
+        scaler = get_store_scaler(state)
+    print('Successfuly loaded dataframe')
+
+    # fill Nan values with the mean of the data
+    train_df = cleaned_df.fillna(means)
+
+    if update and survey_store_dir is not None and len(state['parts']) > 1 and not retrain:
+        # update the models trained before the last survey was ingested with its rows
+        num_parts = len(state['parts']) - 1
+        previous_df = load_store(survey_store_dir, num_parts).fillna(get_store_means(state, num_parts))
+        trained_models = update_models(previous_df, train_df, joint_coords=joint_coords, scaler=scaler,
+                                       previous_scaler=get_store_scaler(state, num_parts))
+    else:
+        # load the models trained on this data from the model store or train them if they don't exist yet
+        trained_models = load_or_train_models(train_df, retrain=retrain, joint_coords=joint_coords, scaler=scaler)
+    print('Successfully loaded models')
 
     # re-combine the species column from being one-hot encoded to a single column and label encode that column for faster
-    # processing on the front-end
+    # processing on the front-end. The forecast only copies species from the survey so the survey has every species.
     le = LabelEncoder()
-    species_columns = [col for col in output_df.columns if col.startswith('SPECIES_')]
+    species_columns = [col for col in cleaned_df.columns if col.startswith('SPECIES_')]
+    le.fit(cleaned_df[species_columns].idxmax(axis=1).str.replace('SPECIES_', ''))
 
-    output_df['SPECIES'] = output_df[species_columns].idxmax(axis=1).str.replace('SPECIES_', '')
-    output_df['SPECIES'] = le.fit_transform(output_df['SPECIES'])
+    # cast each column to the dtype it would have with the survey and the forecast in one dataframe
+    dtypes = {col: np.result_type(cleaned_df[col].dtype, train_df[col].dtype) for col in OUTPUT_COLUMNS if col in cleaned_df.columns}
 
-    # output only the necessary columns for front-end development
-    output_df = output_df[['ID', 'COUNT', 'MONTH', 'DATE', 'TIME', 'NUMBER', 'LATITUDE', 'LONGITUDE', 'SPECIES']]
+    # generate the synthetic data from the year after the last survey
+    last_year = int(cleaned_df['COUNT'].max())
+    num_years = 2030 - last_year
+    if num_years == 1:
+        print(f'Producing predictions for: {last_year + 1}')
+    else:
+        print(f'Producing predictions for years: {last_year + 1} to {last_year + num_years}')
 
-    # output the final dataframe as a CSV
-    print('Outputting to CSV')
-    output_df.to_csv('animal_migration.csv')
-    print('Completed outputting to CSV')
+    # stream the survey followed by each forecast year to the output (a .csv or .parquet file, or a directory partitioned by year)
+    # so only the last forecast year is kept in memory, to a dataset indexed by year and month for range queries if export_dir is
+    # given, to packed binary records if binary_path is given and to a summary of the sightings in each cell of a grid for each species
+    # and month (for drawing the map zoomed out) if grid_path is given
+    print(f'Outputting to {output_path}')
+    sinks = [make_sink(output_path, le.classes_)]
+    if export_dir is not None:
+        sinks.append(IndexedPartitionSink(export_dir))
+    if binary_path is not None:
+        sinks.append(BinarySink(binary_path, le.classes_))
+    if grid_path is not None:
+        sinks.append(GridSummarySink(grid_path))
+    with ForecastWriter(MultiSink(sinks), le.classes_, dtypes) as writer:
+        # the indexed dataset needs the rows in year order, the stable sort keeps the order of the rows within each year
+        writer.write(cleaned_df.sort_values('COUNT', kind='stable'), chunk_size=100000)
+        # years already forecast with the same data and models are loaded from their checkpoints
+        for year_df in iter_future_predictions(train_df, trained_models, num_years_to_pred=num_years, last_year=last_year,
+                                               cache_dir=forecast_cache_dir):
+            writer.write(year_df)
+    print('Completed generating predictions')
+    print(f'Completed outputting to {", ".join(path for path in [output_path, export_dir, binary_path, grid_path] if path is not None)}')
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,54 @@
+import torch
+
+class TensorBatches:
+    '''
+    TensorBatches iterates over in-memory tensors in shuffled batches. It is a drop-in replacement for a DataLoader over a
+    TensorDataset for data that already fits in memory: instead of indexing and collating every sample, each epoch draws a single
+    permutation, gathers every tensor in that order once and yields contiguous slices of the shuffled tensors as the batches.
+    With num_members each member of an ensemble draws its own permutation and the batches are stacked with a leading member
+    dimension, so the members of an EnsembleMultiOutputNN see different batches like separately trained models.
+    '''
+    def __init__(self, *tensors, batch_size=32, shuffle=True, generator=None, drop_last=False, num_members=None):
+        if any(len(tensor) != len(tensors[0]) for tensor in tensors):
+            raise ValueError('All tensors must have the same number of rows')
+
+        self.tensors = tensors
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.generator = generator
+        self.drop_last = drop_last
+        self.num_members = num_members
+
+    def __len__(self):
+        '''
+        Returns the number of batches in an epoch
+        '''
+        num_rows = len(self.tensors[0])
+        if self.drop_last:
+            return num_rows // self.batch_size
+        return (num_rows + self.batch_size - 1) // self.batch_size
+
+    def __iter__(self):
+        tensors = self.tensors
+        if self.num_members is not None:
+            # gather every tensor in the order of one permutation per member into [members, rows, ...] tensors
+            num_rows = len(tensors[0])
+            if self.shuffle:
+                order = torch.stack([torch.randperm(num_rows, generator=self.generator) for _ in range(self.num_members)])
+            else:
+                order = torch.arange(num_rows).expand(self.num_members, -1)
+            tensors = [tensor[order] for tensor in tensors]
+
+            for i in range(len(self)):
+                start = i * self.batch_size
+                yield tuple(tensor[:, start:start + self.batch_size] for tensor in tensors)
+            return
+
+        if self.shuffle:
+            # gather every tensor in the order of one permutation so each batch is a contiguous slice
+            order = torch.randperm(len(tensors[0]), generator=self.generator)
+            tensors = [tensor[order] for tensor in tensors]
+
+        for i in range(len(self)):
+            start = i * self.batch_size
+            yield tuple(tensor[start:start + self.batch_size] for tensor in tensors)
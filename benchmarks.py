@@ -0,0 +1,835 @@
+import os
+import tempfile
+import time
+import numpy as np
+import pandas as pd
+import torch
+from torch.utils.data import DataLoader, TensorDataset
+from sklearn.metrics import mean_absolute_error, r2_score
+from sklearn.preprocessing import StandardScaler
+from non_dl import clean_df, train_gb_model, train_coord_model
+from data_loader import DATA_PATH, load_survey, load_clean_survey
+from script_lstm import LSTMModel, LSTMPredictor, SEQUENCE_WINDOW
+from multi_output_nn import MultiOutputNN, EnsembleMultiOutputNN, train_dl_model, ensemble_mse_loss
+from batching import TensorBatches
+from sequences import SequenceWindows
+from training import fit_model, bf16_supported
+from forecast_writer import BinarySink, CSVSink, ForecastWriter, IndexedPartitionSink, MultiSink, read_binary, read_partitions
+from script_lstm import get_species_codes
+from scenarios import run_scenarios
+from animal_migration import iter_future_predictions, load_or_train_models, update_models, get_model_error, get_replay_rows
+from survey_store import create_store, ingest_survey, load_store, read_state, get_store_means
+from tuning import SEARCH_SPACES, get_brackets, run_trial, sample_configs, tune
+from non_dl import get_cv_fold, get_cv_years
+from spatial import GRID_CELL_SIZES, GridSummarySink, SightingIndex, get_species, points_in_polygon
+from tests.reference import reference_clean_df, reference_final_predict, get_output_years
+
+def time_call(func, *args, repeats=5, **kwargs):
+    '''
+    Times a function call and returns the best wall time over a number of repeats
+
+    Inputs:
+        - func (function) - The function to time
+        - repeats (int) - The number of times to call the function
+
+    Returns:
+        - best (float) - The fastest wall time in seconds
+        - result (Any) - The result of the last call
+    '''
+    best = float('inf')
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = func(*args, **kwargs)
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+def benchmark_clean_df(df, repeats=5):
+    '''
+    Prints the time taken by clean_df and the reference implementation (their parity is checked in tests/test_clean_df.py)
+
+    Inputs:
+        - df (pd.Dataframe) - The original dataframe (it is copied before every call)
+        - repeats (int) - The number of times to time each implementation
+
+    Returns:
+        - results (dict) - The best wall time in seconds for each implementation
+    '''
+    reference_time, _ = time_call(lambda: reference_clean_df(df.copy()), repeats=repeats)
+    vectorized_time, _ = time_call(lambda: clean_df(df.copy()), repeats=repeats)
+
+    print(f'clean_df reference: {reference_time:.4f}s, vectorized: {vectorized_time:.4f}s '
+          f'({reference_time / vectorized_time:.1f}x faster) on {len(df)} rows')
+
+    return {'reference': reference_time, 'vectorized': vectorized_time}
+
+def benchmark_load(path=DATA_PATH, repeats=3):
+    '''
+    Prints the time taken to read the workbook with openpyxl compared to reading the raw and cleaned columnar caches
+
+    Inputs:
+        - path (str) - The path of the workbook
+        - repeats (int) - The number of times to time each reader
+
+    Returns:
+        - results (dict) - The best wall time in seconds for each reader
+    '''
+    # make sure both caches exist so only the cached reads are timed
+    load_clean_survey(path)
+
+    excel_time, _ = time_call(pd.read_excel, path, repeats=repeats)
+    raw_time, _ = time_call(load_survey, path, repeats=repeats)
+    clean_time, _ = time_call(load_clean_survey, path, repeats=repeats)
+
+    print(f'read_excel: {excel_time:.4f}s, raw cache: {raw_time:.4f}s, cleaned cache: {clean_time:.4f}s')
+
+    return {'read_excel': excel_time, 'raw_cache': raw_time, 'clean_cache': clean_time}
+
+def get_holdout_split(cleaned_df, test_year=2022):
+    '''
+    Splits the cleaned dataframe into scaled training inputs and the held out test year the same way as non_dl.main()
+
+    Inputs:
+        - cleaned_df (pd.Dataframe) - The cleaned dataframe
+        - test_year (int) - The year to hold out
+
+    Returns:
+        - X_train (np.Array) - The scaled training inputs
+        - X_test (np.Array) - The scaled test inputs
+        - train_df (pd.Dataframe) - The training rows
+        - test_df (pd.Dataframe) - The test rows
+    '''
+    df = cleaned_df.fillna(cleaned_df.mean())
+    train_df = df[df['COUNT'] != test_year]
+    test_df = df[df['COUNT'] == test_year]
+
+    scaler = StandardScaler()
+    X_train = scaler.fit_transform(train_df.drop(columns=['ID', 'LATITUDE', 'LONGITUDE', 'NUMBER']))
+    X_test = scaler.transform(test_df.drop(columns=['ID', 'LATITUDE', 'LONGITUDE', 'NUMBER']))
+
+    return X_train, X_test, train_df, test_df
+
+def benchmark_gb_backends(cleaned_df, backends=('exact', 'hist'), targets=('NUMBER', 'LATITUDE', 'LONGITUDE'), test_year=2022):
+    '''
+    Compares the gradient boosting backends of train_gb_model on the held out test year
+
+    Inputs:
+        - cleaned_df (pd.Dataframe) - The cleaned dataframe
+        - backends (tuple) - The backends to compare
+        - targets (tuple) - The columns to train a model for
+        - test_year (int) - The year to hold out
+
+    Returns:
+        - results (pd.Dataframe) - The fit time, batch and single row predict latency, MAE and R2 of each backend and target
+    '''
+    X_train, X_test, train_df, test_df = get_holdout_split(cleaned_df, test_year)
+    results = []
+
+    for target in targets:
+        for backend in backends:
+            fit_time, model = time_call(train_gb_model, X_train, train_df[target], backend=backend, repeats=1)
+            batch_time, y_pred = time_call(model.predict, X_test)
+            row_time, _ = time_call(model.predict, X_test[:1], repeats=20)
+
+            results.append({
+                'target': target,
+                'backend': backend,
+                'fit_s': fit_time,
+                'predict_batch_ms': batch_time * 1000,
+                'predict_row_ms': row_time * 1000,
+                'mae': mean_absolute_error(test_df[target], y_pred),
+                'r2': r2_score(test_df[target], y_pred)
+            })
+
+    results = pd.DataFrame(results)
+    print(results.to_string(index=False))
+
+    return results
+
+def benchmark_coord_models(cleaned_df, backends=('exact', 'hist'), test_year=2022):
+    '''
+    Compares predicting the latitude and longitude with two gradient boosting models (scaling the inputs for each) against one
+    multi-output coordinate model (scaling the inputs once) on the held out test year
+
+    Inputs:
+        - cleaned_df (pd.Dataframe) - The cleaned dataframe
+        - backends (tuple) - The gradient boosting backends to compare against
+        - test_year (int) - The year to hold out
+
+    Returns:
+        - results (pd.Dataframe) - The fit time, batch and single row predict latency, MAE and R2 of each option
+    '''
+    X_train, X_test, train_df, test_df = get_holdout_split(cleaned_df, test_year)
+    raw_test = test_df.drop(columns=['ID', 'LATITUDE', 'LONGITUDE', 'NUMBER']).to_numpy(dtype=float)
+    scaler = StandardScaler().fit(train_df.drop(columns=['ID', 'LATITUDE', 'LONGITUDE', 'NUMBER']).to_numpy(dtype=float))
+    options = {}
+
+    # two independent models that each scale the inputs like the forecast loop used to
+    for backend in backends:
+        start = time.perf_counter()
+        lat_model = train_gb_model(X_train, train_df['LATITUDE'], backend=backend)
+        long_model = train_gb_model(X_train, train_df['LONGITUDE'], backend=backend)
+        fit_time = time.perf_counter() - start
+
+        def predict(X, lat_model=lat_model, long_model=long_model):
+            return np.column_stack([lat_model.predict(scaler.transform(X)), long_model.predict(scaler.transform(X))])
+
+        options[f'2 x gb ({backend})'] = (fit_time, predict)
+
+    # one model that predicts both from a single scaled input
+    fit_time, coord_model = time_call(train_coord_model, X_train, train_df[['LATITUDE', 'LONGITUDE']], repeats=1)
+    options['joint forest'] = (fit_time, lambda X: coord_model.predict(scaler.transform(X)))
+
+    results = []
+    for name, (fit_time, predict) in options.items():
+        batch_time, y_pred = time_call(predict, raw_test)
+        row_time, _ = time_call(predict, raw_test[:1], repeats=20)
+
+        results.append({
+            'model': name,
+            'fit_s': fit_time,
+            'predict_batch_ms': batch_time * 1000,
+            'predict_row_ms': row_time * 1000,
+            'mae_lat': mean_absolute_error(test_df['LATITUDE'], y_pred[:, 0]),
+            'mae_long': mean_absolute_error(test_df['LONGITUDE'], y_pred[:, 1]),
+            'r2_lat': r2_score(test_df['LATITUDE'], y_pred[:, 0]),
+            'r2_long': r2_score(test_df['LONGITUDE'], y_pred[:, 1])
+        })
+
+    results = pd.DataFrame(results)
+    print(results.to_string(index=False))
+
+    return results
+
+def benchmark_lstm_inference(n_features, batch_sizes=(1, 32, 1024), num_species=20):
+    '''
+    Prints the latency of the traced and frozen LSTMPredictor against the original final_predict called once per row for an
+    untrained single row LSTMModel, and against running an untrained LSTMModel of SEQUENCE_WINDOW rows eagerly on the same windows
+    of the history of each species
+
+    Inputs:
+        - n_features (int) - The number of model inputs
+        - batch_sizes (tuple) - The number of rows to predict per call
+        - num_species (int) - The number of species the rows are spread over
+
+    Returns:
+        - results (pd.Dataframe) - The latency of each implementation and the largest difference between them per batch size
+    '''
+    rng = np.random.default_rng(0)
+    scaler = StandardScaler().fit(rng.standard_normal((100, n_features)))
+    row_model = LSTMModel(n_features, 64, 2, 1).eval()
+    row_predictor = LSTMPredictor(row_model, scaler)
+    window_model = LSTMModel(n_features, 64, 2, 1, SEQUENCE_WINDOW).eval()
+    window_predictor = LSTMPredictor(window_model)
+    history = rng.standard_normal((num_species, SEQUENCE_WINDOW - 1, n_features))
+    history_lengths = rng.integers(0, SEQUENCE_WINDOW, num_species)
+    results = []
+
+    def predict_rows(rows):
+        # the original forecast loop called final_predict on every row
+        return np.concatenate([reference_final_predict(row_model, scaler, rows[i:i + 1]) for i in range(len(rows))])
+
+    def predict_windows(rows, groups):
+        # the window of each row is the history of its species followed by the earlier rows of its species and the row
+        real = np.arange(SEQUENCE_WINDOW - 1)[None, :] >= (SEQUENCE_WINDOW - 1 - history_lengths)[:, None]
+        history_groups = np.broadcast_to(np.arange(num_species)[:, None], real.shape)[real]
+        windows = SequenceWindows(np.concatenate([history[real], rows]), np.concatenate([history_groups, groups]), SEQUENCE_WINDOW)
+        with torch.no_grad():
+            return window_model(*windows[torch.arange(len(history_groups), len(windows))]).numpy()
+
+    for batch_size in batch_sizes:
+        rows = rng.standard_normal((batch_size, n_features))
+        groups = rng.integers(0, num_species, batch_size)
+        repeats = max(5, 2000 // batch_size)
+        calls = [
+            ('final_predict per row', (predict_rows, rows), (row_predictor.predict, rows)),
+            ('eager windows', (predict_windows, rows, groups), (window_predictor.predict_scaled, rows, history, history_lengths, groups))
+        ]
+
+        for reference, (reference_func, *reference_args), (engine_func, *engine_args) in calls:
+            reference_time, expected = time_call(reference_func, *reference_args, repeats=repeats)
+            engine_time, predicted = time_call(engine_func, *engine_args, repeats=repeats)
+
+            results.append({
+                'reference': reference,
+                'batch_size': batch_size,
+                'reference_ms': reference_time * 1000,
+                'engine_ms': engine_time * 1000,
+                'speedup': reference_time / engine_time,
+                'max_abs_diff': np.abs(expected - predicted).max()
+            })
+
+    results = pd.DataFrame(results)
+    print(results.to_string(index=False))
+
+    return results
+
+def benchmark_batching(cleaned_df, batch_sizes=(32, 256), num_epochs=3):
+    '''
+    Compares the epochs per second of train_dl_model when batching with a DataLoader over a TensorDataset against TensorBatches
+
+    Inputs:
+        - cleaned_df (pd.Dataframe) - The cleaned dataframe
+        - batch_sizes (tuple) - The batch sizes to compare
+        - num_epochs (int) - The number of epochs to time for each
+
+    Returns:
+        - results (pd.Dataframe) - The epochs per second of each batching method and batch size
+    '''
+    X_train, _, train_df, _ = get_holdout_split(cleaned_df)
+    X = torch.tensor(X_train, dtype=torch.float32)
+    y = torch.tensor(train_df[['NUMBER', 'LATITUDE', 'LONGITUDE']].to_numpy(), dtype=torch.float32)
+    results = []
+
+    for batch_size in batch_sizes:
+        loaders = {
+            'DataLoader': DataLoader(TensorDataset(X, y), batch_size=batch_size, shuffle=True),
+            'TensorBatches': TensorBatches(X, y, batch_size=batch_size)
+        }
+        for name, loader in loaders.items():
+            torch.manual_seed(0)
+            model = MultiOutputNN(input_size=X.shape[1])
+            fit_time, _ = time_call(train_dl_model, model, loader, epochs=num_epochs, repeats=1)
+            results.append({'batch_size': batch_size, 'loader': name, 'epochs_per_s': num_epochs / fit_time})
+
+    results = pd.DataFrame(results)
+    print(results.to_string(index=False))
+
+    return results
+
+def benchmark_ensemble(cleaned_df, sizes=(1, 3, 8), num_epochs=3):
+    '''
+    Compares the training time of an ensemble of MultiOutputNN models trained one after another against one EnsembleMultiOutputNN
+
+    Inputs:
+        - cleaned_df (pd.Dataframe) - The cleaned dataframe
+        - sizes (tuple) - The ensemble sizes to compare
+        - num_epochs (int) - The number of epochs to time for each
+
+    Returns:
+        - results (pd.Dataframe) - The fit time of each ensemble size when trained sequentially and batched
+    '''
+    X_train, _, train_df, _ = get_holdout_split(cleaned_df)
+    X = torch.tensor(X_train, dtype=torch.float32)
+    y = torch.tensor(train_df[['NUMBER', 'LATITUDE', 'LONGITUDE']].to_numpy(), dtype=torch.float32)
+    results = []
+
+    # warm up torch so the first size isn't charged for it
+    train_dl_model(MultiOutputNN(X.shape[1]), TensorBatches(X, y), epochs=1)
+
+    for size in sizes:
+        def train_sequential():
+            return [train_dl_model(MultiOutputNN(X.shape[1]), TensorBatches(X, y), epochs=num_epochs) for _ in range(size)]
+
+        def train_batched():
+            ensemble = EnsembleMultiOutputNN(X.shape[1], num_members=size)
+            return train_dl_model(ensemble, TensorBatches(X, y, num_members=size), epochs=num_epochs, criterion=ensemble_mse_loss)
+
+        sequential_time, _ = time_call(train_sequential, repeats=1)
+        batched_time, _ = time_call(train_batched, repeats=1)
+        results.append({'members': size, 'sequential_s': sequential_time, 'batched_s': batched_time,
+                        'speedup': sequential_time / batched_time})
+
+    results = pd.DataFrame(results)
+    print(results.to_string(index=False))
+
+    return results
+
+def benchmark_perf_mode(cleaned_df, num_epochs=5):
+    '''
+    Compares the default training of MultiOutputNN and the LSTM against perf mode (every core and fused Adam) with and without
+    bfloat16 autocast, reporting the epochs per second and the final training loss of each so the accuracy can be compared
+
+    Inputs:
+        - cleaned_df (pd.Dataframe) - The cleaned dataframe
+        - num_epochs (int) - The number of epochs to train for
+
+    Returns:
+        - results (pd.Dataframe) - The epochs per second and final loss of each model and mode
+    '''
+    X_train, _, train_df, _ = get_holdout_split(cleaned_df)
+    X = torch.tensor(X_train, dtype=torch.float32)
+    y = torch.tensor(train_df[['NUMBER', 'LATITUDE', 'LONGITUDE']].to_numpy(), dtype=torch.float32)
+    windows = SequenceWindows(X, get_species_codes(train_df), 4)
+    criterion = torch.nn.MSELoss()
+
+    # warm up torch so the first mode isn't charged for it
+    train_dl_model(MultiOutputNN(X.shape[1]), TensorBatches(X, y), epochs=1)
+
+    modes = {'default': {'perf_mode': False, 'bf16': False}, 'perf': {'perf_mode': True, 'bf16': False}}
+    if bf16_supported():
+        modes['perf + bf16'] = {'perf_mode': True, 'bf16': True}
+
+    results = []
+    for name, mode in modes.items():
+        # train both models from the same initial weights and batches in every mode
+        torch.manual_seed(0)
+        model = MultiOutputNN(X.shape[1])
+        batches = TensorBatches(X, y, generator=torch.Generator().manual_seed(0))
+        fit_time, model = time_call(train_dl_model, model, batches, epochs=num_epochs, repeats=1, **mode)
+        model.eval()
+        with torch.no_grad():
+            final_loss = criterion(model(X), y).item()
+        results.append({'model': 'MultiOutputNN', 'mode': name, 'epochs_per_s': num_epochs / fit_time, 'final_loss': final_loss})
+
+        torch.manual_seed(0)
+        model = LSTMModel(X.shape[1], 64, 2, 1, 4)
+        model, history = fit_model(model, windows, y[:, :1], num_epochs=num_epochs, val_fraction=0, patience=num_epochs, verbose=False,
+                                   **mode)
+        results.append({'model': 'LSTMModel', 'mode': name, 'epochs_per_s': len(history) / sum(1 / h['epochs_per_s'] for h in history),
+                        'final_loss': history[-1]['train_loss']})
+
+    results = pd.DataFrame(results)
+    print(results.to_string(index=False))
+
+    return results
+
+def benchmark_range_queries(cleaned_df, num_years=10, queries=((2022, 1, 2022, 12), (2025, 6, 2026, 5), (2031, 3, 2031, 3))):
+    '''
+    Compares reading a range of months from the dataset indexed by year and month against scanning the full output CSV and filtering
+    it the way the back-end does
+
+    Inputs:
+        - cleaned_df (pd.Dataframe) - The cleaned dataframe
+        - num_years (int) - The number of copies of the last survey year to append as forecast years
+        - queries (tuple) - The (start year, start month, end year, end month) of each query
+
+    Returns:
+        - results (pd.Dataframe) - The time of each query with both layouts
+    '''
+    years, species = get_output_years(cleaned_df, num_years)
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        csv_path = os.path.join(tmp, 'animal_migration.csv')
+        export_dir = os.path.join(tmp, 'animal_migration')
+        with ForecastWriter(MultiSink([CSVSink(csv_path), IndexedPartitionSink(export_dir)]), species) as writer:
+            for year in years:
+                writer.write(year)
+        print(f'CSV: {os.path.getsize(csv_path) / 1e6:.2f} MB, indexed: '
+              f'{sum(os.path.getsize(os.path.join(export_dir, f)) for f in os.listdir(export_dir)) / 1e6:.2f} MB')
+
+        def scan_csv(start_year, start_month, end_year, end_month):
+            df = pd.read_csv(csv_path, index_col=0)
+            month = df['COUNT'] * 12 + df['MONTH']
+            return df[(month >= start_year * 12 + start_month) & (month <= end_year * 12 + end_month)]
+
+        for query in queries:
+            scan_time, _ = time_call(scan_csv, *query, repeats=3)
+            indexed_time, indexed = time_call(read_partitions, export_dir, *query, repeats=3)
+
+            results.append({'query': '{}-{:02d} to {}-{:02d}'.format(*query), 'rows': len(indexed), 'csv_scan_s': scan_time,
+                            'indexed_s': indexed_time, 'speedup': scan_time / indexed_time})
+
+    results = pd.DataFrame(results)
+    print(results.to_string(index=False))
+
+    return results
+
+def benchmark_binary_export(cleaned_df, num_years=10):
+    '''
+    Compares the size and load time of the packed binary export against the output CSV
+
+    Inputs:
+        - cleaned_df (pd.Dataframe) - The cleaned dataframe
+        - num_years (int) - The number of copies of the last survey year to append as forecast years
+
+    Returns:
+        - results (pd.Dataframe) - The size and load time of each format
+    '''
+    years, species = get_output_years(cleaned_df, num_years)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        csv_path = os.path.join(tmp, 'animal_migration.csv')
+        binary_path = os.path.join(tmp, 'animal_migration.bin')
+        with ForecastWriter(MultiSink([CSVSink(csv_path), BinarySink(binary_path, species)]), species) as writer:
+            for year in years:
+                writer.write(year)
+
+        # include a pass over a column in both loads so the memory map is actually read
+        def load_csv():
+            df = pd.read_csv(csv_path, index_col=0)
+            return df, df['LATITUDE'].sum()
+
+        def load_binary():
+            records, header = read_binary(binary_path)
+            return records, header, records['latitude'].sum()
+
+        csv_time, _ = time_call(load_csv)
+        binary_time, (records, _, _) = time_call(load_binary)
+
+        results = pd.DataFrame([
+            {'format': 'csv', 'bytes': os.path.getsize(csv_path), 'load_s': csv_time},
+            {'format': 'binary', 'bytes': os.path.getsize(binary_path), 'load_s': binary_time},
+        ])
+        del records
+
+    results['size_ratio'] = results['bytes'].iloc[0] / results['bytes']
+    results['speedup'] = results['load_s'].iloc[0] / results['load_s']
+    print(results.to_string(index=False))
+
+    return results
+
+def benchmark_grid_summary(cleaned_df, num_years=10, cell_sizes=GRID_CELL_SIZES):
+    '''
+    Builds the grid summary of the output while streaming it and compares the number of records of each zoom level against the raw
+    sightings
+
+    Inputs:
+        - cleaned_df (pd.Dataframe) - The cleaned dataframe
+        - num_years (int) - The number of copies of the last survey year to append as forecast years
+        - cell_sizes (tuple) - The cell size in degrees of each zoom level
+
+    Returns:
+        - results (pd.Dataframe) - The number of records of each zoom level
+    '''
+    years, species = get_output_years(cleaned_df, num_years)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        grid_path = os.path.join(tmp, 'animal_migration_grid.parquet')
+        writer = ForecastWriter(GridSummarySink(grid_path, cell_sizes), species)
+
+        def stream():
+            for year in years:
+                writer.write(year)
+            writer.close()
+            return pd.read_parquet(grid_path)
+
+        stream_time, grid = time_call(stream, repeats=1)
+
+    output = pd.concat([writer.to_output(year) for year in years], ignore_index=True)
+    placed = output.dropna(subset=['LATITUDE', 'LONGITUDE', 'MONTH'])
+    results = []
+    for cell_size, level in grid.groupby('CELL_SIZE'):
+        results.append({'cell_size': round(float(cell_size), 4), 'records': len(level), 'sightings': len(placed),
+                        'reduction': len(placed) / len(level)})
+
+    results = pd.DataFrame(results)
+    print(f'Streamed the grid summary in {stream_time:.3f}s')
+    print(results.to_string(index=False))
+
+    return results
+
+def benchmark_spatial_index(cleaned_df, num_rows=1_200_000, seed=0):
+    '''
+    Compares bounding box, radius, polygon and nearest neighbour queries with SightingIndex against scanning every row with a pandas
+    boolean mask
+
+    Inputs:
+        - cleaned_df (pd.Dataframe) - The cleaned dataframe
+        - num_rows (int) - The number of sightings to query, drawn from the survey with their positions moved slightly
+        - seed (int) - The seed of the random sightings
+
+    Returns:
+        - results (pd.Dataframe) - The time of each query with both methods
+    '''
+    # draw sightings from the survey and spread them over the survey and forecast years
+    rng = np.random.default_rng(seed)
+    sample = cleaned_df.iloc[rng.integers(0, len(cleaned_df), num_rows)]
+    df = pd.DataFrame({'COUNT': rng.integers(1990, 2031, num_rows), 'MONTH': sample['MONTH'].to_numpy(),
+                       'LATITUDE': sample['LATITUDE'].to_numpy() + rng.normal(0, 0.01, num_rows),
+                       'LONGITUDE': sample['LONGITUDE'].to_numpy() + rng.normal(0, 0.01, num_rows), 'SPECIES': get_species(sample)})
+
+    build_time, index = time_call(SightingIndex, df, repeats=1)
+    print(f'Built the index over {num_rows} sightings in {build_time:.2f}s')
+
+    lat, lon = df['LATITUDE'].median(), df['LONGITUDE'].median()
+    species = [df['SPECIES'].iloc[0]]
+    start, end = (2010, 7), (2014, 8)
+    polygon = [(lat - 0.1, lon - 0.1), (lat + 0.05, lon - 0.05), (lat + 0.1, lon + 0.1), (lat - 0.05, lon + 0.08)]
+
+    def in_query():
+        months = df['COUNT'] * 12 + df['MONTH']
+        return df['SPECIES'].isin(species) & (months >= start[0] * 12 + start[1]) & (months <= end[0] * 12 + end[1])
+
+    def scan_bbox():
+        return df.index[in_query() & df['LATITUDE'].between(lat - 0.05, lat + 0.05) & df['LONGITUDE'].between(lon - 0.05, lon + 0.05)]
+
+    def scan_distances():
+        points = index.project(df['LATITUDE'].to_numpy(), df['LONGITUDE'].to_numpy())
+        return np.sqrt(((points - index.project(lat, lon)) ** 2).sum(axis=1))
+
+    def scan_radius():
+        return df.index[in_query() & (scan_distances() <= 3)]
+
+    def scan_polygon():
+        inside = points_in_polygon(df['LATITUDE'].to_numpy(), df['LONGITUDE'].to_numpy(), polygon)
+        return df.index[in_query() & inside]
+
+    def scan_nearest():
+        distances = pd.Series(scan_distances(), index=df.index)[in_query()]
+        return distances.sort_values(kind='stable').index[:10]
+
+    queries = {
+        'bbox': (scan_bbox, lambda: index.bbox(lat - 0.05, lon - 0.05, lat + 0.05, lon + 0.05, species, start, end)),
+        'radius 3 km': (scan_radius, lambda: index.radius(lat, lon, 3, species, start, end)),
+        'polygon': (scan_polygon, lambda: index.polygon(polygon, species, start, end)),
+        'nearest 10': (scan_nearest, lambda: index.nearest(lat, lon, 10, species, start, end)[0]),
+    }
+
+    results = []
+    for name, (scan, query) in queries.items():
+        scan_time, expected = time_call(scan)
+        index_time, found = time_call(query)
+        results.append({'query': name, 'rows': len(found), 'scan_s': scan_time, 'index_s': index_time, 'speedup': scan_time / index_time})
+
+    results = pd.DataFrame(results)
+    print(results.to_string(index=False))
+
+    return results
+
+def benchmark_scenarios(cleaned_df, num_rollouts=64, num_years=3, chunk_sizes=(1, 16, 64)):
+    '''
+    Compares running the scenario rollouts one at a time against running them in batches
+
+    Inputs:
+        - cleaned_df (pd.Dataframe) - The cleaned dataframe
+        - num_rollouts (int) - The number of rollouts
+        - num_years (int) - The number of years to forecast
+        - chunk_sizes (tuple) - The number of rollouts of each batch to compare
+
+    Returns:
+        - results (pd.Dataframe) - The rollouts per second of each batch size
+    '''
+    train_df = cleaned_df.fillna(cleaned_df.mean())
+    models = load_or_train_models(train_df)
+
+    results = []
+    for chunk_size in chunk_sizes:
+        run_time, _ = time_call(lambda: list(run_scenarios(train_df, models, num_rollouts=num_rollouts, num_years_to_pred=num_years,
+                                                           chunk_size=chunk_size)), repeats=1)
+        results.append({'chunk_size': chunk_size, 'time_s': run_time, 'rollouts_per_s': num_rollouts / run_time})
+
+    results = pd.DataFrame(results)
+    results['speedup'] = results['rollouts_per_s'] / results['rollouts_per_s'].iloc[0]
+    print(results.to_string(index=False))
+
+    return results
+
+def benchmark_forecast_cache(cleaned_df, num_years=8, extra_years=2):
+    '''
+    Compares forecasting every year against loading the checkpointed years and extending the horizon
+
+    Inputs:
+        - cleaned_df (pd.Dataframe) - The cleaned dataframe
+        - num_years (int) - The number of years of the first forecast
+        - extra_years (int) - The number of years the horizon is extended by
+
+    Returns:
+        - results (pd.Dataframe) - The time of each run
+    '''
+    train_df = cleaned_df.fillna(cleaned_df.mean())
+    models = load_or_train_models(train_df)
+
+    def forecast(years, cache_dir=None):
+        return pd.concat(iter_future_predictions(train_df, models, years, cache_dir=cache_dir), ignore_index=True)
+
+    with tempfile.TemporaryDirectory() as cache_dir:
+        runs = {
+            'no cache': lambda: forecast(num_years),
+            'cold cache': lambda: forecast(num_years, cache_dir),
+            'warm cache': lambda: forecast(num_years, cache_dir),
+            f'extend by {extra_years}': lambda: forecast(num_years + extra_years, cache_dir),
+            f'no cache, {num_years + extra_years} years': lambda: forecast(num_years + extra_years),
+        }
+
+        results = []
+        for name, run in runs.items():
+            run_time, _ = time_call(run, repeats=1)
+            results.append({'run': name, 'time_s': run_time})
+
+    results = pd.DataFrame(results)
+    print(results.to_string(index=False))
+
+    return results
+
+def benchmark_ingest(df, new_year=2022, history_sizes=(1, 10)):
+    '''
+    Compares appending a new survey year to the store against cleaning the whole history again
+
+    Inputs:
+        - df (pd.Dataframe) - The original dataframe
+        - new_year (int) - The survey year that is ingested into a store of the earlier years
+        - history_sizes (tuple) - The number of times the earlier years are repeated to see how each approach scales with the history
+
+    Returns:
+        - results (pd.Dataframe) - The time of the full rebuild and the ingest for each size of the history
+    '''
+    history = df[df['COUNT'] < new_year]
+    new_rows = df[df['COUNT'] == new_year]
+
+    results = []
+    for size in history_sizes:
+        big_history = pd.concat([history] * size, ignore_index=True)
+
+        # the full rebuild cleans every row again and recomputes the means
+        def rebuild():
+            cleaned = clean_df(pd.concat([big_history, new_rows], ignore_index=True))
+            return cleaned, cleaned.mean()
+        rebuild_time, _ = time_call(rebuild, repeats=1)
+
+        with tempfile.TemporaryDirectory() as store_dir:
+            create_store(big_history, store_dir)
+            ingest_time, _ = time_call(lambda: ingest_survey(new_rows, store_dir), repeats=1)
+
+        results.append({'history_rows': len(big_history), 'new_rows': len(new_rows), 'rebuild_s': rebuild_time,
+                        'ingest_s': ingest_time, 'speedup': rebuild_time / ingest_time})
+
+    results = pd.DataFrame(results)
+    print(results.to_string(index=False))
+
+    return results
+
+def benchmark_model_update(df, new_year=2022):
+    '''
+    Compares updating the models trained on the earlier survey years with a new year against training them from scratch on every
+    year, printing the time of each and the error of each model on the new rows and on every row
+
+    Inputs:
+        - df (pd.Dataframe) - The original dataframe
+        - new_year (int) - The survey year the models are updated with
+
+    Returns:
+        - results (pd.Dataframe) - The error of each model after the update and after the full retrain
+    '''
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        # a survey store of the earlier years with the new year ingested
+        survey_dir = os.path.join(tmp_dir, 'survey')
+        create_store(df[df['COUNT'] < new_year], survey_dir)
+        ingest_survey(df[df['COUNT'] == new_year], survey_dir)
+        state = read_state(survey_dir)
+        previous_df = load_store(survey_dir, 1).fillna(get_store_means(state, 1))
+        train_df = load_store(survey_dir).fillna(get_store_means(state))
+
+        # the models trained on the earlier years that are updated
+        update_dir = os.path.join(tmp_dir, 'update')
+        load_or_train_models(previous_df, store_dir=update_dir)
+
+        update_time, updated = time_call(lambda: update_models(previous_df, train_df, store_dir=update_dir), repeats=1)
+        retrain_time, retrained = time_call(lambda: load_or_train_models(train_df, store_dir=os.path.join(tmp_dir, 'retrain')), repeats=1)
+
+    new_rows = np.arange(len(previous_df), len(train_df))
+    all_rows = np.arange(len(train_df))
+    results = []
+    for name in updated:
+        results.append({'model': name,
+                        'update_new_mae': get_model_error(name, *updated[name], train_df, new_rows),
+                        'retrain_new_mae': get_model_error(name, *retrained[name], train_df, new_rows),
+                        'update_all_mae': get_model_error(name, *updated[name], train_df, all_rows),
+                        'retrain_all_mae': get_model_error(name, *retrained[name], train_df, all_rows)})
+
+    print(f'update: {update_time:.2f}s, full retrain: {retrain_time:.2f}s ({retrain_time / update_time:.1f}x faster) '
+          f'on {len(train_df) - len(previous_df)} new rows and {len(get_replay_rows(len(train_df), len(train_df) - len(previous_df)))} replayed')
+    results = pd.DataFrame(results)
+    print(results.to_string(index=False))
+
+    return results
+
+def benchmark_tuning(cleaned_df, kind='gb', min_budget=10, max_budget=270, num_splits=2, backend='hist', seed=0):
+    '''
+    Compares a successive halving search against training every configuration it starts with the full budget, printing the time
+    taken and the best validation loss found by each, and the time taken to resume the finished search from the results database
+
+    Inputs:
+        - cleaned_df (pd.Dataframe) - The cleaned dataframe
+        - kind (str) - The kind of model to tune as specified in tune()
+        - min_budget (int) - The smallest budget of a trial
+        - max_budget (int) - The largest budget of a trial
+        - num_splits (int) - The number of validation years
+        - backend (str) - The gradient boosting backend
+        - seed (int) - The seed of the search
+
+    Returns:
+        - results (pd.Dataframe) - The time and best loss of each search
+    '''
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db_path = os.path.join(tmp_dir, 'tuning.sqlite')
+
+        def search():
+            return tune(cleaned_df, kind, method='halving', min_budget=min_budget, max_budget=max_budget, num_splits=num_splits,
+                        seed=seed, backend=backend, db_path=db_path, cache_dir=tmp_dir)
+        halving_time, halving = time_call(search, repeats=1)
+        resume_time, resumed = time_call(search, repeats=1)
+
+        # the same configurations (the first bracket of the search) each trained with the full budget
+        num_configs, _ = get_brackets(min_budget, max_budget, method='halving')[0]
+        configs = sample_configs(SEARCH_SPACES[kind], num_configs, np.random.default_rng([seed, 0]))
+        folds = [get_cv_fold(cleaned_df, [], year, cache_dir=tmp_dir) for year in get_cv_years(cleaned_df, num_splits, seed)]
+        def full_search():
+            return [np.mean([run_trial(kind, config, max_budget, fold, ['NUMBER'], backend, seed + trial)['loss'] for fold in folds])
+                    for trial, config in enumerate(configs)]
+        full_time, full_losses = time_call(full_search, repeats=1)
+
+    results = pd.DataFrame([
+        {'search': f'every config at {max_budget}', 'configs': num_configs, 'time_s': full_time, 'best_loss': min(full_losses)},
+        {'search': 'successive halving', 'configs': num_configs, 'time_s': halving_time,
+         'best_loss': halving.loc[halving['budget'] == max_budget, 'loss'].min()},
+        {'search': 'resumed', 'configs': num_configs, 'time_s': resume_time, 'best_loss': resumed.loc[resumed['budget'] == max_budget, 'loss'].min()}
+    ])
+    print(results.to_string(index=False))
+
+    return results
+
+def main():
+    print('Reading in dataframe')
+    df = pd.read_excel(DATA_PATH) # read in the dataframe from the workbook since the cleaning reference expects the raw values
+    print('Successfuly loaded dataframe')
+
+    print('-' * 50)
+    benchmark_load()
+
+    print('-' * 50)
+    benchmark_clean_df(df)
+
+    # repeat the survey to see how the cleaning scales with the size of the export
+    big_df = pd.concat([df] * 10, ignore_index=True)
+    benchmark_clean_df(big_df, repeats=2)
+
+    print('-' * 50)
+    benchmark_ingest(df)
+
+    print('-' * 50)
+    benchmark_model_update(df)
+
+    cleaned_df = load_clean_survey()
+
+    print('-' * 50)
+    benchmark_gb_backends(cleaned_df)
+
+    print('-' * 50)
+    benchmark_coord_models(cleaned_df)
+
+    print('-' * 50)
+    benchmark_lstm_inference(cleaned_df.shape[1] - 4)
+
+    print('-' * 50)
+    benchmark_batching(cleaned_df)
+
+    print('-' * 50)
+    benchmark_ensemble(cleaned_df)
+
+    print('-' * 50)
+    benchmark_perf_mode(cleaned_df)
+
+    print('-' * 50)
+    benchmark_range_queries(cleaned_df)
+
+    print('-' * 50)
+    benchmark_binary_export(cleaned_df)
+
+    print('-' * 50)
+    benchmark_grid_summary(cleaned_df)
+
+    print('-' * 50)
+    benchmark_spatial_index(cleaned_df)
+
+    print('-' * 50)
+    benchmark_scenarios(cleaned_df)
+
+    print('-' * 50)
+    benchmark_forecast_cache(cleaned_df)
+
+    print('-' * 50)
+    benchmark_tuning(cleaned_df)
+
+if __name__ == '__main__':
+    main()
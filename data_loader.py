@@ -0,0 +1,233 @@
+import hashlib
+import inspect
+import json
+import os
+from datetime import datetime, time
+import numpy as np
+import pandas as pd
+import pyarrow.feather as feather
+import non_dl as ndl
+
+# the GNP aerial-count workbook read by every entry point
+DATA_PATH = './data/GNP_Aerial_counting_1969_2022.xlsx'
+
+# the directory the columnar caches are written to
+CACHE_DIR = './data/cache'
+
+def file_hash(path, cache_dir=CACHE_DIR):
+    '''
+    Returns the SHA-256 hash of a file. The hash is stored with the file's size and modification time so it is only recomputed
+    when the file changes on disk.
+
+    Inputs:
+        - path (str) - The path of the file to hash
+        - cache_dir (str) - The directory holding the hash manifest
+
+    Returns:
+        - sha256 (str) - The hex digest of the file contents
+    '''
+    manifest_path = os.path.join(cache_dir, 'manifest.json')
+    manifest = {}
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+
+    # reuse the stored hash if the file hasn't changed since it was hashed
+    key = os.path.abspath(path)
+    stat = os.stat(path)
+    entry = manifest.get(key)
+    if entry is not None and entry['mtime_ns'] == stat.st_mtime_ns and entry['size'] == stat.st_size:
+        return entry['sha256']
+
+    # hash the file in 1MB blocks
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha256.update(block)
+
+    manifest[key] = {'mtime_ns': stat.st_mtime_ns, 'size': stat.st_size, 'sha256': sha256.hexdigest()}
+    write_json(manifest_path, manifest)
+
+    return manifest[key]['sha256']
+
+def source_hash(func):
+    '''
+    Returns the SHA-256 hash of the source of the module a function is defined in, so a cache built with the function is rebuilt
+    when the function or any of the helpers it calls from its module change
+
+    Inputs:
+        - func (function) - The function
+
+    Returns:
+        - sha256 (str) - The hex digest of the source
+    '''
+    return hashlib.sha256(inspect.getsource(inspect.getmodule(func)).encode()).hexdigest()
+
+def write_json(path, obj):
+    '''
+    Writes an object as JSON by writing a temporary file and renaming it so readers never see a partially written file
+    '''
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(obj, f, indent=2)
+    os.replace(tmp_path, path)
+
+def get_value_kind(val):
+    '''
+    Returns the kind of a single non-Nan value of an object column
+    '''
+    if isinstance(val, str):
+        return 'str'
+    elif isinstance(val, datetime):
+        return 'datetime'
+    elif isinstance(val, time):
+        return 'time'
+    return 'number'
+
+def encode_object_columns(df):
+    '''
+    Converts the object columns read from the workbook into typed columns that can be stored in Arrow. Columns with a single kind of
+    value get a proper dtype (time of day becomes a timedelta) and columns that mix kinds, such as DATE, are split into one typed column
+    per kind so the original values can be put back together when the cache is read.
+
+    Inputs:
+        - df (pd.Dataframe) - The dataframe read from the workbook
+
+    Returns:
+        - encoded (pd.Dataframe) - The dataframe with only Arrow compatible columns
+        - mixed (dict) - The kinds each mixed column was split into
+    '''
+    encoded = {}
+    mixed = {}
+
+    for col in df.columns:
+        values = df[col]
+        if values.dtype != object:
+            encoded[col] = values
+            continue
+
+        # find the kind of each value from the unique values of the column
+        codes, uniques = pd.factorize(values)
+        unique_kinds = np.array([get_value_kind(val) for val in uniques] + ['missing'])
+        kinds = pd.Series(unique_kinds[codes], index=df.index)
+        column_kinds = sorted(set(unique_kinds[:-1]))
+
+        for kind in column_kinds:
+            part = values.where(kinds == kind)
+            if kind == 'datetime':
+                part = pd.to_datetime(part)
+            elif kind == 'time':
+                part = pd.to_timedelta(part.astype(str), errors='coerce')
+            elif kind == 'number':
+                part = pd.to_numeric(part)
+
+            # columns with one kind of value keep their name
+            name = col if len(column_kinds) <= 1 else f'{col}__{kind}'
+            encoded[name] = part
+
+        if len(column_kinds) == 0:
+            encoded[col] = values.astype(float)
+        elif len(column_kinds) > 1:
+            mixed[col] = column_kinds
+
+    return pd.DataFrame(encoded, index=df.index), mixed
+
+def decode_object_columns(df, mixed):
+    '''
+    Puts the mixed columns split by encode_object_columns back together as object columns in their original position
+
+    Inputs:
+        - df (pd.Dataframe) - The dataframe read from the cache
+        - mixed (dict) - The kinds each mixed column was split into
+
+    Returns:
+        - df (pd.Dataframe) - The dataframe with the mixed columns restored
+    '''
+    for col, column_kinds in mixed.items():
+        names = [f'{col}__{kind}' for kind in column_kinds]
+        values = np.full(len(df), np.nan, dtype=object)
+
+        # fill in the values of each kind where that kind was present
+        for name in names:
+            present = df[name].notna().to_numpy()
+            values[present] = df[name].to_numpy(dtype=object)[present]
+
+        position = df.columns.get_loc(names[0])
+        df = df.drop(columns=names)
+        df.insert(position, col, values)
+
+    return df
+
+def read_cache(path):
+    '''
+    Reads a Feather cache file into a dataframe. The file is memory-mapped so Arrow reads it without a separate buffer, but
+    to_pandas() still copies every column into the dataframe.
+    '''
+    return feather.read_table(path, memory_map=True).to_pandas()
+
+def write_cache(path, df):
+    '''
+    Writes a dataframe as an uncompressed Feather file (so it can be memory-mapped) by writing a temporary file and renaming it
+    '''
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    feather.write_feather(df.reset_index(drop=True), tmp_path, compression='uncompressed')
+    os.replace(tmp_path, path)
+
+def load_survey(path=DATA_PATH, cache_dir=CACHE_DIR):
+    '''
+    Loads the aerial-count workbook from a columnar cache keyed by the hash of the workbook, converting the workbook into the cache the
+    first time it is read. The TIME column is returned as a timedelta since midnight instead of time objects, which clean_df and
+    preprocess convert with datetime accessors.
+
+    Inputs:
+        - path (str) - The path of the workbook
+        - cache_dir (str) - The directory the cache is written to
+
+    Returns:
+        - df (pd.Dataframe) - The raw dataframe
+    '''
+    key = file_hash(path, cache_dir)[:16]
+    stem = os.path.splitext(os.path.basename(path))[0]
+    cache_path = os.path.join(cache_dir, f'{stem}-{key}.raw.feather')
+    meta_path = os.path.join(cache_dir, f'{stem}-{key}.raw.json')
+
+    # convert the workbook the first time it is read
+    if not os.path.exists(cache_path) or not os.path.exists(meta_path):
+        encoded, mixed = encode_object_columns(pd.read_excel(path))
+        write_cache(cache_path, encoded)
+        write_json(meta_path, {'source': os.path.abspath(path), 'mixed': mixed})
+
+    with open(meta_path) as f:
+        meta = json.load(f)
+
+    return decode_object_columns(read_cache(cache_path), meta['mixed'])
+
+def load_clean_survey(path=DATA_PATH, clean=None, cache_dir=CACHE_DIR):
+    '''
+    Loads the cleaned aerial-count dataframe from a columnar cache keyed by the hash of the workbook and the hash of the source of the
+    cleaning function (see source_hash()), so repeated runs skip both reading the workbook and cleaning it and a change to the
+    cleaning rebuilds the cache
+
+    Inputs:
+        - path (str) - The path of the workbook
+        - clean (function) - The function used to clean the raw dataframe, clean_df if not given
+        - cache_dir (str) - The directory the cache is written to
+
+    Returns:
+        - df (pd.Dataframe) - The cleaned dataframe
+    '''
+    if clean is None:
+        clean = ndl.clean_df
+
+    key = file_hash(path, cache_dir)[:16]
+    stem = os.path.splitext(os.path.basename(path))[0]
+    clean_key = source_hash(clean)[:16]
+    cache_path = os.path.join(cache_dir, f'{stem}-{key}.{clean.__module__}.{clean.__name__}.{clean_key}.feather')
+
+    # clean the raw dataframe the first time it is read
+    if not os.path.exists(cache_path):
+        write_cache(cache_path, clean(load_survey(path, cache_dir)))
+
+    return read_cache(cache_path)
@@ -0,0 +1,132 @@
+import numpy as np
+import pandas as pd
+
+# the lag feature columns in the order they are stored in the per-species lag state
+LAG_COLUMNS = ['lat_lag1', 'lon_lag1', 'count_lag1', 'lat_lag2', 'lon_lag2', 'count_lag2']
+
+# the columns the models predict
+TARGET_COLUMNS = ['NUMBER', 'LATITUDE', 'LONGITUDE']
+
+# the columns that are not used as inputs to the models
+NON_FEATURE_COLUMNS = ['ID', 'LATITUDE', 'LONGITUDE', 'NUMBER']
+
+class FeatureSchema:
+    '''
+    FeatureSchema is the fixed column layout of a dataframe produced by clean_df. It is built once and then used to move rows
+    between the dataframe and a contiguous NumPy matrix whose first n_features columns are the model inputs (in the same order
+    the scalers were fit on) followed by the ID and target columns. Because the inputs are contiguous, the models can be given a
+    view of the matrix instead of a new dataframe, and the lag and target columns can be read and written in place by index.
+    '''
+    def __init__(self, columns, dtypes, dtype=np.float64):
+        self.columns = list(columns)
+        self.dtypes = {col: str(dtypes[col]) for col in self.columns}
+        self.dtype = np.dtype(dtype)
+
+        # the model inputs keep the order of the cleaned dataframe so they line up with the fitted scalers
+        self.feature_columns = [col for col in self.columns if col not in NON_FEATURE_COLUMNS]
+        self.matrix_columns = self.feature_columns + NON_FEATURE_COLUMNS
+        self.n_features = len(self.feature_columns)
+
+        # precompute the indices of the columns the forecast reads and writes
+        self.col_idx = {col: i for i, col in enumerate(self.matrix_columns)}
+        self.lag_idx = np.array([self.col_idx[col] for col in LAG_COLUMNS])
+        self.target_idx = np.array([self.col_idx[col] for col in TARGET_COLUMNS])
+        self.lag_source_idx = np.array([self.col_idx[col] for col in ['LATITUDE', 'LONGITUDE', 'NUMBER']])
+        self.id_idx = self.col_idx['ID']
+        self.count_idx = self.col_idx['COUNT']
+
+        # the one-hot encoded species columns are contiguous after get_dummies
+        self.species_columns = [col for col in self.feature_columns if col.startswith('SPECIES_')]
+        self.species_names = np.array([col.replace('SPECIES_', '') for col in self.species_columns])
+        self.species_idx = np.array([self.col_idx[col] for col in self.species_columns])
+
+    @classmethod
+    def from_df(cls, df, dtype=np.float64):
+        '''
+        Builds the schema from the output of clean_df
+
+        Inputs:
+            - df (pd.Dataframe) - The cleaned dataframe
+            - dtype (np.dtype) - The dtype of the matrices built by the schema
+
+        Returns:
+            - schema (FeatureSchema) - The schema for the dataframe
+        '''
+        return cls(df.columns, df.dtypes, dtype=dtype)
+
+    def to_dict(self):
+        '''
+        Returns a JSON serializable description of the schema
+        '''
+        return {'columns': self.columns, 'dtypes': self.dtypes, 'dtype': self.dtype.name}
+
+    @classmethod
+    def from_dict(cls, d):
+        '''
+        Rebuilds a schema from the output of to_dict
+        '''
+        return cls(d['columns'], d['dtypes'], dtype=d['dtype'])
+
+    def check_scaler(self, scaler):
+        '''
+        Ensures a fitted StandardScaler was fit on the feature columns of this schema in the same order
+
+        Inputs:
+            - scaler (StandardScaler) - The fitted scaler to check
+        '''
+        names = getattr(scaler, 'feature_names_in_', None)
+        if scaler.n_features_in_ != self.n_features or (names is not None and list(names) != self.feature_columns):
+            raise ValueError('The scaler was not fit on the feature columns of this schema')
+
+    def to_matrix(self, df):
+        '''
+        Converts a dataframe with this schema to a contiguous matrix in the matrix column order
+
+        Inputs:
+            - df (pd.Dataframe) - The dataframe to convert
+
+        Returns:
+            - matrix (np.Array) - A C-contiguous matrix of shape (len(df), len(matrix_columns))
+        '''
+        return np.ascontiguousarray(df[self.matrix_columns].to_numpy(dtype=self.dtype))
+
+    def features(self, matrix):
+        '''
+        Returns a view of the model input columns of a matrix built by to_matrix
+        '''
+        return matrix[:, :self.n_features]
+
+    def get_species(self, matrix):
+        '''
+        Returns the index into species_names of the one-hot encoded species of each row of a matrix
+        '''
+        return np.argmax(matrix[:, self.species_idx], axis=1)
+
+    def scale(self, features, scaler, out=None):
+        '''
+        Scales the model inputs with a fitted StandardScaler without building a dataframe
+
+        Inputs:
+            - features (np.Array) - The model inputs, usually the output of features()
+            - scaler (StandardScaler) - The fitted scaler
+            - out (np.Array) - An optional preallocated array of the same shape to write the scaled values into
+
+        Returns:
+            - out (np.Array) - The scaled model inputs
+        '''
+        out = np.subtract(features, scaler.mean_, out=out)
+        return np.divide(out, scaler.scale_, out=out)
+
+    def to_df(self, matrix, index=None):
+        '''
+        Converts a matrix built by to_matrix back to a dataframe with the original column order and dtypes
+
+        Inputs:
+            - matrix (np.Array) - The matrix to convert
+            - index (pd.Index) - The optional index of the returned dataframe
+
+        Returns:
+            - df (pd.Dataframe) - The dataframe with this schema
+        '''
+        df = pd.DataFrame(matrix, columns=self.matrix_columns, index=index)
+        return df[self.columns].astype(self.dtypes)
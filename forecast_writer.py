@@ -0,0 +1,357 @@
+import io
+import json
+import os
+import struct
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+# the columns written for the front-end
+OUTPUT_COLUMNS = ['ID', 'COUNT', 'MONTH', 'DATE', 'TIME', 'NUMBER', 'LATITUDE', 'LONGITUDE', 'SPECIES']
+
+# the fixed width record of the binary export, packed without padding, and the output column each field is taken from
+RECORD_DTYPE = np.dtype([('id', '<u4'), ('year', '<i2'), ('month', 'u1'), ('day', 'u1'), ('seconds', '<u4'), ('latitude', '<f4'),
+                         ('longitude', '<f4'), ('count', '<u4'), ('species', 'u1')])
+RECORD_COLUMNS = {'id': 'ID', 'year': 'COUNT', 'month': 'MONTH', 'day': 'DATE', 'seconds': 'TIME', 'latitude': 'LATITUDE',
+                  'longitude': 'LONGITUDE', 'count': 'NUMBER', 'species': 'SPECIES'}
+
+# the value stored for a missing value in the integer fields (missing coordinates are stored as NaN)
+RECORD_MISSING = {'id': 2**32 - 1, 'year': -1, 'month': 0, 'day': 0, 'seconds': 2**32 - 1, 'count': 2**32 - 1, 'species': 255}
+
+# the binary export starts with the magic bytes, the format version, the length of the JSON header and the number of records
+BINARY_MAGIC = b'AMRC'
+BINARY_VERSION = 1
+BINARY_PREFIX = struct.Struct('<4sIIQ')
+
+class CSVSink:
+    '''
+    CSVSink appends each chunk to one CSV file, writing the header with the first chunk
+    '''
+    def __init__(self, path, index=True):
+        self.path = path
+        self.index = index
+        self.file = open(path, 'w', newline='')
+        self.header = True
+
+    def write(self, chunk):
+        chunk.to_csv(self.file, header=self.header, index=self.index)
+        self.header = False
+
+    def close(self):
+        self.file.close()
+
+class ParquetSink:
+    '''
+    ParquetSink writes each chunk as one or more row groups of a single Parquet file
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.writer = None
+
+    def write(self, chunk):
+        table = pa.Table.from_pandas(chunk, preserve_index=False)
+        if self.writer is None:
+            self.writer = pq.ParquetWriter(self.path, table.schema)
+        self.writer.write_table(table.cast(self.writer.schema))
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+class PartitionedSink:
+    '''
+    PartitionedSink writes the rows of each value of a partition column (the survey year by default) to their own directory, adding
+    one file per chunk that contains rows of that value
+    '''
+    def __init__(self, directory, partition_col='COUNT', file_format='csv'):
+        self.directory = directory
+        self.partition_col = partition_col
+        self.file_format = file_format
+        self.num_parts = {}
+        os.makedirs(directory, exist_ok=True)
+
+    def write(self, chunk):
+        for value, part in chunk.groupby(self.partition_col, sort=False):
+            part_dir = os.path.join(self.directory, f'{self.partition_col}={value}')
+            os.makedirs(part_dir, exist_ok=True)
+
+            num = self.num_parts.get(value, 0)
+            path = os.path.join(part_dir, f'part-{num:05d}.{self.file_format}')
+            if self.file_format == 'parquet':
+                part.to_parquet(path, index=False)
+            else:
+                part.to_csv(path, index=False)
+            self.num_parts[value] = num + 1
+
+    def close(self):
+        pass
+
+class IndexedPartitionSink:
+    '''
+    IndexedPartitionSink writes a dataset for range queries by year and month: one compact CSV file per year (without a header or
+    index) whose rows are grouped by month, and a manifest.json with the columns and dtypes, and the row count, byte offset and byte
+    length of every month of every year. A query for a range of months then only reads the byte ranges of the months it needs.
+    Chunks have to arrive in year order, and only the rows of the year being written are kept until the next year starts.
+    '''
+    def __init__(self, directory, year_col='COUNT', month_col='MONTH'):
+        self.directory = directory
+        self.year_col = year_col
+        self.month_col = month_col
+        self.pending = []
+        self.pending_year = None
+        self.written_years = set()
+        self.manifest = {'version': 1, 'columns': None, 'dtypes': None, 'year_col': year_col, 'month_col': month_col,
+                         'total_rows': 0, 'years': []}
+        os.makedirs(directory, exist_ok=True)
+
+    def write(self, chunk):
+        if self.manifest['columns'] is None:
+            self.manifest['columns'] = list(chunk.columns)
+            self.manifest['dtypes'] = {col: str(dtype) for col, dtype in chunk.dtypes.items()}
+
+        for year, part in chunk.groupby(self.year_col, sort=False):
+            # check every group against the years flushed so far, which includes the years flushed earlier in this chunk
+            year = int(year)
+            if year in self.written_years:
+                raise ValueError(f'The rows of {year} have already been written, chunks must be in year order')
+
+            # write the year that was being collected once a new year starts
+            if year != self.pending_year:
+                self.flush()
+                self.pending_year = year
+            self.pending.append(part)
+
+    def flush(self):
+        '''
+        Writes the file of the year being collected and adds it to the manifest
+        '''
+        if not self.pending:
+            return
+
+        rows = pd.concat(self.pending)
+        file_name = f'{self.pending_year}.csv'
+        entry = {'year': self.pending_year, 'file': file_name, 'rows': len(rows), 'bytes': 0, 'months': []}
+
+        # group the rows by month (rows without a month go last) and record where each month starts in the file
+        months = rows[self.month_col]
+        with open(os.path.join(self.directory, file_name), 'wb') as f:
+            for month in sorted(months.dropna().unique()) + ([None] if months.isna().any() else []):
+                part = rows[months.isna()] if month is None else rows[months == month]
+                data = part.to_csv(index=False, header=False).encode()
+                entry['months'].append({'month': None if month is None else int(month), 'rows': len(part), 'offset': f.tell(),
+                                        'length': len(data)})
+                f.write(data)
+            entry['bytes'] = f.tell()
+
+        self.manifest['years'].append(entry)
+        self.manifest['total_rows'] += len(rows)
+        self.written_years.add(self.pending_year)
+        self.pending = []
+        self.pending_year = None
+
+    def close(self):
+        self.flush()
+        with open(os.path.join(self.directory, 'manifest.json'), 'w') as f:
+            json.dump(self.manifest, f, indent=2)
+
+class BinarySink:
+    '''
+    BinarySink writes the rows as fixed width records (RECORD_DTYPE) after a header that holds the species dictionary (the species
+    of each label encoded SPECIES code), the record fields and the value used for missing values. The records start at a multiple of
+    8 bytes so the file can be memory-mapped by read_binary() (or any reader that understands the header) without parsing it.
+    Counts are rounded to whole animals (at least zero) and coordinates are stored as float32.
+    '''
+    def __init__(self, path, species_classes):
+        if len(species_classes) >= RECORD_MISSING['species']:
+            raise ValueError(f'At most {RECORD_MISSING["species"]} species can be stored in a uint8 species code')
+
+        self.path = path
+        self.num_records = 0
+        header = json.dumps({'species': [str(species) for species in species_classes],
+                             'fields': [[name, RECORD_DTYPE[name].str] for name in RECORD_DTYPE.names],
+                             'missing': RECORD_MISSING}).encode()
+
+        # pad the header so the records are aligned
+        self.header = header + b' ' * (-(BINARY_PREFIX.size + len(header)) % 8)
+        self.file = open(path, 'wb')
+        self.file.write(BINARY_PREFIX.pack(BINARY_MAGIC, BINARY_VERSION, len(self.header), 0))
+        self.file.write(self.header)
+
+    def write(self, chunk):
+        records = np.empty(len(chunk), dtype=RECORD_DTYPE)
+        for name, col in RECORD_COLUMNS.items():
+            values = chunk[col].to_numpy(dtype=np.float64)
+            if name in RECORD_MISSING:
+                # forecast counts can be fractional or negative so they are rounded and clipped to zero
+                values = np.maximum(np.round(values), 0) if name == 'count' else np.round(values)
+                values = np.where(np.isnan(values), RECORD_MISSING[name], values)
+            records[name] = values
+        self.file.write(records.tobytes())
+        self.num_records += len(records)
+
+    def close(self):
+        # fill in the number of records now that every chunk has been written
+        self.file.seek(0)
+        self.file.write(BINARY_PREFIX.pack(BINARY_MAGIC, BINARY_VERSION, len(self.header), self.num_records))
+        self.file.close()
+
+class MultiSink:
+    '''
+    MultiSink writes every chunk to several sinks, so one pass over the forecast produces every output
+    '''
+    def __init__(self, sinks):
+        self.sinks = sinks
+
+    def write(self, chunk):
+        for sink in self.sinks:
+            sink.write(chunk)
+
+    def close(self):
+        for sink in self.sinks:
+            sink.close()
+
+def read_partitions(directory, start_year, start_month, end_year, end_month):
+    '''
+    Reads the rows between two months (inclusive) from a dataset written by IndexedPartitionSink, reading only the byte range of the
+    matching months of each year
+
+    Inputs:
+        - directory (str) - The directory of the dataset
+        - start_year (int) - The year of the first month
+        - start_month (int) - The first month (1 - 12)
+        - end_year (int) - The year of the last month
+        - end_month (int) - The last month (1 - 12)
+
+    Returns:
+        - df (pd.Dataframe) - The matching rows ordered by year and month
+    '''
+    with open(os.path.join(directory, 'manifest.json')) as f:
+        manifest = json.load(f)
+
+    start = start_year * 12 + start_month
+    end = end_year * 12 + end_month
+    parts = []
+
+    for year in manifest['years']:
+        months = [m for m in year['months'] if m['month'] is not None and start <= year['year'] * 12 + m['month'] <= end]
+        if not months:
+            continue
+
+        # the months of a year are stored in order so the matching months are one contiguous byte range
+        offset = months[0]['offset']
+        length = months[-1]['offset'] + months[-1]['length'] - offset
+        with open(os.path.join(directory, year['file']), 'rb') as f:
+            f.seek(offset)
+            parts.append(f.read(length))
+
+    data = io.BytesIO(b''.join(parts))
+    if not parts:
+        return pd.DataFrame({col: pd.Series(dtype=dtype) for col, dtype in manifest['dtypes'].items()})
+    return pd.read_csv(data, header=None, names=manifest['columns'], dtype=manifest['dtypes'])
+
+def read_binary(path):
+    '''
+    Memory-maps the records of a file written by BinarySink without copying or parsing them
+
+    Inputs:
+        - path (str) - The path of the binary export
+
+    Returns:
+        - records (np.memmap) - The records with the fields of RECORD_DTYPE
+        - header (dict) - The header with the species of each species code, the record fields and the missing values
+    '''
+    with open(path, 'rb') as f:
+        magic, version, header_len, num_records = BINARY_PREFIX.unpack(f.read(BINARY_PREFIX.size))
+        if magic != BINARY_MAGIC or version != BINARY_VERSION:
+            raise ValueError(f'{path} is not a version {BINARY_VERSION} binary export')
+        header = json.loads(f.read(header_len))
+
+    dtype = np.dtype([(name, fmt) for name, fmt in header['fields']])
+    if num_records == 0:
+        return np.zeros(0, dtype=dtype), header
+    records = np.memmap(path, dtype=dtype, mode='r', offset=BINARY_PREFIX.size + header_len, shape=(num_records,))
+    return records, header
+
+def make_sink(path, species_classes=None):
+    '''
+    Creates the sink for an output path from its extension
+
+    Inputs:
+        - path (str) - A .csv, .parquet or .bin file, or a directory for a PartitionedSink
+        - species_classes (np.Array) - The species names of the label encoded SPECIES column, needed for a .bin file
+
+    Returns:
+        - sink (CSVSink, ParquetSink, BinarySink or PartitionedSink) - The sink
+    '''
+    extension = os.path.splitext(path)[1].lower()
+    if extension == '.csv':
+        return CSVSink(path)
+    elif extension == '.parquet':
+        return ParquetSink(path)
+    elif extension == '.bin':
+        if species_classes is None:
+            raise ValueError('species_classes is needed to write a .bin file')
+        return BinarySink(path, species_classes)
+    return PartitionedSink(path)
+
+class ForecastWriter:
+    '''
+    ForecastWriter converts chunks of cleaned (or forecast) rows to the output columns and streams them to a sink, so the output is
+    written as it is produced instead of being collected into one dataframe first. The one-hot encoded species columns are combined
+    into a single label encoded SPECIES column, the columns are cast to the dtypes they would have in the combined dataframe and the
+    rows are numbered continuously across chunks.
+    '''
+    def __init__(self, sink, species_classes, dtypes=None, columns=OUTPUT_COLUMNS):
+        self.sink = sink
+        self.species_classes = np.asarray(species_classes)
+        self.dtypes = dtypes or {}
+        self.columns = columns
+        self.num_rows = 0
+
+    def to_output(self, chunk):
+        '''
+        Converts a chunk with one-hot encoded species columns to the output columns
+
+        Inputs:
+            - chunk (pd.Dataframe) - The rows to convert
+
+        Returns:
+            - output (pd.Dataframe) - The output rows
+        '''
+        species_columns = [col for col in chunk.columns if col.startswith('SPECIES_')]
+        species = chunk[species_columns].idxmax(axis=1).str.replace('SPECIES_', '').to_numpy()
+
+        # label encode the species the same way as LabelEncoder.transform with the classes sorted
+        codes = np.searchsorted(self.species_classes, species)
+        known = codes < len(self.species_classes)
+        if not known.all() or (self.species_classes[codes[known]] != species[known]).any():
+            raise ValueError('The chunk has a species that is not in species_classes')
+
+        output = chunk.assign(SPECIES=codes)[self.columns]
+        output = output.astype({col: dtype for col, dtype in self.dtypes.items() if col in output.columns})
+        output.index = pd.RangeIndex(self.num_rows, self.num_rows + len(output))
+        return output
+
+    def write(self, chunk, chunk_size=None):
+        '''
+        Converts and writes rows to the sink, optionally split into chunks of chunk_size rows
+
+        Inputs:
+            - chunk (pd.Dataframe) - The rows to write
+            - chunk_size (int) - The maximum number of rows to convert at once, all the rows if not given
+        '''
+        chunk_size = chunk_size or max(len(chunk), 1)
+        for start in range(0, len(chunk), chunk_size):
+            output = self.to_output(chunk.iloc[start:start + chunk_size])
+            self.sink.write(output)
+            self.num_rows += len(output)
+
+    def close(self):
+        self.sink.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,239 @@
+import hashlib
+import importlib
+import io
+import json
+import os
+import pickle
+import shutil
+from datetime import datetime, timezone
+import joblib
+import numpy as np
+import pandas as pd
+import torch
+import torch.nn as nn
+
+# the directory trained models are stored in
+STORE_DIR = './models'
+
+# increase when the layout of a stored artifact changes so older artifacts are ignored
+STORE_VERSION = 1
+
+def data_fingerprint(df, extra=None):
+    '''
+    Returns a fingerprint of a training dataframe (its values, index, columns and dtypes) so a stored model can be matched to the
+    data it was trained on
+
+    Inputs:
+        - df (pd.Dataframe) - The training dataframe
+        - extra (dict) - Optional JSON serializable settings that also change the trained model (e.g. the targets or hyperparameters)
+
+    Returns:
+        - fingerprint (str) - The hex digest of the fingerprint
+    '''
+    sha256 = hashlib.sha256()
+    sha256.update(pd.util.hash_pandas_object(df, index=True).to_numpy().tobytes())
+    sha256.update(json.dumps([list(map(str, df.columns)), list(map(str, df.dtypes))]).encode())
+    if extra is not None:
+        sha256.update(json.dumps(extra, sort_keys=True).encode())
+    return sha256.hexdigest()
+
+def scaler_fingerprint(scaler):
+    '''
+    Returns a fingerprint of the statistics of a fitted StandardScaler (its mean and scale), or None if no scaler is given
+
+    Inputs:
+        - scaler (StandardScaler) - The fitted scaler
+
+    Returns:
+        - fingerprint (str) - The hex digest of the fingerprint
+    '''
+    if scaler is None:
+        return None
+
+    sha256 = hashlib.sha256()
+    for values in [scaler.mean_, scaler.scale_]:
+        sha256.update(np.ascontiguousarray(values, dtype=np.float64).tobytes())
+    return sha256.hexdigest()
+
+def serialize_model(model):
+    '''
+    Serializes a trained model to bytes. Torch models are stored as a state_dict together with the class and init_args needed to
+    rebuild them and everything else (sklearn estimators and scalers) is stored with joblib.
+
+    Inputs:
+        - model (nn.Module or sklearn estimator) - The trained model
+
+    Returns:
+        - model_format (str) - 'torch' or 'joblib'
+        - data (bytes) - The serialized model
+    '''
+    buffer = io.BytesIO()
+    if isinstance(model, nn.Module):
+        torch.save({
+            'module': type(model).__module__,
+            'class': type(model).__qualname__,
+            'init_args': model.init_args,
+            'state_dict': model.state_dict()
+        }, buffer)
+        return 'torch', buffer.getvalue()
+
+    joblib.dump(model, buffer)
+    return 'joblib', buffer.getvalue()
+
+def deserialize_model(model_format, data):
+    '''
+    Rebuilds a model serialized by serialize_model
+
+    Inputs:
+        - model_format (str) - 'torch' or 'joblib'
+        - data (bytes) - The serialized model
+
+    Returns:
+        - model (nn.Module or sklearn estimator) - The trained model
+    '''
+    if model_format == 'torch':
+        saved = torch.load(io.BytesIO(data), weights_only=True)
+        model_class = getattr(importlib.import_module(saved['module']), saved['class'])
+        model = model_class(**saved['init_args'])
+        model.load_state_dict(saved['state_dict'])
+        model.eval()
+        return model
+
+    return joblib.load(io.BytesIO(data))
+
+def model_fingerprint(models):
+    '''
+    Returns a fingerprint of the trained weights of a set of models and their scalers, so results computed with the models can be
+    matched to the exact models they came from
+
+    Inputs:
+        - models (dict) - The name of each model mapped to its [model, scaler]
+
+    Returns:
+        - fingerprint (str) - The hex digest of the fingerprint
+    '''
+    sha256 = hashlib.sha256()
+    for name in sorted(models):
+        sha256.update(name.encode())
+        for part in models[name]:
+            model_format, data = serialize_model(part)
+            sha256.update(model_format.encode())
+            # the pickle of an estimator depends on which of its objects are shared, which differs between the process that trained
+            # it and one that loaded it, so estimators are hashed by value (joblib.hash doesn't share strings) after a reload
+            if model_format == 'joblib':
+                sha256.update(joblib.hash(deserialize_model(model_format, data)).encode())
+            else:
+                sha256.update(hashlib.sha256(data).digest())
+    return sha256.hexdigest()
+
+def make_artifact(model, scaler, fingerprint, schema=None, extra=None):
+    '''
+    Bundles a trained model with its scaler, feature schema and training data fingerprint
+
+    Inputs:
+        - model (nn.Module or sklearn estimator) - The trained model
+        - scaler (StandardScaler) - The scaler the model inputs are scaled with
+        - fingerprint (str) - The fingerprint of the training data from data_fingerprint
+        - schema (FeatureSchema) - The optional schema of the model inputs
+        - extra (dict) - Optional JSON serializable information to store with the model
+
+    Returns:
+        - artifact (dict) - The model, scaler and metadata
+    '''
+    meta = {
+        'store_version': STORE_VERSION,
+        'fingerprint': fingerprint,
+        'created': datetime.now(timezone.utc).isoformat(),
+        'schema': schema.to_dict() if schema is not None else None,
+        'extra': extra or {}
+    }
+    return {'model': model, 'scaler': scaler, 'meta': meta}
+
+def dumps_artifact(artifact):
+    '''
+    Serializes an artifact built by make_artifact to bytes so it can be sent between processes
+    '''
+    model_format, model_data = serialize_model(artifact['model'])
+    _, scaler_data = serialize_model(artifact['scaler'])
+    return pickle.dumps({'meta': artifact['meta'], 'model_format': model_format, 'model': model_data, 'scaler': scaler_data})
+
+def loads_artifact(data):
+    '''
+    Rebuilds an artifact serialized by dumps_artifact
+    '''
+    saved = pickle.loads(data)
+    return {
+        'model': deserialize_model(saved['model_format'], saved['model']),
+        'scaler': deserialize_model('joblib', saved['scaler']),
+        'meta': saved['meta']
+    }
+
+def get_artifact_dir(name, fingerprint, store_dir=STORE_DIR):
+    '''
+    Returns the directory of the version of a model trained on data with the given fingerprint
+    '''
+    return os.path.join(store_dir, name, fingerprint[:16])
+
+def save_artifact(name, artifact, store_dir=STORE_DIR):
+    '''
+    Saves an artifact built by make_artifact as a new version of a model. The files are written to a temporary directory which
+    is then renamed so a partially written version is never loaded.
+
+    Inputs:
+        - name (str) - The name of the model (e.g. 'lat_model')
+        - artifact (dict) - The artifact to save
+        - store_dir (str) - The directory of the store
+
+    Returns:
+        - path (str) - The directory the version was saved to
+    '''
+    path = get_artifact_dir(name, artifact['meta']['fingerprint'], store_dir)
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    os.makedirs(tmp_path, exist_ok=True)
+
+    model_format, model_data = serialize_model(artifact['model'])
+    _, scaler_data = serialize_model(artifact['scaler'])
+    with open(os.path.join(tmp_path, f'model.{model_format}'), 'wb') as f:
+        f.write(model_data)
+    with open(os.path.join(tmp_path, 'scaler.joblib'), 'wb') as f:
+        f.write(scaler_data)
+    with open(os.path.join(tmp_path, 'meta.json'), 'w') as f:
+        json.dump({**artifact['meta'], 'name': name, 'model_format': model_format}, f, indent=2)
+
+    # replace any older copy of the same version
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.replace(tmp_path, path)
+
+    return path
+
+def load_artifact(name, fingerprint, store_dir=STORE_DIR):
+    '''
+    Loads the version of a model that was trained on data with the given fingerprint
+
+    Inputs:
+        - name (str) - The name of the model (e.g. 'lat_model')
+        - fingerprint (str) - The fingerprint of the training data from data_fingerprint
+        - store_dir (str) - The directory of the store
+
+    Returns:
+        - artifact (dict) - The model, scaler and metadata, or None if no matching version is stored
+    '''
+    path = get_artifact_dir(name, fingerprint, store_dir)
+    meta_path = os.path.join(path, 'meta.json')
+    if not os.path.exists(meta_path):
+        return None
+
+    with open(meta_path) as f:
+        meta = json.load(f)
+
+    # ignore versions written by an older store or for different data that shares the fingerprint prefix
+    if meta['store_version'] != STORE_VERSION or meta['fingerprint'] != fingerprint:
+        return None
+
+    with open(os.path.join(path, f"model.{meta['model_format']}"), 'rb') as f:
+        model = deserialize_model(meta['model_format'], f.read())
+    with open(os.path.join(path, 'scaler.joblib'), 'rb') as f:
+        scaler = deserialize_model('joblib', f.read())
+
+    return {'model': model, 'scaler': scaler, 'meta': meta}
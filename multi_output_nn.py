@@ -2,9 +2,12 @@ import pandas as pd
 from sklearn.metrics import mean_absolute_error, r2_score, mean_squared_error
 from sklearn.preprocessing import StandardScaler
 import torch
-from torch.utils.data import DataLoader, TensorDataset
+from torch.utils.data import TensorDataset
 import torch.nn as nn
-import non_dl as ndl
+from data_loader import load_clean_survey
+from batching import TensorBatches
+from training import cpu_threads, make_adam, get_autocast
+import time
 
 class MultiOutputNN(nn.Module):
     '''
@@ -14,6 +17,7 @@ class MultiOutputNN(nn.Module):
     '''
     def __init__(self, input_size, output_size=3):
         super(MultiOutputNN, self).__init__()
+        self.init_args = {'input_size': input_size, 'output_size': output_size}
         self.fc1 = nn.Linear(input_size, 64)
         self.bn1 = nn.BatchNorm1d(64)
         self.relu = nn.ReLU()
@@ -31,6 +35,117 @@ class MultiOutputNN(nn.Module):
         x = self.output(x)
         return x
 
+class EnsembleMultiOutputNN(nn.Module):
+    '''
+    EnsembleMultiOutputNN runs num_members MultiOutputNN models as one batched model. The weights of each layer are stacked with a
+    leading member dimension so every layer is a single batched matrix multiplication (baddbmm) for all the members, and the batch
+    normalization of every member is one BatchNorm1d over the members' channels side by side, which normalizes each member's channels
+    with its own statistics exactly like the separate models. Trained on TensorBatches with num_members, every member gets its own
+    shuffled batches and ensemble_mse_loss gives each member the same gradients it would get when trained on its own, so the whole
+    ensemble is trained and run in one forward/backward pass without the members losing the diversity of their batch orders.
+    '''
+    def __init__(self, input_size, output_size=3, num_members=3):
+        super(EnsembleMultiOutputNN, self).__init__()
+        self.init_args = {'input_size': input_size, 'output_size': output_size, 'num_members': num_members}
+        self.num_members = num_members
+
+        # initialize every member like a separate MultiOutputNN and stack their weights
+        members = [MultiOutputNN(input_size, output_size) for _ in range(num_members)]
+        self.weights = nn.ParameterList()
+        self.biases = nn.ParameterList()
+        for layer in ['fc1', 'fc2', 'output']:
+            self.weights.append(nn.Parameter(torch.stack([getattr(m, layer).weight.detach().T for m in members])))
+            self.biases.append(nn.Parameter(torch.stack([getattr(m, layer).bias.detach() for m in members])[:, None, :]))
+        self.bn1 = nn.BatchNorm1d(num_members * 64)
+        self.bn2 = nn.BatchNorm1d(num_members * 32)
+        self.relu = nn.ReLU()
+
+    @classmethod
+    def from_members(cls, members):
+        '''
+        Builds an ensemble from a list of MultiOutputNN models, copying their weights and batch normalization statistics
+
+        Inputs:
+            - members (list) - The MultiOutputNN models
+
+        Returns:
+            - ensemble (EnsembleMultiOutputNN) - The ensemble of the models
+        '''
+        ensemble = cls(members[0].init_args['input_size'], members[0].init_args['output_size'], len(members))
+        with torch.no_grad():
+            for i, layer in enumerate(['fc1', 'fc2', 'output']):
+                ensemble.weights[i].copy_(torch.stack([getattr(m, layer).weight.T for m in members]))
+                ensemble.biases[i].copy_(torch.stack([getattr(m, layer).bias for m in members])[:, None, :])
+            for bn in ['bn1', 'bn2']:
+                for name in ['weight', 'bias', 'running_mean', 'running_var']:
+                    getattr(getattr(ensemble, bn), name).copy_(torch.cat([getattr(getattr(m, bn), name) for m in members]))
+        return ensemble
+
+    def to_members(self):
+        '''
+        Splits the ensemble back into separate MultiOutputNN models
+
+        Returns:
+            - members (list) - The MultiOutputNN model of each member
+        '''
+        members = [MultiOutputNN(self.init_args['input_size'], self.init_args['output_size']) for _ in range(self.num_members)]
+        with torch.no_grad():
+            for m, member in enumerate(members):
+                for i, layer in enumerate(['fc1', 'fc2', 'output']):
+                    getattr(member, layer).weight.copy_(self.weights[i][m].T)
+                    getattr(member, layer).bias.copy_(self.biases[i][m, 0])
+                for bn, size in [('bn1', 64), ('bn2', 32)]:
+                    for name in ['weight', 'bias', 'running_mean', 'running_var']:
+                        getattr(getattr(member, bn), name).copy_(getattr(getattr(self, bn), name)[m * size:(m + 1) * size])
+                member.train(self.training)
+        return members
+
+    def batch_norm(self, x, bn):
+        '''
+        Normalizes the [members, samples, channels] activations with the members' channels side by side in one BatchNorm1d
+        '''
+        num_members, num_rows, num_channels = x.shape
+        x = bn(x.transpose(0, 1).reshape(num_rows, num_members * num_channels))
+        return x.reshape(num_rows, num_members, num_channels).transpose(0, 1)
+
+    def forward(self, x):
+        '''
+        Runs every member on the same inputs, or on its own inputs
+
+        Inputs:
+            - x (torch.Tensor) - The inputs with shape [samples, features], or [members, samples, features] for a batch per member
+
+        Returns:
+            - out (torch.Tensor) - The predictions of every member with shape [members, samples, outputs]
+        '''
+        if x.dim() == 2:
+            x = x.expand(self.num_members, -1, -1)
+        x = torch.baddbmm(self.biases[0], x, self.weights[0])
+        x = self.relu(self.batch_norm(x, self.bn1))
+        x = torch.baddbmm(self.biases[1], x, self.weights[1])
+        x = self.relu(self.batch_norm(x, self.bn2))
+        x = torch.baddbmm(self.biases[2], x, self.weights[2])
+        return x
+
+    def predict(self, x):
+        '''
+        Returns the average prediction of the members
+        '''
+        return self(x).mean(dim=0)
+
+def ensemble_mse_loss(predictions, targets):
+    '''
+    The sum of the mean squared error of each member of an ensemble, so each member gets the gradients it would get on its own
+
+    Inputs:
+        - predictions (torch.Tensor) - The predictions of every member with shape [members, samples, outputs]
+        - targets (torch.Tensor) - The true values with shape [samples, outputs], or [members, samples, outputs] for a batch per member
+
+    Returns:
+        - loss (torch.Tensor) - The summed loss
+    '''
+    return ((predictions - targets) ** 2).mean(dim=(1, 2)).sum()
+
 def get_predictions_dl(model, X_test_tensor, y_test_tensor):
     '''
     Generates predictions from a pretrained model on a test set and prints out the relevant metrics
@@ -65,43 +180,56 @@ def get_predictions_dl(model, X_test_tensor, y_test_tensor):
 
         return predicted
 
-def train_dl_model(model, train_loader, verbose=0):
+def train_dl_model(model, train_loader, verbose=0, epochs=100, criterion=None, perf_mode=False, bf16=False, lr=0.001):
     '''
-    This model trains a MultiOutputNN over 100 epochs
+    This model trains a MultiOutputNN (or an EnsembleMultiOutputNN) for the given number of epochs
 
     Inputs:
         - model (MultiOutputNN) - The model to train
-        - train_loader (torch.DataLoader) - The training data loader
+        - train_loader (TensorBatches) - The training batches
         - verbose (int) - A flag for whether or not to print training information
+        - epochs (int) - The number of epochs to train for
+        - criterion (function) - The loss function, the mean squared error if not given
+        - perf_mode (bool) - Whether to train with every available core and the fused Adam optimizer
+        - bf16 (bool) - Whether to run the forward pass under bfloat16 autocast, only used in perf_mode on CPUs that support it
+        - lr (float) - The learning rate, lower when fine-tuning a trained model on new data for a few epochs
     
     Returns:
         - model (MultiOutputNN) - The trained model
     '''
-    # set the loss function, optimizer and number of epochs to train
-    criterion = nn.MSELoss()
-    optimizer = torch.optim.Adam(model.parameters(), lr=0.001)
-    epochs = 100
-
-    # begin the training loop
-    for epoch in range(epochs):
-        # start model training
-        model.train()
-        running_loss = 0.0
-
-        # batch train for every batch in the loader
-        for X_batch, y_batch in train_loader:
-            optimizer.zero_grad()
-            predictions = model(X_batch)
-            loss = criterion(predictions, y_batch)
-            loss.backward()
-            optimizer.step()
-            running_loss += loss.item()
-
-        # print the loss information if specified
-        if verbose == 1:
-            print(f"Epoch {epoch+1}/{epochs}, Loss: {running_loss / len(train_loader):.4f}")
-    
-    return model
+    # use every available core in perf mode, restoring the previous number of threads when training ends
+    with cpu_threads(perf_mode):
+        # set the loss function, optimizer and number of epochs to train
+        if criterion is None:
+            criterion = nn.MSELoss()
+        optimizer = make_adam(model.parameters(), lr=lr, fused=perf_mode)
+
+        # begin the training loop
+        start = time.perf_counter()
+        for epoch in range(epochs):
+            # start model training
+            model.train()
+            running_loss = 0.0
+
+            # batch train for every batch in the loader
+            for X_batch, y_batch in train_loader:
+                optimizer.zero_grad()
+                with get_autocast(perf_mode and bf16):
+                    predictions = model(X_batch)
+                loss = criterion(predictions.float(), y_batch)
+                loss.backward()
+                optimizer.step()
+                running_loss += loss.item()
+
+            # print the loss information if specified
+            if verbose == 1:
+                print(f"Epoch {epoch+1}/{epochs}, Loss: {running_loss / len(train_loader):.4f}")
+
+        # print the training speed and final loss to compare training modes
+        if verbose == 1 and epochs > 0:
+            print(f"Trained at {epochs / (time.perf_counter() - start):.2f} epochs/s, final loss: {running_loss / len(train_loader):.4f}")
+
+        return model
 
 def get_tensors(X_train, y_train, X_test=None, y_test=None):
     '''
@@ -156,24 +284,26 @@ def get_tensor_datasets(X_train_tensor, y_train_tensor, X_test_tensor=None, y_te
     
     return train_dataset, None
 
-def get_data_loaders(train_dataset, test_dataset=None):
+def get_data_loaders(train_dataset, test_dataset=None, batch_size=32):
     '''
-    Convert training and test TensorDatasets tensors to torch DataLoaders
+    Convert training and test TensorDatasets to in-memory batch iterators which shuffle the whole tensors once per epoch and slice
+    the batches out of them instead of collating every sample like a DataLoader
 
     Inputs:
         - train_dataset (torch.TensorDatasets) - the dataset for training data
         - test_dataset (torch.TensorDatasets) - the optional dataset if not training on the full data
+        - batch_size (int) - the number of rows in each batch
     
     Returns:
-        - train_loader (torch.DataLoader) - the DataLoader for training data
-        - test_loader (torch.DataLoader) - the optional DataLoader if not training on the full data
+        - train_loader (TensorBatches) - the shuffled batches of the training data
+        - test_loader (TensorBatches) - the optional batches of the test data if not training on the full data
     '''
-    # convert the training dataset to a dataloader
-    train_loader = DataLoader(train_dataset, batch_size=32, shuffle=True)
+    # batch the training tensors
+    train_loader = TensorBatches(*train_dataset.tensors, batch_size=batch_size, shuffle=True)
 
-    # convert the test dataset to a dataloader if it exists
+    # batch the test tensors if they exist
     if test_dataset is not None:
-        test_loader = DataLoader(test_dataset, batch_size=32, shuffle=False)
+        test_loader = TensorBatches(*test_dataset.tensors, batch_size=batch_size, shuffle=False)
         return train_loader, test_loader
     
     return train_loader, None
@@ -191,27 +321,48 @@ def setup_dl_model(X_train_tensor):
     model = MultiOutputNN(input_size=X_train_tensor.shape[1])
     return model
 
-def ensemble_dl_models(models, train_loader, verbose=0):
+def setup_dl_ensemble(X_train_tensor, num_members=3):
+    '''
+    Creates an EnsembleMultiOutputNN for a give training tensor
+
+    Inputs:
+        - X_train_tensor (torch.tensor) - the tensor for training inputs
+        - num_members (int) - the number of models in the ensemble
+
+    Returns:
+        - ensemble (EnsembleMultiOutputNN) - The untrained ensemble
+    '''
+    return EnsembleMultiOutputNN(input_size=X_train_tensor.shape[1], num_members=num_members)
+
+def ensemble_dl_models(models, train_loader, verbose=0, perf_mode=False, bf16=False):
     '''
-    This function takes in a list of untrained MultiOutputNN, trains them and returns the trained models
+    This function takes in an untrained EnsembleMultiOutputNN (or a list of untrained MultiOutputNN which are stacked into one) and
+    trains every member at once in a single batched forward/backward pass, each member on its own shuffled batches
 
     Inputs:
-        - models (list) - A list of untrained MultiOutputNN models
-        - train_loader (torch.DataLoader) - the data loader for the training set
+        - models (EnsembleMultiOutputNN or list) - The untrained ensemble or a list of untrained MultiOutputNN models
+        - train_loader (TensorBatches) - the batches of the training set
         - verbose (int) - A flag for whether or not to print training information
+        - perf_mode (bool) - Whether to train with every available core and the fused Adam optimizer
+        - bf16 (bool) - Whether to train under bfloat16 autocast in perf_mode
     
     Returns:
-        - trained_models (list) - A list of trained MultiOutputNN models
+        - trained_models (EnsembleMultiOutputNN or list) - The trained ensemble, or a list of the trained models if a list was given
     '''
-    # create the output list
-    trained_models = []
-    
-    # train each model in the list and add it to the output list
-    for model in models:
-        trained_model = train_dl_model(model, train_loader, verbose=verbose)
-        trained_models.append(trained_model)
-    
-    return trained_models
+    # stack a list of models into one ensemble
+    ensemble = models if isinstance(models, EnsembleMultiOutputNN) else EnsembleMultiOutputNN.from_members(models)
+
+    # draw a permutation of the training set for every member so the members don't all see the same batches
+    if train_loader.num_members != ensemble.num_members:
+        train_loader = TensorBatches(*train_loader.tensors, batch_size=train_loader.batch_size, shuffle=train_loader.shuffle,
+                                     generator=train_loader.generator, drop_last=train_loader.drop_last, num_members=ensemble.num_members)
+
+    # train every member at once with the sum of their losses
+    ensemble = train_dl_model(ensemble, train_loader, verbose=verbose, criterion=ensemble_mse_loss, perf_mode=perf_mode, bf16=bf16)
+
+    if isinstance(models, EnsembleMultiOutputNN):
+        return ensemble
+    return ensemble.to_members()
 
 def print_metrics(df_actual, df_predicted):
     '''
@@ -260,28 +411,25 @@ def print_metrics(df_actual, df_predicted):
 
 def get_ensemble_dl_preds(trained_models, X_test_tensor, y_test_tensor):
     '''
-    This function ensembles predictions of a list of trained MultiOutputNN models by averaging the values of their predictions
+    This function ensembles predictions of trained MultiOutputNN models by averaging the values of their predictions
 
     Inputs:
-        - trained_models (list): A list of trained MultiOutputNN models
+        - trained_models (EnsembleMultiOutputNN or list): The trained ensemble or a list of trained MultiOutputNN models
         - X_test_tensor (torch.tensor): A tensor for the test inputs
         - y_test_tensor (torch.tensor): A tensor for the actual output values
     
     Returns:
         - df_predicted (pd.Dataframe): A dataframe of the predicted values
     '''
-    # A list that will hold the prediction values for each model
-    predictions = []
+    # stack a list of models into one ensemble
+    ensemble = trained_models
+    if not isinstance(ensemble, EnsembleMultiOutputNN):
+        ensemble = EnsembleMultiOutputNN.from_members(trained_models)
 
-    # generate predictions for each model on the test set and add it to the predictions list
-    for model in trained_models:
-        model.eval()
-        with torch.no_grad():
-            y_preds = model(X_test_tensor)
-            predictions.append(y_preds.detach().numpy())
-
-    # Average predictions
-    predicted = sum(predictions) / len(predictions)
+    # generate the average prediction of every model on the test set in one call
+    ensemble.eval()
+    with torch.no_grad():
+        predicted = ensemble.predict(X_test_tensor).numpy()
 
     # create a dataframe for the true values
     actual = y_test_tensor.numpy()
@@ -295,15 +443,11 @@ def get_ensemble_dl_preds(trained_models, X_test_tensor, y_test_tensor):
 
     return df_predicted
 
-def main():
+def main(num_members=3, perf_mode=False, bf16=False):
     print('Reading in dataframe')
-    df = pd.read_excel('./data/GNP_Aerial_counting_1969_2022.xlsx') # read in the dataframe
+    cleaned_df = load_clean_survey() # read in the pre-processed dataframe from the cache (built from the workbook on the first run)
     print('Successfuly loaded dataframe')
 
-    print('Cleaning dataframe')
-    cleaned_df = ndl.clean_df(df) #pre-process the data
-    print('Cleaning complete')
-
     # fill Nan values with the mean of that column
     train_df = cleaned_df.fillna(cleaned_df.mean())
     
@@ -332,14 +476,14 @@ def main():
     # create the data loaders
     train_loader, _ = get_data_loaders(train_dataset)
 
-    # create the untrained models
-    dl_models = [setup_dl_model(X_train_tensor) for _ in range(3)]
+    # create the untrained ensemble
+    dl_ensemble = setup_dl_ensemble(X_train_tensor, num_members)
 
-    # train the models
-    trained_dl_models = ensemble_dl_models(dl_models, train_loader, verbose=1)
+    # train every model of the ensemble at once
+    trained_dl_ensemble = ensemble_dl_models(dl_ensemble, train_loader, verbose=1, perf_mode=perf_mode, bf16=bf16)
 
     # print the metrics for the ensembled models
-    get_ensemble_dl_preds(trained_dl_models, X_test_tensor, y_test_tensor)
+    get_ensemble_dl_preds(trained_dl_ensemble, X_test_tensor, y_test_tensor)
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -1,10 +1,30 @@
+import copy
 import numpy as np
 import pandas as pd
 from datetime import datetime
 from sklearn.metrics import mean_absolute_error, r2_score, mean_squared_error
 from sklearn.preprocessing import StandardScaler
-from sklearn.ensemble import GradientBoostingRegressor
-import random
+from sklearn.ensemble import GradientBoostingRegressor, HistGradientBoostingRegressor, RandomForestRegressor
+import os
+import shutil
+import time
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import data_loader
+from model_store import data_fingerprint
+from training import configure_cpu_threads, get_available_cores, init_worker
+
+# the targets stored in each cross-validation fold
+CV_TARGETS = ['NUMBER', 'LATITUDE', 'LONGITUDE']
+
+# the directory cross-validation folds are cached in
+CV_CACHE_DIR = './data/cache/cv'
+
+# increase when the arrays stored in a fold change so older cached folds are ignored
+CV_FOLD_VERSION = 4
+
+# the hyperparameters of the random forest that predicts the latitude and longitude together
+COORD_MODEL_PARAMS = {'n_estimators': 50, 'max_depth': 10, 'min_samples_leaf': 2, 'random_state': 0}
 
 def process_date(val):
     '''
@@ -27,12 +47,81 @@ def process_date(val):
     else:
         return float(val) # if it's anything else we return the value as a float
     
-def clean_df(df):
+def datetime_days(col):
+    '''
+    Returns the day of the month of every datetime value of a column and Nan for every other value (strings, numbers and Nan)
+
+    Inputs:
+        - col (pd.Series) - The column to convert
+
+    Returns:
+        - days (pd.Series) - The days as floats
+    '''
+    if pd.api.types.is_datetime64_any_dtype(col):
+        return col.dt.day.astype(float)
+    if not pd.api.types.is_object_dtype(col):
+        return pd.Series(np.nan, index=col.index)
+
+    # hide the strings (the .str accessor gives Nan for anything else) and the numbers before parsing the rest as datetimes
+    is_string = col.str.len().notna()
+    is_number = pd.to_numeric(col.where(~is_string), errors='coerce').notna()
+    return pd.to_datetime(col.where(~is_string & ~is_number), errors='coerce').dt.day.astype(float)
+
+def convert_time(time_col):
+    '''
+    Converts the TIME column to seconds past midnight with vectorized string and timedelta operations instead of a per-element apply
+
+    Inputs:
+        - time_col (pd.Series) - The TIME column as read from the workbook (time objects, datetimes or timedeltas) or from the cache,
+                                 where a column that mixes kinds of values holds its times of day as timedeltas
+
+    Returns:
+        - seconds (pd.Series) - The seconds past midnight with Nan values replaced by 0
+    '''
+    if pd.api.types.is_timedelta64_dtype(time_col):
+        seconds = time_col.dt.seconds.astype(float)
+    elif pd.api.types.is_datetime64_any_dtype(time_col):
+        seconds = (time_col.dt.hour * 3600 + time_col.dt.minute * 60 + time_col.dt.second).astype(float)
+    else:
+        # every time object, string, timedelta and datetime is written as text that ends in its time of day (e.g. '10:30:00',
+        # '0 days 10:30:00' or '2002-07-15 10:30:00'), which is read back as a timedelta, while Nan values have no time of day
+        time_of_day = time_col.astype(str).str.extract(r'(\d{1,2}:\d{2}:\d{2}(?:\.\d+)?)$', expand=False)
+        seconds = pd.to_timedelta(time_of_day, errors='coerce').dt.seconds.astype(float)
+
+    # keep the column as integers when there was nothing to fill, the same as the per-element conversion
+    if seconds.notna().all():
+        return seconds.astype('int64')
+    return seconds.fillna(0)
+
+def convert_date(date_col):
+    '''
+    Converts the DATE column to the day of the month as specified in process_date() with vectorized string and datetime operations
+    instead of a per-element apply
+
+    Inputs:
+        - date_col (pd.Series) - The DATE column as read from the workbook
+
+    Returns:
+        - day (pd.Series) - The day of the month
+    '''
+    if pd.api.types.is_datetime64_any_dtype(date_col):
+        return date_col.dt.day.astype('int64' if date_col.notna().all() else float)
+    if pd.api.types.is_numeric_dtype(date_col):
+        return date_col.astype(float)
+
+    # strings such as '7/15/2002' hold the day between the slashes, numbers are the day itself and datetimes give their day
+    days = pd.to_numeric(date_col.str.split('/').str[1], errors='coerce')
+    numbers = pd.to_numeric(date_col.where(date_col.str.len().isna()), errors='coerce')
+    return days.fillna(numbers).fillna(datetime_days(date_col))
+
+def clean_df(df, species_categories=None, stratum_categories=None):
     '''
     Pre-process the original dataframe
 
     Inputs:
         - df (pd.Dataframe) - The original dataframe
+        - species_categories (list) - The optional fixed list of lowercase species to one-hot encode, all species in df if not given
+        - stratum_categories (list) - The optional fixed list of lowercase strata to one-hot encode, all strata in df if not given
     
     Returns:
         - df (pd.Dataframe) - The cleaned dataframe
@@ -54,102 +143,252 @@ def clean_df(df):
     # remove the notes column as it was found to hurt performance
     drop_cols = ['NOTES']
 
-    df.drop(columns=empty_cols, inplace=True)
-    df.drop(columns=zero_cols, inplace=True)
-    df.drop(columns=drop_cols, inplace=True)
+    df.drop(columns=empty_cols + zero_cols + drop_cols, inplace=True)
 
     # convert the time column to seconds past midnight and replace Nan values with 0 so they don't get filled in with the 
     # mean of the time column later on
-    df['TIME'] = df['TIME'].apply(lambda x: x.hour * 3600 + x.minute * 60 + x.second if pd.notna(x) else x)
-    df['TIME'] = df['TIME'].fillna(0)
+    df['TIME'] = convert_time(df['TIME'])
 
     # convert the TYPE column to binary
     df['TYPE'] = df['TYPE'].map({'Fixed-wing': 0, 'Helicopter': 1})
 
     # convert the date column as specified in process_date()
-    df['DATE'] = df['DATE'].apply(process_date)
+    df['DATE'] = convert_date(df['DATE'])
 
     # label encode the month column and ensure it is numeric
-    df['MONTH'] = df['MONTH'].map(month_mapping)
-    df['MONTH'] = pd.to_numeric(df['MONTH'], errors='coerce')
+    df['MONTH'] = pd.to_numeric(df['MONTH'].map(month_mapping), errors='coerce')
 
     # create the lag for 1 timestep and 2 timesteps behind for the latitude, longitude and number (number of animals) columns
-    df['lat_lag1'] = df.groupby('SPECIES')['LATITUDE'].shift(1)
-    df['lon_lag1'] = df.groupby('SPECIES')['LONGITUDE'].shift(1)
-    df['lat_lag2'] = df.groupby('SPECIES')['LATITUDE'].shift(2)
-    df['lon_lag2'] = df.groupby('SPECIES')['LONGITUDE'].shift(2)
-    df['count_lag1'] = df.groupby('SPECIES')['NUMBER'].shift(1)
-    df['count_lag2'] = df.groupby('SPECIES')['NUMBER'].shift(2)
+    # from a single grouping of the species column
+    grouped = df.groupby('SPECIES')[['LATITUDE', 'LONGITUDE', 'NUMBER']]
+    lag_1 = grouped.shift(1)
+    lag_2 = grouped.shift(2)
+    df['lat_lag1'] = lag_1['LATITUDE']
+    df['lon_lag1'] = lag_1['LONGITUDE']
+    df['lat_lag2'] = lag_2['LATITUDE']
+    df['lon_lag2'] = lag_2['LONGITUDE']
+    df['count_lag1'] = lag_1['NUMBER']
+    df['count_lag2'] = lag_2['NUMBER']
 
     # convert the species and stratum columns to lowercase to avoid creating duplicate columns when one-hot encoding
-    df['SPECIES'] = df['SPECIES'].str.lower()
-    df['STRATUM'] = df['STRATUM'].str.lower()
+    # and fix the categories so the same columns are created for any subset of the data
+    df['SPECIES'] = to_categories(df['SPECIES'], species_categories)
+    df['STRATUM'] = to_categories(df['STRATUM'], stratum_categories)
 
     # one-hot encode the species and stratum columns
     df = pd.get_dummies(df, columns=['SPECIES', 'STRATUM'])
 
     return df
 
-def run_cv(df, train_drop, pred_col, num_splits=5):
+def to_categories(col, categories=None):
+    '''
+    Lowercases a string column and converts it to a categorical column
+
+    Inputs:
+        - col (pd.Series) - The string column to convert
+        - categories (list) - The optional fixed list of categories, the sorted unique lowercase values of col if not given
+
+    Returns:
+        - col (pd.Categorical) - The categorical column
+    '''
+    col = col.str.lower()
+    if categories is None:
+        categories = np.sort(col.dropna().unique())
+    return pd.Categorical(col, categories=categories)
+
+def get_cv_fold(df, train_drop, cv_year, test_year=2022, cache_dir=None):
     '''
-    Perform cross validation on the GradientBoostingRegressor model
+    Splits the dataframe into the training and validation set of one cross-validation fold and scales the inputs. The scaled matrices
+    hold every target so a fold can be reused for any prediction column, and they are cached on disk if cache_dir is given so repeated
+    runs (e.g. hyperparameter sweeps) skip the pre-processing.
 
     Inputs:
         - df (pd.Dataframe) - the pre-processed dataframe to get split into training and test set
         - train_drop (list) - A list of columns to drop from the dataframe for training
-        - pred_col (str) - The prediction column to use
-        - num_splits (int) - The number of splits to use for cross-validation
+        - cv_year (int) - The year used as the validation set
+        - test_year (int) - The year held out as the true test set which is never trained on
+        - cache_dir (str) - The optional directory to cache the fold in
+
+    Returns:
+        - fold (dict) - The scaled inputs (X_train, X_test), the targets (y_train, y_test), the species of each row (groups_train,
+                        groups_test) and the position of each row in the survey ordered by year (order_train, order_test) of the fold,
+                        or the path of the directory of the cached fold to read with load_cv_fold()
     '''
-    # using 2022 as a true test set so remove it from CV
-    tested_years = [2022]
+    cache_path = None
+    if cache_dir is not None:
+        key = data_fingerprint(df, extra={'train_drop': list(train_drop), 'cv_year': int(cv_year), 'test_year': int(test_year),
+                                          'version': CV_FOLD_VERSION})
+        cache_path = os.path.join(cache_dir, f'fold-{key[:16]}')
+        if os.path.exists(cache_path):
+            return {'path': cache_path, 'year': int(cv_year)}
+
+    # split the data into training and test dataframes
+    is_train = ~df['COUNT'].isin([test_year, cv_year]).to_numpy()
+    is_test = (df['COUNT'] == cv_year).to_numpy()
+    train_df = df[is_train]
+    test_df = df[is_test]
+
+    # the position of each row in the survey ordered by year (keeping the row order within a year), so sequence models can put the
+    # validation rows back in their place in the history of each species
+    order = np.empty(len(df), dtype=np.int64)
+    order[np.argsort(df['COUNT'].to_numpy(), kind='stable')] = np.arange(len(df))
+
+    # the species of each row from its one-hot encoded columns, so sequence models can group the rows by species
+    species_columns = [col for col in df.columns if col.startswith('SPECIES_')]
+    groups_train = np.argmax(train_df[species_columns].to_numpy(), axis=1) if species_columns else np.zeros(len(train_df), dtype=int)
+    groups_test = np.argmax(test_df[species_columns].to_numpy(), axis=1) if species_columns else np.zeros(len(test_df), dtype=int)
+
+    # drop the appropriate columns from the dataframe
+    train_df = train_df.drop(columns=train_drop)
+    test_df = test_df.drop(columns=train_drop)
+
+    #fillna with mean
+    train_df = train_df.fillna(train_df.mean())
+    test_df = test_df.fillna(test_df.mean())
+
+    # scale the training and test set
+    scaler = StandardScaler()
+    fold = {
+        'X_train': scaler.fit_transform(train_df.drop(columns=['ID', 'LATITUDE', 'LONGITUDE', 'NUMBER'])),
+        'X_test': scaler.transform(test_df.drop(columns=['ID', 'LATITUDE', 'LONGITUDE', 'NUMBER'])),
+        'y_train': train_df[CV_TARGETS].to_numpy(dtype=float),
+        'y_test': test_df[CV_TARGETS].to_numpy(dtype=float),
+        'groups_train': groups_train,
+        'groups_test': groups_test,
+        'order_train': order[is_train],
+        'order_test': order[is_test],
+        'year': int(cv_year)
+    }
 
-    # start cross-validation
-    for _ in range(num_splits):
-        # remove a random year from the training set to be used as the validation set
-        cv_year = random.choice(df['COUNT'].unique())
+    if cache_path is None:
+        return fold
 
-        # ensure that year hasn't already been tested
-        while cv_year in tested_years:
-            cv_year = random.choice(df['COUNT'].unique())
-        
-        # add the year tested to the list to ensure we are not retraining on the same test set
-        tested_years.append(cv_year)
+    # write every array to its own .npy file (the arrays of an .npz archive can't be memory-mapped) in a temporary directory first
+    # so a partially written fold is never read
+    tmp_path = f'{cache_path}.{os.getpid()}.tmp'
+    os.makedirs(tmp_path, exist_ok=True)
+    for name, values in fold.items():
+        np.save(os.path.join(tmp_path, f'{name}.npy'), values)
+    try:
+        os.replace(tmp_path, cache_path)
+    except OSError:
+        # another process cached the same fold first
+        shutil.rmtree(tmp_path)
 
-        # split the data into training and test dataframes
-        train_df = df[~df['COUNT'].isin([2022, cv_year])]
-        test_df = df[df['COUNT'] == cv_year]
+    return {'path': cache_path, 'year': int(cv_year)}
 
-        # drop the appropriate columns from the dataframe
-        train_df = train_df.drop(columns=train_drop)
-        test_df = test_df.drop(columns=train_drop)
+def load_cv_fold(fold):
+    '''
+    Returns the arrays of a fold from get_cv_fold(), memory-mapping every array of a cached fold so the workers of run_cv() share
+    the pages of the files instead of each reading the whole fold into memory
 
-        #fillna with mean
-        train_df = train_df.fillna(train_df.mean())
-        test_df = test_df.fillna(test_df.mean())
+    Inputs:
+        - fold (dict) - The fold returned by get_cv_fold()
 
-        # remove the predictions columns from the inputs and assign it to the outputs
-        X_train = train_df.drop(columns=['ID', 'LATITUDE', 'LONGITUDE', 'NUMBER'])
-        y_train = train_df[pred_col]
-        X_test = test_df.drop(columns=['ID', 'LATITUDE', 'LONGITUDE', 'NUMBER'])
-        y_test = test_df[pred_col]
+    Returns:
+        - fold (dict) - The arrays of the fold
+    '''
+    if 'path' not in fold:
+        return fold
 
-        # scale the training and test set
-        scaler = StandardScaler()
-        X_train = scaler.fit_transform(X_train)
-        X_test = scaler.transform(X_test)
+    names = [file[:-len('.npy')] for file in os.listdir(fold['path']) if file.endswith('.npy')]
+    return {name: np.load(os.path.join(fold['path'], f'{name}.npy'), mmap_mode='r') for name in names}
 
-        # Multi-output regressor with hyperparameters optimized from GridSearchCV
-        model = GradientBoostingRegressor(max_depth=3, min_samples_leaf=2, min_samples_split=5, n_estimators=500)
+def run_cv_fold(fold, pred_col, backend='exact', params=None):
+    '''
+    Trains and evaluates the gradient boosting model on one cross-validation fold
 
-        # train the model
-        model.fit(X_train, y_train)
+    Inputs:
+        - fold (dict) - The fold returned by get_cv_fold()
+        - pred_col (str) - The prediction column to use
+        - backend (str) - The gradient boosting backend to use as specified in make_gb_model()
+        - params (dict) - Optional hyperparameters that replace the ones optimized from GridSearchCV
 
-        # Get predictions
-        y_pred = model.predict(X_test)
+    Returns:
+        - metrics (dict) - The year, size, fit time and metrics of the fold
+    '''
+    # memory-map the cached fold instead of reading it into memory
+    fold = load_cv_fold(fold)
+
+    target = CV_TARGETS.index(pred_col)
+    y_train = fold['y_train'][:, target]
+    y_test = fold['y_test'][:, target]
+
+    # train the model with the hyperparameters optimized from GridSearchCV
+    start = time.perf_counter()
+    model = train_gb_model(fold['X_train'], y_train, backend=backend, params=params)
+    fit_time = time.perf_counter() - start
+
+    # Get predictions
+    y_pred = model.predict(fold['X_test'])
+
+    return {
+        'year': int(fold['year']),
+        'n_train': len(y_train),
+        'n_test': len(y_test),
+        'fit_s': fit_time,
+        'mse': mean_squared_error(y_test, y_pred),
+        'mae': mean_absolute_error(y_test, y_pred),
+        'r2': r2_score(y_test, y_pred)
+    }
 
-        # print the metrics for this fold
-        print(f"year being tested for CV: {cv_year}")
-        print_metrics(y_test, pd.DataFrame(y_pred))
+def get_cv_years(df, num_splits=5, seed=0, leave_one_year_out=False, test_year=2022):
+    '''
+    Picks the validation year of each cross-validation fold
+
+    Inputs:
+        - df (pd.Dataframe) - the pre-processed dataframe
+        - num_splits (int) - The number of folds when not using leave-one-year-out
+        - seed (int) - The seed used to pick the years so the same folds are used on every run
+        - leave_one_year_out (bool) - Whether to use every survey year (except test_year) as a fold
+        - test_year (int) - The year held out as the true test set
+
+    Returns:
+        - cv_years (list) - The validation year of each fold
+    '''
+    years = np.sort(df.loc[df['COUNT'] != test_year, 'COUNT'].unique())
+    if leave_one_year_out:
+        return years.tolist()
+
+    # pick the years without replacement so no year is tested twice
+    rng = np.random.default_rng(seed)
+    return rng.choice(years, size=min(num_splits, len(years)), replace=False).tolist()
+
+def run_cv(df, train_drop, pred_col, num_splits=5, backend='exact', seed=0, leave_one_year_out=False, test_year=2022,
+           max_workers=1, cache_dir=None, params=None):
+    '''
+    Perform cross validation on the gradient boosting model where each fold holds out one survey year
+
+    Inputs:
+        - df (pd.Dataframe) - the pre-processed dataframe to get split into training and test set
+        - train_drop (list) - A list of columns to drop from the dataframe for training
+        - pred_col (str) - The prediction column to use
+        - num_splits (int) - The number of splits to use for cross-validation
+        - backend (str) - The gradient boosting backend to use as specified in make_gb_model()
+        - seed (int) - The seed used to pick the validation years
+        - leave_one_year_out (bool) - Whether to use every survey year (except test_year) as a fold instead of num_splits random years
+        - test_year (int) - The year used as a true test set which is removed from CV
+        - max_workers (int) - The number of folds to train at once in separate processes
+        - cache_dir (str) - The optional directory to cache the scaled matrices of each fold in (e.g. CV_CACHE_DIR)
+        - params (dict) - Optional hyperparameters that replace the ones optimized from GridSearchCV
+
+    Returns:
+        - results (pd.Dataframe) - One row per fold with the year tested, the fit time and the MSE, MAE and R2
+    '''
+    # build (or load) every fold before training so the workers only receive the scaled matrices
+    folds = [get_cv_fold(df, train_drop, cv_year, test_year, cache_dir) for cv_year in get_cv_years(df, num_splits, seed, leave_one_year_out, test_year)]
+
+    max_workers = max(1, min(max_workers, len(folds), get_available_cores()))
+    if max_workers == 1:
+        results = [run_cv_fold(fold, pred_col, backend, params) for fold in folds]
+    else:
+        # each worker gets an equal share of the cores so the folds don't oversubscribe them
+        context = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(max_workers=max_workers, mp_context=context, initializer=init_worker,
+                                 initargs=(max(1, get_available_cores() // max_workers),)) as executor:
+            results = list(executor.map(run_cv_fold, folds, [pred_col] * len(folds), [backend] * len(folds), [params] * len(folds)))
+
+    return pd.DataFrame(results)
 
 def print_metrics(actual, df_predicted):
     '''
@@ -177,7 +416,7 @@ def get_predictions(model, X_test, y_test=None):
     gets the predictions for the trained model
 
     Inputs:
-        - model (GradientBoostingRegressor) - The trained GradientBoostingRegressor model
+        - model (GradientBoostingRegressor or HistGradientBoostingRegressor) - The trained gradient boosting model
         - X_test (pd.Dataframe) - The dataframe to use for getting predictions
         - y_test (pd.Series) - The optional list of actual values if they exist to get metrics from
     
@@ -193,34 +432,105 @@ def get_predictions(model, X_test, y_test=None):
     
     return y_pred
 
-def train_gb_model(X_train, y_train):
+def make_gb_model(backend='exact', params=None):
     '''
-    Trains a GradientBoostingRegressor model
+    Creates an untrained gradient boosting model using the hyperparameters optimized from GridSearchCV
+
+    Inputs:
+        - backend (str) - 'exact' for the GradientBoostingRegressor that finds the exact best split of every tree on one core (kept as
+                          the reference) or 'hist' for the HistGradientBoostingRegressor that bins the inputs into histograms and
+                          builds each tree on all cores
+        - params (dict) - Optional hyperparameters that replace the ones optimized from GridSearchCV
+
+    Returns:
+        - model (GradientBoostingRegressor or HistGradientBoostingRegressor) - The untrained model
+    '''
+    if backend == 'exact':
+        model = GradientBoostingRegressor(max_depth=3, min_samples_leaf=2, min_samples_split=5, n_estimators=500)
+    elif backend == 'hist':
+        # the same number of depth 3 trees with early stopping turned off so every tree is built like the exact backend
+        model = HistGradientBoostingRegressor(max_depth=3, min_samples_leaf=2, max_iter=500, early_stopping=False)
+    else:
+        raise ValueError(f'Unknown gradient boosting backend: {backend}')
+
+    return model.set_params(**(params or {}))
+
+def train_gb_model(X_train, y_train, backend='exact', params=None):
+    '''
+    Trains a gradient boosting model
 
     Inputs:
         - X_train (pd.Dataframe) - The training inputs for the model
         - y_train (pd.Dataframe) - The training outputs for the model
+        - backend (str) - The gradient boosting backend to use as specified in make_gb_model()
+        - params (dict) - Optional hyperparameters that replace the ones optimized from GridSearchCV
     
     Returns:
-        - model (GradientBoostingRegressor) - The trained GradientBoostingRegressor model
+        - model (GradientBoostingRegressor or HistGradientBoostingRegressor) - The trained model
     '''
-    # create the GradientBoostingRegressor usijng the hyperparameters optimized from GridSearchCV
-    model = GradientBoostingRegressor(max_depth=3, min_samples_leaf=2, min_samples_split=5, n_estimators=500)
+    # create the model using the hyperparameters optimized from GridSearchCV
+    model = make_gb_model(backend, params)
 
     # train the model on the training data
     model.fit(X_train, y_train)
 
     return model
 
-def main():
+def train_coord_model(X_train, y_train):
+    '''
+    Trains a single multi-output RandomForestRegressor that predicts the latitude and longitude together, so each row only has to
+    be scaled once and run through one ensemble instead of two
+
+    Inputs:
+        - X_train (pd.Dataframe) - The training inputs for the model
+        - y_train (pd.Dataframe) - The training outputs for the model with a LATITUDE and LONGITUDE column
+
+    Returns:
+        - model (RandomForestRegressor) - The trained model whose predictions have a latitude and longitude column
+    '''
+    # every tree splits on the error of both outputs at once and the trees are built on the threads of this process (its share of
+    # the cores in a training worker) with a fixed seed. The depth is limited to keep the cost of predicting close to the two depth 3
+    # gradient boosting models it replaces
+    model = RandomForestRegressor(**COORD_MODEL_PARAMS, n_jobs=configure_cpu_threads())
+
+    # train the model on the training data
+    model.fit(X_train, y_train[['LATITUDE', 'LONGITUDE']])
+
+    return model
+
+def update_tree_model(model, X_train, y_train, num_trees=50):
+    '''
+    Updates a trained tree ensemble with new data by warm starting it: the trees already built are kept and num_trees more are
+    grown on X_train (for gradient boosting each new tree fits what the existing trees still get wrong on X_train, for the random
+    forest the new trees are averaged with the old ones)
+
+    Inputs:
+        - model (GradientBoostingRegressor, HistGradientBoostingRegressor or RandomForestRegressor) - The trained model, which isn't changed
+        - X_train (pd.Dataframe) - The training inputs of the update, scaled like the inputs the model was trained on
+        - y_train (pd.Dataframe) - The training outputs of the update
+        - num_trees (int) - The number of trees to add
+
+    Returns:
+        - model (GradientBoostingRegressor, HistGradientBoostingRegressor or RandomForestRegressor) - The updated copy of the model
+    '''
+    model = copy.deepcopy(model)
+
+    # the histogram backend counts its trees in max_iter, the others in n_estimators
+    if isinstance(model, HistGradientBoostingRegressor):
+        model.set_params(warm_start=True, max_iter=model.max_iter + num_trees)
+    else:
+        model.set_params(warm_start=True, n_estimators=model.n_estimators + num_trees)
+
+    # grow the new trees on the update data
+    model.fit(X_train, y_train)
+
+    return model.set_params(warm_start=False)
+
+def main(backend='exact'):
     print('Reading in dataframe')
-    df = pd.read_excel('./data/GNP_Aerial_counting_1969_2022.xlsx') # read in the dataframe
+    cleaned_df = data_loader.load_clean_survey() # read in the pre-processed dataframe from the cache (built from the workbook on the first run)
     print('Successfuly loaded dataframe')
 
-    print('Cleaning dataframe')
-    cleaned_df = clean_df(df) # pre-process the data
-    print('Cleaning complete')
-
     # fill Nan values with the mean of the data
     train_df = cleaned_df.fillna(cleaned_df.mean()) 
 
@@ -245,7 +555,7 @@ def main():
 
     # train the number model
     print('Start number model training')
-    model = train_gb_model(X_train, y_train)
+    model = train_gb_model(X_train, y_train, backend=backend)
 
     print('Metrics for number model')
     get_predictions(model, X_test, y_test)
@@ -257,7 +567,7 @@ def main():
 
     # train the latitude model
     print('Start latitude model training')
-    model = train_gb_model(X_train, y_train)
+    model = train_gb_model(X_train, y_train, backend=backend)
 
     print('Metrics for latitude model')
     get_predictions(model, X_test, y_test)
@@ -270,7 +580,7 @@ def main():
 
     # train the longitude model
     print('Start longitude model training')
-    model = train_gb_model(X_train, y_train)
+    model = train_gb_model(X_train, y_train, backend=backend)
 
     print('Metrics for longitude model')
     get_predictions(model, X_test, y_test)
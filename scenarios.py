@@ -0,0 +1,282 @@
+import multiprocessing
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from data_loader import load_clean_survey
+from feature_schema import FeatureSchema, TARGET_COLUMNS
+from animal_migration import start_next_year, predict_targets, prepare_forecast_models, get_forecast_state, load_or_train_models
+from sequences import append_group_tails
+from forecast_writer import CSVSink
+from training import get_available_cores, init_worker
+
+# the quantiles reported for each target of every row
+SCENARIO_QUANTILES = (0.1, 0.5, 0.9)
+
+# the most predictions read into memory at once while taking the quantiles of a year
+QUANTILE_BLOCK_SIZE = 2**24
+
+# the models and starting state of the rollouts run by this process, set by load_scenario_state()
+_scenario_state = None
+
+def get_lag_noise(df, scale):
+    '''
+    Gets the standard deviation of the noise added to each of the LAG_COLUMNS, which is a fraction of the standard deviation of the
+    column the lag is taken from
+
+    Inputs:
+        - df (pd.Dataframe) - The cleaned training data
+        - scale (float) - The fraction of the standard deviation of each column
+
+    Returns:
+        - lag_noise (np.Array) - The standard deviation of the noise of each lag column, None if scale is 0
+    '''
+    if not scale:
+        return None
+    return scale * np.tile(df[['LATITUDE', 'LONGITUDE', 'NUMBER']].std().to_numpy(), 2)
+
+def forecast_rollouts(past_years, id_offsets, members, schema, rollout_ids, history=None, lag_noise=None, seed=0):
+    '''
+    Generates the rows of the following year for a batch of rollouts at once. Every rollout starts from its own rows of the previous
+    year, so the rollouts drift apart through the noise added to their lag state and through the ensemble member each one uses.
+
+    Inputs:
+        - past_years (np.Array) - The rows of the previous year of each rollout with shape (rollouts, rows, columns), built by
+                                  schema.to_matrix
+        - id_offsets (np.Array) - How far past the last ID of the previous year the ID of each new row is, minus 1
+        - members (list) - The models of each ensemble member as used by predict_targets(), rollout i uses member i % len(members)
+        - schema (FeatureSchema) - The schema of the rows
+        - rollout_ids (np.Array) - The number of each rollout, which seeds its noise so a rollout is the same in any batch
+        - history (tuple) - The history of each species of each rollout with shapes (rollouts, species, length, features) and
+                            (rollouts, species), only used by a sequence number model
+        - lag_noise (np.Array) - The standard deviation of the noise added to each lag column, no noise if not given
+        - seed (int) - The seed of the noise
+
+    Returns:
+        - matrix (np.Array) - The rows of the new year of each rollout
+    '''
+    matrix, species_idx, lag_state = start_next_year(past_years, id_offsets, schema)
+    num_rollouts, num_rows, num_columns = matrix.shape
+    num_species = lag_state.shape[1]
+
+    if lag_noise is not None:
+        # add noise to the lags of each rollout from its own generator, leaving the zero lags of species without enough rows
+        year = int(matrix[0, 0, schema.count_idx])
+        counts = np.bincount(species_idx, minlength=num_species)
+        has_lag = np.repeat(np.stack([counts >= 1, counts >= 2], axis=1), 3, axis=1)
+        noise = np.stack([np.random.default_rng([seed, rollout, year]).standard_normal((num_species, len(lag_noise)))
+                          for rollout in rollout_ids])
+        lag_state += noise * lag_noise * has_lag
+
+    matrix[..., schema.lag_idx] = lag_state[:, species_idx]
+
+    # predict the rows of every rollout of a member in one batch
+    for member, models in enumerate(members):
+        rollouts = np.flatnonzero(rollout_ids % len(members) == member)
+        if len(rollouts) == 0:
+            continue
+
+        rows = matrix[rollouts].reshape(-1, num_columns)
+        member_history, groups = None, None
+        if history is not None:
+            # every species of every rollout has its own history
+            tails, lengths = history
+            member_history = (tails[rollouts].reshape(-1, *tails.shape[2:]), lengths[rollouts].reshape(-1))
+            groups = (np.arange(len(rollouts))[:, None] * num_species + species_idx).ravel()
+
+        predictions = predict_targets(schema.features(rows), models, schema, member_history, groups)
+        for col, pred in zip(TARGET_COLUMNS, predictions):
+            matrix[rollouts, :, schema.col_idx[col]] = pred.reshape(len(rollouts), num_rows)
+
+    return matrix
+
+def load_scenario_state(state):
+    '''
+    Prepares the models of every ensemble member and keeps them with the starting state of the forecast for the rollouts run by
+    this process
+
+    Inputs:
+        - state (dict) - The members, schema, starting state and settings of the rollouts from run_scenarios()
+    '''
+    global _scenario_state
+    members = [prepare_forecast_models(models, state['schema']) for models in state['members']]
+    _scenario_state = {**state, 'members': members}
+
+def init_scenario_worker(num_threads, state):
+    '''
+    Limits the threads of a worker process and loads the models the worker's rollouts use once, instead of with every chunk
+
+    Inputs:
+        - num_threads (int) - The number of threads each worker may use
+        - state (dict) - The members, schema, starting state and settings of the rollouts from run_scenarios()
+    '''
+    init_worker(num_threads)
+    load_scenario_state(state)
+
+def run_rollout_chunk(first, num_rollouts, out_dir):
+    '''
+    Runs a chunk of rollouts through every forecast year with the state loaded by load_scenario_state() and saves the predicted
+    targets of each year, so only one year of the chunk is held in memory
+
+    Inputs:
+        - first (int) - The number of the first rollout of the chunk
+        - num_rollouts (int) - The number of rollouts in the chunk
+        - out_dir (str) - The directory to save the predictions to
+
+    Returns:
+        - paths (dict) - The path of the .npy file with the targets (rollouts, rows, NUMBER / LATITUDE / LONGITUDE) of each year
+    '''
+    state = _scenario_state
+    schema = state['schema']
+    num_species = len(schema.species_names)
+    rollout_ids = np.arange(first, first + num_rollouts)
+
+    # every rollout starts from the same rows and history
+    past_years = np.repeat(state['past_year'][None], num_rollouts, axis=0)
+    id_offsets = state['id_offsets']
+    history = None
+    if state['history'] is not None:
+        tails, lengths = state['history']
+        history = (np.repeat(tails[None], num_rollouts, axis=0), np.repeat(lengths[None], num_rollouts, axis=0))
+
+    paths = {}
+    for year in range(state['last_year'] + 1, state['last_year'] + state['num_years'] + 1):
+        past_years = forecast_rollouts(past_years, id_offsets, state['members'], schema, rollout_ids, history, state['lag_noise'],
+                                       state['seed'])
+        id_offsets = np.arange(past_years.shape[1])
+
+        if history is not None:
+            # append the new rows to the history of every species of every rollout
+            tails, lengths = history
+            groups = (np.arange(num_rollouts)[:, None] * num_species + schema.get_species(past_years[0])).ravel()
+            tails, lengths = append_group_tails(tails.reshape(-1, *tails.shape[2:]), lengths.reshape(-1),
+                                                schema.features(past_years.reshape(-1, past_years.shape[-1])), groups)
+            history = (tails.reshape(num_rollouts, num_species, *tails.shape[1:]), lengths.reshape(num_rollouts, num_species))
+
+        paths[year] = os.path.join(out_dir, f'{year}-{first:08d}.npy')
+        np.save(paths[year], past_years[..., schema.target_idx].astype(np.float32))
+
+    return paths
+
+def get_year_quantiles(paths, quantiles=SCENARIO_QUANTILES):
+    '''
+    Takes the quantiles of the predictions of every rollout for each row of a year, reading the saved chunks a block of rows at a time
+    so the memory used doesn't grow with the number of rollouts
+
+    Inputs:
+        - paths (list) - The .npy files of the year saved by run_rollout_chunk()
+        - quantiles (tuple) - The quantiles to take
+
+    Returns:
+        - quantiles (np.Array) - The quantiles with shape (quantiles, rows, targets)
+    '''
+    chunks = [np.load(path, mmap_mode='r') for path in paths]
+    num_rollouts = sum(len(chunk) for chunk in chunks)
+    _, num_rows, num_targets = chunks[0].shape
+    block = max(1, QUANTILE_BLOCK_SIZE // (num_rollouts * num_targets))
+
+    out = np.empty((len(quantiles), num_rows, num_targets))
+    for start in range(0, num_rows, block):
+        values = np.concatenate([chunk[:, start:start + block] for chunk in chunks])
+        out[:, start:start + block] = np.quantile(values, quantiles, axis=0)
+
+    del chunks
+    return out
+
+def run_scenarios(df, models, num_rollouts=1000, num_years_to_pred=1, last_year=None, lag_noise=0.05, quantiles=SCENARIO_QUANTILES,
+                  seed=0, chunk_size=256, max_workers=1, tmp_dir=None):
+    '''
+    Forecasts many possible futures instead of one and summarizes them as quantiles for every row of each year. The rollouts are
+    run in chunks, each a batch through the forecast recursion, optionally in parallel in separate processes that load the models
+    once. The predictions of each chunk are saved to disk a year at a time and combined into quantiles one block of rows at a time,
+    so the memory used is bounded by the chunk size instead of the number of rollouts.
+
+    Inputs:
+        - df (pd.Dataframe) - The original dataframe to use for generating synthetic data
+        - models (dict or list) - The models used by the forecast, or a list of them for an ensemble of members that the rollouts take
+                                  turns using
+        - num_rollouts (int) - The number of rollouts
+        - num_years_to_pred (int) - The number of years past the last year to create synthetic data for
+        - last_year (int) - The last_year to use as a baseline, the last survey year in df if not given
+        - lag_noise (float) - The standard deviation of the noise added to the lags as a fraction of the standard deviation of the
+                              lagged column (see get_lag_noise()), 0 for no noise
+        - quantiles (tuple) - The quantiles to report
+        - seed (int) - The seed of the noise
+        - chunk_size (int) - The number of rollouts run as one batch
+        - max_workers (int) - The number of chunks to run at once in separate processes
+        - tmp_dir (str) - The directory to save the predictions of the chunks in, the system's temporary directory if not given
+
+    Returns:
+        - year_df (pd.Dataframe) - Yields the rows of each year with the quantiles of NUMBER, LATITUDE and LONGITUDE over every
+                                   rollout (e.g. NUMBER_P10)
+    '''
+    if last_year is None:
+        last_year = int(df['COUNT'].max())
+
+    schema = FeatureSchema.from_df(df)
+    members = models if isinstance(models, list) else [models]
+    window = getattr(members[0]['num_model'][0], 'window', 1)
+    past_year, id_offsets, history = get_forecast_state(df, schema, window, last_year)
+    state = {'members': members, 'schema': schema, 'past_year': past_year, 'id_offsets': id_offsets, 'history': history,
+             'last_year': last_year, 'num_years': num_years_to_pred, 'lag_noise': get_lag_noise(df, lag_noise), 'seed': seed}
+
+    starts = list(range(0, num_rollouts, chunk_size))
+    sizes = [min(chunk_size, num_rollouts - start) for start in starts]
+
+    with tempfile.TemporaryDirectory(dir=tmp_dir) as out_dir:
+        max_workers = max(1, min(max_workers, len(starts), get_available_cores()))
+        if max_workers == 1:
+            load_scenario_state(state)
+            chunk_paths = [run_rollout_chunk(start, size, out_dir) for start, size in zip(starts, sizes)]
+        else:
+            # each worker gets an equal share of the cores and loads the models once when it starts
+            context = multiprocessing.get_context('spawn')
+            with ProcessPoolExecutor(max_workers=max_workers, mp_context=context, initializer=init_scenario_worker,
+                                     initargs=(max(1, get_available_cores() // max_workers), state)) as executor:
+                chunk_paths = list(executor.map(run_rollout_chunk, starts, sizes, [out_dir] * len(starts)))
+
+        # the rows of each year (other than the targets) are the same in every rollout
+        keys = past_year
+        for year in range(last_year + 1, last_year + num_years_to_pred + 1):
+            keys = start_next_year(keys, id_offsets, schema)[0]
+            id_offsets = np.arange(len(keys))
+
+            paths = [paths[year] for paths in chunk_paths]
+            year_quantiles = get_year_quantiles(paths, quantiles)
+            for path in paths:
+                os.remove(path)
+
+            year_df = schema.to_df(keys)[['ID', 'COUNT', 'MONTH', 'DATE', 'TIME']]
+            year_df['SPECIES'] = schema.species_names[schema.get_species(keys)]
+            for i, q in enumerate(quantiles):
+                for j, col in enumerate(TARGET_COLUMNS):
+                    year_df[f'{col}_P{round(q * 100)}'] = year_quantiles[i, :, j]
+
+            yield year_df
+
+def main(num_rollouts=1000, lag_noise=0.05, max_workers=None, output_path='animal_migration_scenarios.csv'):
+    print('Reading in dataframe')
+    cleaned_df = load_clean_survey()
+    print('Successfuly loaded dataframe')
+
+    # the scenarios use the same training data and models as the forecast
+    train_df = cleaned_df.fillna(cleaned_df.mean())
+    trained_models = load_or_train_models(train_df)
+    print('Successfully loaded models')
+
+    # forecast from the year after the last survey like the forecast of animal_migration
+    last_year = int(cleaned_df['COUNT'].max())
+    num_years = 2030 - last_year
+    print(f'Running {num_rollouts} rollouts for years: {last_year + 1} to {last_year + num_years}')
+
+    # write the quantiles of each year as soon as they are taken
+    sink = CSVSink(output_path, index=False)
+    for year_df in run_scenarios(train_df, trained_models, num_rollouts=num_rollouts, num_years_to_pred=num_years, last_year=last_year,
+                                 lag_noise=lag_noise, max_workers=max_workers or get_available_cores()):
+        print(f'Completed scenarios for year: {year_df["COUNT"].iloc[0]}')
+        sink.write(year_df)
+    sink.close()
+    print(f'Completed outputting to {output_path}')
+
+if __name__ == '__main__':
+    main()
@@ -1,21 +1,75 @@
+import copy
+import warnings
 import numpy as np
 import pandas as pd
 from datetime import datetime
 from sklearn.metrics import mean_absolute_error, r2_score, mean_squared_error
 from sklearn.preprocessing import StandardScaler
 import torch
-from torch.utils.data import DataLoader, TensorDataset
 import torch.nn as nn
-import torch
-import torch.nn as nn
-import torch.optim as optim
-from torch.utils.data import DataLoader, TensorDataset
-import numpy as np
-import pandas as pd
-from sklearn.preprocessing import StandardScaler
+from non_dl import convert_time, datetime_days, to_categories
+from data_loader import load_clean_survey
+from training import fit_model, get_best_epoch, get_model_args, get_row_tensors
+from sequences import SequenceWindows
 
 device = torch.device("cpu")
 
+# the number of surveys of a species (the row itself and the ones before it) the LSTM reads for every prediction
+SEQUENCE_WINDOW = 4
+
+class LSTMModel(nn.Module):
+    '''
+    LSTMModel is a stacked LSTM followed by a fully connected layer that maps the last hidden state to the target variables.
+    It is defined at module level so trained models can be rebuilt from their state_dict and init_args. The model reads windows of
+    the survey history of a species (see SequenceWindows) whose length is stored with the model, and front padded windows are masked
+    by packing only their real rows.
+    '''
+    def __init__(self, input_size, hidden_size, num_layers, output_size, window=1):
+        super(LSTMModel, self).__init__()
+        self.init_args = {'input_size': input_size, 'hidden_size': hidden_size, 'num_layers': num_layers, 'output_size': output_size,
+                          'window': window}
+        self.hidden_size = hidden_size
+        self.num_layers = num_layers
+        self.window = window
+        self.lstm = nn.LSTM(input_size, hidden_size, num_layers, batch_first=True, dropout= 0.2)
+        self.fc = nn.Linear(hidden_size, output_size)
+
+    def run_lstm(self, x, lengths=None):
+        '''
+        Runs the LSTM over a batch of front padded windows and returns the hidden and cell state after the last real row of each
+        '''
+        h0 = torch.zeros(self.num_layers, x.size(0), self.hidden_size).to(x.device)
+        c0 = torch.zeros(self.num_layers, x.size(0), self.hidden_size).to(x.device)
+        state = (h0, c0)
+
+        if lengths is None or x.size(1) == 1:
+            _, state = self.lstm(x, state)
+            return state
+
+        # move the real rows of each window to the front and pack them so the padding never reaches the LSTM
+        steps = torch.arange(x.size(1), device=x.device)
+        shift = (x.size(1) - lengths).to(x.device)
+        idx = torch.clamp(steps[None, :] + shift[:, None], max=x.size(1) - 1)
+        x = torch.gather(x, 1, idx[:, :, None].expand(-1, -1, x.size(2)))
+        packed = nn.utils.rnn.pack_padded_sequence(x, lengths.cpu(), batch_first=True, enforce_sorted=False)
+        _, state = self.lstm(packed, state)
+        return state
+
+    def forward(self, x, lengths=None):
+        '''
+        Predicts the targets of the last row of each window
+
+        Inputs:
+            - x (torch.Tensor) - The windows with shape [samples, time steps, features]
+            - lengths (torch.Tensor) - The number of real rows at the end of each window, every row is real if not given
+
+        Returns:
+            - out (torch.Tensor) - The predicted targets
+        '''
+        h, _ = self.run_lstm(x, lengths)
+        out = self.fc(h[-1])
+        return out
+
 def process_date(val):
     '''
     Processes a date value to extract numeric information based on its type.
@@ -52,11 +106,9 @@ def preprocess(df):
     df.drop(columns=empty_cols, inplace=True)
     df.drop(columns=zero_cols, inplace=True)
     df.drop(columns=drop_cols, inplace=True)
-    df['TIME'] = df['TIME'].apply(lambda x: x.hour * 3600 + x.minute * 60 + x.second if pd.notna(x) else x)
-    df['TIME'] = df['TIME'].fillna(0)
+    df['TIME'] = convert_time(df['TIME'])
     df['TYPE'] = df['TYPE'].map({'Fixed-wing': 0, 'Helicopter': 1})
-    df['DATE'] = df['DATE'].apply(lambda t: t.day if isinstance(t, datetime) else np.nan)
-    df['DATE'] = df['DATE'].apply(process_date)
+    df['DATE'] = datetime_days(df['DATE'])
 
     month_mapping = {
     'January': 1, 'February': 2, 'March': 3, 'April': 4,
@@ -64,22 +116,23 @@ def preprocess(df):
     'September': 9, 'October': 10, 'November': 11, 'December': 12
     }
 
-    df['MONTH'] = df['MONTH'].map(month_mapping)
-    df['MONTH'] = pd.to_numeric(df['MONTH'], errors='coerce')
+    df['MONTH'] = pd.to_numeric(df['MONTH'].map(month_mapping), errors='coerce')
 
-    df['lat_lag1'] = df.groupby('SPECIES')['LATITUDE'].shift(1)
-    df['lat_lag2'] = df.groupby('SPECIES')['LATITUDE'].shift(2)
-    
+    grouped = df.groupby('SPECIES')[['LATITUDE', 'LONGITUDE', 'NUMBER']]
+    lag_1 = grouped.shift(1)
+    lag_2 = grouped.shift(2)
 
-    df['lon_lag1'] = df.groupby('SPECIES')['LONGITUDE'].shift(1)
-    df['lon_lag2'] = df.groupby('SPECIES')['LONGITUDE'].shift(2)
-    
+    df['lat_lag1'] = lag_1['LATITUDE']
+    df['lat_lag2'] = lag_2['LATITUDE']
+
+    df['lon_lag1'] = lag_1['LONGITUDE']
+    df['lon_lag2'] = lag_2['LONGITUDE']
 
-    df['number_lag1'] = df.groupby('SPECIES')['NUMBER'].shift(1)
-    df['number_lag2'] = df.groupby('SPECIES')['NUMBER'].shift(2)
+    df['number_lag1'] = lag_1['NUMBER']
+    df['number_lag2'] = lag_2['NUMBER']
     
-    df['SPECIES'] = df['SPECIES'].str.lower()
-    df['STRATUM'] = df['STRATUM'].str.lower()
+    df['SPECIES'] = to_categories(df['SPECIES'])
+    df['STRATUM'] = to_categories(df['STRATUM'])
     df = pd.get_dummies(df, columns=['SPECIES', 'STRATUM'])
 
     return df
@@ -116,7 +169,21 @@ def split(df):
 
     return X_train, X_test, y_train, y_test
 
-def create_model(X_train, X_test, y_train, y_test):
+def get_species_codes(df):
+    '''
+    Gets the species of every row of a preprocessed dataframe from its one-hot encoded species columns.
+
+    Inputs:
+        - df (pd.DataFrame) - The preprocessed dataframe.
+
+    Returns:
+        - codes (np.ndarray) - The index of the species column of each row, used to group the rows into sequences.
+    '''
+    species_columns = [col for col in df.columns if col.startswith('SPECIES_')]
+    return np.argmax(df[species_columns].to_numpy(), axis=1)
+
+def create_model(X_train, X_test, y_train, y_test, num_epochs=100, checkpoint_path=None, groups_train=None, groups_test=None,
+                 window=SEQUENCE_WINDOW, batch_size=32, perf_mode=False, bf16=False):
     '''
     Creates and trains an LSTM model for predicting target variables based on training data.
 
@@ -125,6 +192,14 @@ def create_model(X_train, X_test, y_train, y_test):
         - X_test (np.ndarray) - Testing features.
         - y_train (pd.DataFrame) - Training target variables.
         - y_test (pd.DataFrame) - Testing target variables.
+        - num_epochs (int) - Maximum number of training epochs.
+        - checkpoint_path (str) - Optional file to checkpoint training to and resume from.
+        - groups_train (np.ndarray) - Species of each training row, all rows are one sequence if not given.
+        - groups_test (np.ndarray) - Species of each testing row, which continue the sequences of the training rows.
+        - window (int) - Number of rows in each window read by the LSTM.
+        - batch_size (int) - Number of rows in each training batch.
+        - perf_mode (bool) - Whether to train with every available core and the fused Adam optimizer.
+        - bf16 (bool) - Whether to train under bfloat16 autocast in perf_mode on CPUs that support it.
 
     Returns:
         - actual (np.ndarray) - Actual target values from the test set.
@@ -137,34 +212,16 @@ def create_model(X_train, X_test, y_train, y_test):
     X_test_scaled = scaler.transform(X_test)
 
     # Convert to PyTorch tensors
-    X_train_tensor = torch.FloatTensor(X_train_scaled)
     y_train_tensor = torch.FloatTensor(y_train.values)
-    X_test_tensor = torch.FloatTensor(X_test_scaled)
     y_test_tensor = torch.FloatTensor(y_test.values)
 
-    # Reshape input to be [samples, time steps, features]
-    X_train_tensor = X_train_tensor.unsqueeze(1)
-    X_test_tensor = X_test_tensor.unsqueeze(1)
-
-    # Create DataLoader
-    train_dataset = TensorDataset(X_train_tensor, y_train_tensor)
-    train_loader = DataLoader(train_dataset, batch_size=32, shuffle=True)
-
-    # Define the LSTM Model
-    class LSTMModel(nn.Module):
-        def __init__(self, input_size, hidden_size, num_layers, output_size):
-            super(LSTMModel, self).__init__()
-            self.hidden_size = hidden_size
-            self.num_layers = num_layers
-            self.lstm = nn.LSTM(input_size, hidden_size, num_layers, batch_first=True, dropout= 0.2)
-            self.fc = nn.Linear(hidden_size, output_size)
-
-        def forward(self, x):
-            h0 = torch.zeros(self.num_layers, x.size(0), self.hidden_size).to(x.device)
-            c0 = torch.zeros(self.num_layers, x.size(0), self.hidden_size).to(x.device)
-            out, _ = self.lstm(x, (h0, c0))
-            out = self.fc(out[:, -1, :])
-            return out
+    # Build the windows of [time steps, features] over the survey history of each species so the test rows see the training rows before them
+    if groups_train is None:
+        groups_train = np.zeros(len(X_train_scaled), dtype=int)
+        groups_test = np.zeros(len(X_test_scaled), dtype=int)
+    windows = SequenceWindows(np.vstack([X_train_scaled, X_test_scaled]), np.r_[groups_train, groups_test], window)
+    train_windows = windows.subset(torch.arange(len(X_train_scaled)))
+    test_idx = torch.arange(len(X_train_scaled), len(windows))
 
     # Instantiate the model
     input_size = X_train.shape[1]
@@ -172,44 +229,23 @@ def create_model(X_train, X_test, y_train, y_test):
     num_layers = 2
     output_size = 3  # Number of target variables
 
-    model = LSTMModel(input_size, hidden_size, num_layers, output_size)
-
-    # Define loss function and optimizer
-    criterion = nn.MSELoss()
-    optimizer = optim.Adam(model.parameters())
-
-    # Training loop
-    num_epochs = 100
+    model = LSTMModel(input_size, hidden_size, num_layers, output_size, window)
     model.to(device)
 
-    for epoch in range(num_epochs):
-        model.train()
-        for batch_X, batch_y in train_loader:
-            batch_X, batch_y = batch_X.to(device), batch_y.to(device)
-            optimizer.zero_grad()
-            outputs = model(batch_X)
-            loss = criterion(outputs, batch_y)
-            loss.backward()
-            optimizer.step()
-        
-        if (epoch + 1) % 10 == 0:
-            print(f'Epoch [{epoch+1}/{num_epochs}], Loss: {loss.item():.4f}')
+    # Train until the validation loss stops improving
+    model, _ = fit_model(model, train_windows, y_train_tensor, num_epochs=num_epochs, batch_size=batch_size, checkpoint_path=checkpoint_path,
+                         perf_mode=perf_mode, bf16=bf16)
+    criterion = nn.MSELoss()
 
     # Evaluation
     model.eval()
     with torch.no_grad():
-        X_test_tensor = X_test_tensor.to(device)
-        predictions = model(X_test_tensor)
+        predictions = model(*windows[test_idx])
         test_loss = criterion(predictions, y_test_tensor.to(device))
         print(f'Test Loss: {test_loss.item():.4f}')
 
-    # Convert predictions back to numpy for further analysis if needed
-    predictions = predictions.cpu().numpy()
-
-    with torch.no_grad():
-        actual = y_test_tensor.numpy()
-        y_preds = model(X_test_tensor)
-        predicted = y_preds.detach().numpy()
+    actual = y_test_tensor.numpy()
+    predicted = predictions.cpu().numpy()
     
     return actual, predicted
 
@@ -255,13 +291,14 @@ def metrics(actual, predicted):
     r2 = r2_score(actual[2], predicted[2])
     print(f"R² Score LONGITUDE: {r2}")
 
-def final_split(df, values_to_predict):
+def final_split(df, values_to_predict, scaler=None):
     '''
     Prepares the dataset for final training by scaling and separating features and target variables.
 
     Inputs:
         - df (pd.DataFrame) - The dataframe to process for training.
         - values_to_predict (list) - List of target variables to predict.
+        - scaler (StandardScaler) - Optional scaler already fit on the features, a new one is fit if not given.
 
     Returns:
         - X_train (np.ndarray) - Scaled training features.
@@ -279,85 +316,137 @@ def final_split(df, values_to_predict):
     X_train = train_df.drop(columns=['ID', 'LATITUDE', 'LONGITUDE', 'NUMBER'])
     y_train = train_df[values_to_predict]
 
-    scaler = StandardScaler()
-    X_train = scaler.fit_transform(X_train)
+    if scaler is None:
+        scaler = StandardScaler()
+        X_train = scaler.fit_transform(X_train)
+    else:
+        X_train = scaler.transform(X_train)
     
 
     return X_train, y_train, scaler
 
-def final_train(df, values_to_predict):
+def final_train(df, values_to_predict, num_epochs=100, checkpoint_path=None, window=SEQUENCE_WINDOW, batch_size=32, perf_mode=False,
+                bf16=False, scaler=None, hidden_size=64, num_layers=2):
     '''
-    Trains a final LSTM model based on the entire dataset for the given target variables.
+    Trains a final LSTM model based on the entire dataset for the given target variables. The number of epochs is chosen on the
+    latest surveys held out, then the model is trained again on every row for that many epochs.
 
     Inputs:
         - df (pd.DataFrame) - The dataframe to train the model on.
         - values_to_predict (list) - List of target variables to predict.
+        - num_epochs (int) - Maximum number of training epochs.
+        - checkpoint_path (str) - Optional file to checkpoint training to and resume from, the final training on every row is
+                                  checkpointed to the same path with a .refit suffix.
+        - window (int) - Number of rows of the survey history of a species in each window read by the LSTM.
+        - batch_size (int) - Number of rows in each training batch.
+        - perf_mode (bool) - Whether to train with every available core and the fused Adam optimizer.
+        - bf16 (bool) - Whether to train under bfloat16 autocast in perf_mode on CPUs that support it.
+        - scaler (StandardScaler) - Optional scaler already fit on the features, a new one is fit if not given.
+        - hidden_size (int) - Number of features in the hidden state of each LSTM layer.
+        - num_layers (int) - Number of stacked LSTM layers.
 
     Returns:
         - model (nn.Module) - Trained LSTM model.
         - scaler (StandardScaler) - Scaler object used for scaling features.
     '''
-    X_train_scaled, y_train, scaler = final_split(df, values_to_predict)
+    X_train_scaled, y_train, scaler = final_split(df, values_to_predict, scaler)
     
     # Convert to PyTorch tensors
-    X_train_tensor = torch.FloatTensor(X_train_scaled)
     y_train_tensor = torch.FloatTensor(y_train.values)
-    
 
-    # Reshape input to be [samples, time steps, features]
-    X_train_tensor = X_train_tensor.unsqueeze(1)
-
-    # Create DataLoader
-    train_dataset = TensorDataset(X_train_tensor, y_train_tensor)
-    train_loader = DataLoader(train_dataset, batch_size=32, shuffle=True)
-
-    # Define the LSTM Model
-    class LSTMModel(nn.Module):
-        def __init__(self, input_size, hidden_size, num_layers, output_size):
-            super(LSTMModel, self).__init__()
-            self.hidden_size = hidden_size
-            self.num_layers = num_layers
-            self.lstm = nn.LSTM(input_size, hidden_size, num_layers, batch_first=True, dropout= 0.2)
-            self.fc = nn.Linear(hidden_size, output_size)
-
-        def forward(self, x):
-            h0 = torch.zeros(self.num_layers, x.size(0), self.hidden_size).to(x.device)
-            c0 = torch.zeros(self.num_layers, x.size(0), self.hidden_size).to(x.device)
-            out, _ = self.lstm(x, (h0, c0))
-            out = self.fc(out[:, -1, :])
-            return out
+    # Build the windows of [time steps, features] over the survey history of each species
+    windows = SequenceWindows(X_train_scaled, get_species_codes(df), window)
 
     # Instantiate the model
     input_size = X_train_scaled.shape[1]
-    hidden_size = 64
-    num_layers = 2
     output_size = len(values_to_predict)  # Number of target variables
 
-    model = LSTMModel(input_size, hidden_size, num_layers, output_size)
-
-    # Define loss function and optimizer
-    criterion = nn.MSELoss()
-    optimizer = optim.Adam(model.parameters())
-
-    # Training loop
-    num_epochs = 100
+    # Choose the number of epochs by training until the loss on the latest surveys held out stops improving
+    model = LSTMModel(input_size, hidden_size, num_layers, output_size, window)
     model.to(device)
+    times = df['COUNT'].to_numpy()
+    _, history = fit_model(model, windows, y_train_tensor, num_epochs=num_epochs, batch_size=batch_size, checkpoint_path=checkpoint_path,
+                           perf_mode=perf_mode, bf16=bf16, times=times)
+    best_epoch = get_best_epoch(history)
 
-    for epoch in range(num_epochs):
-        model.train()
-        for batch_X, batch_y in train_loader:
-            batch_X, batch_y = batch_X.to(device), batch_y.to(device)
-            optimizer.zero_grad()
-            outputs = model(batch_X)
-            loss = criterion(outputs, batch_y)
-            loss.backward()
-            optimizer.step()
-        
-        if (epoch + 1) % 10 == 0:
-            print(f'Epoch [{epoch+1}/{num_epochs}], Loss: {loss.item():.4f}')
+    # Train the final model on every row, including the held out surveys, for that number of epochs
+    model = LSTMModel(input_size, hidden_size, num_layers, output_size, window)
+    model.to(device)
+    refit_path = None if checkpoint_path is None else f'{checkpoint_path}.refit'
+    model, _ = fit_model(model, windows, y_train_tensor, num_epochs=best_epoch, batch_size=batch_size, val_fraction=0,
+                         patience=best_epoch, checkpoint_path=refit_path, perf_mode=perf_mode, bf16=bf16)
 
     return model, scaler
 
+def get_final_windows(df, scaler, window=SEQUENCE_WINDOW):
+    '''
+    Scales every row with the scaler of a trained model and builds the windows over the survey history of each species, so a subset
+    of the rows can be fine-tuned on or predicted with the rows before them in their windows
+
+    Inputs:
+        - df (pd.DataFrame) - The dataframe with no Nan values.
+        - scaler (StandardScaler) - Scaler of the trained model.
+        - window (int) - Number of rows of the survey history of a species in each window read by the LSTM.
+
+    Returns:
+        - windows (SequenceWindows) - The windows of every row.
+    '''
+    X_scaled = scaler.transform(df.drop(columns=['ID', 'LATITUDE', 'LONGITUDE', 'NUMBER']))
+    return SequenceWindows(X_scaled, get_species_codes(df), window)
+
+def final_update(model, scaler, df, values_to_predict, rows, num_epochs=5, lr=1e-4, window=SEQUENCE_WINDOW, batch_size=32,
+                 perf_mode=False, bf16=False):
+    '''
+    Fine-tunes a trained LSTM model for a few epochs on a subset of the rows (e.g. the rows of a new survey and a sample of the
+    earlier ones replayed so the model doesn't forget them), keeping its scaler.
+
+    Inputs:
+        - model (nn.Module) - Trained LSTM model, which isn't changed.
+        - scaler (StandardScaler) - Scaler of the trained model.
+        - df (pd.DataFrame) - The dataframe with no Nan values, every row so the windows include the history before the rows.
+        - values_to_predict (list) - List of target variables to predict.
+        - rows (np.ndarray) - The positions of the rows to fine-tune on.
+        - num_epochs (int) - Maximum number of epochs.
+        - lr (float) - The learning rate, lower than for training from scratch so the update stays close to the trained weights.
+        - window (int) - Number of rows of the survey history of a species in each window read by the LSTM.
+        - batch_size (int) - Number of rows in each training batch.
+        - perf_mode (bool) - Whether to train with every available core and the fused Adam optimizer.
+        - bf16 (bool) - Whether to train under bfloat16 autocast in perf_mode on CPUs that support it.
+
+    Returns:
+        - model (nn.Module) - The fine-tuned copy of the model.
+    '''
+    model = copy.deepcopy(model)
+    rows = torch.as_tensor(rows, dtype=torch.long)
+
+    windows = get_final_windows(df, scaler, window).subset(rows)
+    y_train_tensor = torch.FloatTensor(df[values_to_predict].values)[rows]
+
+    # fine-tune without stopping early, keeping the weights with the lowest validation loss
+    model, _ = fit_model(model, windows, y_train_tensor, num_epochs=num_epochs, batch_size=batch_size, lr=lr, patience=num_epochs,
+                         verbose=False, perf_mode=perf_mode, bf16=bf16)
+
+    return model
+
+def final_predict_windows(model, windows, rows):
+    '''
+    Makes predictions for a subset of the rows of the windows from get_final_windows().
+
+    Inputs:
+        - model (nn.Module) - Trained LSTM model.
+        - windows (SequenceWindows) - The windows of every row.
+        - rows (np.ndarray) - The positions of the rows to predict.
+
+    Returns:
+        - predicted (np.ndarray) - Predicted values for the rows.
+    '''
+    subset = windows.subset(torch.as_tensor(rows, dtype=torch.long))
+    model.eval()
+    with torch.no_grad():
+        pred_values = model(*get_model_args(subset, get_row_tensors(subset)))
+
+    return pred_values.numpy()
+
 def final_predict(model, scaler, row):
     '''
     Makes predictions for a single row of data using the trained model and scaler.
@@ -373,18 +462,161 @@ def final_predict(model, scaler, row):
 
     # Scaling the row to be predicted
     row_scaled = scaler.transform(row)
-    row_tensor = torch.FloatTensor(row_scaled)
+
+    return final_predict_scaled(model, row_scaled)
+
+def final_predict_scaled(model, rows_scaled):
+    '''
+    Makes predictions for rows of data that have already been scaled.
+
+    Inputs:
+        - model (nn.Module) - Trained LSTM model.
+        - rows_scaled (np.ndarray) - Scaled rows of data to predict.
+
+    Returns:
+        - predicted (np.ndarray) - Predicted values for the rows.
+    '''
+    row_tensor = torch.FloatTensor(rows_scaled)
     # Getting the data in the required format
     row_tensor = row_tensor.unsqueeze(1)
     # Setting model to eval mode
     model.eval()
     row_tensor = row_tensor.to(device)
-    # Predicting Values
-    pred_values = model(row_tensor)
-    predicted = pred_values.detach().numpy()
+    # Predicting Values without recording the autograd graph
+    with torch.no_grad():
+        pred_values = model(row_tensor)
+    predicted = pred_values.numpy()
 
     return predicted
 
+class LSTMSteps(nn.Module):
+    '''
+    LSTMSteps runs the layers of a trained LSTMModel over front padded windows one time step at a time, keeping the zero state of
+    each window until its first real row, so it gives the predictions of LSTMModel without packing. The number of steps is fixed by
+    the window, which lets torch.jit.trace unroll it into a single graph.
+    '''
+    def __init__(self, model):
+        super(LSTMSteps, self).__init__()
+        self.lstm = model.lstm
+        self.fc = model.fc
+        self.num_layers = model.num_layers
+        self.hidden_size = model.hidden_size
+
+    def forward(self, x, mask):
+        '''
+        Predicts the targets of the last row of each window
+
+        Inputs:
+            - x (torch.Tensor) - The windows with shape [samples, time steps, features]
+            - mask (torch.Tensor) - Boolean mask with shape [samples, time steps] that is True for the real rows of each window
+
+        Returns:
+            - out (torch.Tensor) - The predicted targets
+        '''
+        h = x.new_zeros(self.num_layers, x.size(0), self.hidden_size)
+        c = x.new_zeros(self.num_layers, x.size(0), self.hidden_size)
+
+        # only move the state forward on the real rows, the padding in front of a window leaves it at zero
+        for t in range(x.size(1)):
+            _, (h_t, c_t) = self.lstm(x[:, t:t + 1], (h, c))
+            real = mask[None, :, t, None]
+            h = torch.where(real, h_t, h)
+            c = torch.where(real, c_t, c)
+
+        return self.fc(h[-1])
+
+class LSTMPredictor:
+    '''
+    LSTMPredictor is an inference engine for a trained LSTMModel. The model is traced once over its window (see LSTMSteps) and
+    frozen, and the windows of every call are copied into input buffers that are only reallocated when a call has more rows than
+    any before it. Models trained on windows of more than one row (SEQUENCE_WINDOW) are given the history of each species: the
+    window of every row is built like SequenceWindows builds it in training, from the rows before it in its species (the end of the
+    history followed by the earlier rows of the same batch) and the row itself, so the rows of a forecast year see the earlier rows of
+    that year just like the survey rows the model was trained on. Rows predicted without any history are a single time step from a
+    zero state. Every call runs without recording an autograd graph.
+    '''
+    def __init__(self, model, scaler=None):
+        self.model = model.eval()
+        self.window = model.init_args.get('window', 1)
+        self.scaler = scaler
+
+        # the input buffers, grown to the largest batch seen
+        self.inputs = torch.zeros(1, self.window, model.init_args['input_size'])
+        self.mask = torch.ones(1, self.window, dtype=torch.bool)
+
+        # the shape checks of nn.LSTM and the torch.jit deprecation notices warn while tracing, neither changes the graph
+        with torch.inference_mode(), warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            self.graph = torch.jit.freeze(torch.jit.trace(LSTMSteps(self.model).eval(), (self.inputs, self.mask)))
+
+    def get_buffers(self, num_rows):
+        '''
+        Returns views of the first num_rows windows of the input buffers, reallocating them if they are too small
+        '''
+        if len(self.inputs) < num_rows:
+            self.inputs = torch.zeros(num_rows, *self.inputs.shape[1:])
+            self.mask = torch.ones(num_rows, self.window, dtype=torch.bool)
+        return self.inputs[:num_rows], self.mask[:num_rows]
+
+    def predict_scaled(self, rows_scaled, history=None, history_lengths=None, groups=None):
+        '''
+        Makes predictions for rows of data that have already been scaled.
+
+        Inputs:
+            - rows_scaled (np.ndarray) - Scaled rows of data to predict with shape (N, F), in order within each group.
+            - history (np.ndarray) - Optional scaled rows that come before the rows of each group (species), front padded with shape
+                                     (G, window - 1, F) like the output of sequences.get_group_tails().
+            - history_lengths (np.ndarray) - The number of real rows in the history of each group.
+            - groups (np.ndarray) - The group of each row to predict.
+
+        Returns:
+            - predicted (np.ndarray) - Predicted values for the rows.
+        '''
+        if history is not None and self.window > 1:
+            return self.predict_sequences(rows_scaled, history, history_lengths, groups)
+
+        # each row is the only real row at the end of its window
+        inputs, mask = self.get_buffers(len(rows_scaled))
+        inputs[:, -1] = torch.as_tensor(rows_scaled, dtype=torch.float32)
+        mask.fill_(False)
+        mask[:, -1] = True
+
+        with torch.inference_mode():
+            return self.graph(inputs, mask).numpy()
+
+    def predict_sequences(self, rows_scaled, history, history_lengths, groups):
+        '''
+        Builds the window of every row from the history of its group followed by the rows of the batch and predicts every row at once
+        '''
+        # put the real rows of the history of each group in front of the new rows
+        num_groups, length, _ = history.shape
+        real = np.arange(length)[None, :] >= (length - np.asarray(history_lengths))[:, None]
+        history_groups = np.broadcast_to(np.arange(num_groups)[:, None], real.shape)[real]
+        rows = np.concatenate([history[real], np.asarray(rows_scaled, dtype=history.dtype)])
+        windows = SequenceWindows(rows, np.concatenate([history_groups, groups]), self.window)
+
+        # copy the windows of the new rows and their masks into the input buffers
+        idx = torch.arange(len(history_groups), len(rows))
+        inputs, mask = self.get_buffers(len(idx))
+        torch.index_select(windows.windows, 0, windows.starts[idx], out=inputs)
+        torch.ge(torch.arange(self.window), (self.window - windows.lengths[idx])[:, None], out=mask)
+
+        with torch.inference_mode():
+            return self.graph(inputs, mask).numpy()
+
+    def predict(self, rows):
+        '''
+        Scales rows of data with the scaler of the model and makes predictions for them.
+
+        Inputs:
+            - rows (np.ndarray) - Rows of data to predict with shape (N, F).
+
+        Returns:
+            - predicted (np.ndarray) - Predicted values for the rows.
+        '''
+        if self.scaler is None:
+            raise ValueError('LSTMPredictor.predict() needs the scaler of the model, pass it to the constructor or use predict_scaled()')
+        return self.predict_scaled((np.asarray(rows, dtype=np.float64) - self.scaler.mean_) / self.scaler.scale_)
 
 
 
@@ -399,13 +631,13 @@ def main():
         - None
     '''
 
-    df = pd.read_excel('./data/GNP_Aerial_counting_1969_2022.xlsx')
-    print("done reading")
-    df = preprocess(df)
-    print("done preprocessing")
+    df = load_clean_survey(clean=preprocess)
+    print("done reading and preprocessing")
     X_train, X_test, y_train, y_test = split(df)
+    groups = get_species_codes(df)
     print("done splitting")
-    actual, predicted = create_model(X_train, X_test, y_train, y_test)
+    actual, predicted = create_model(X_train, X_test, y_train, y_test, groups_train=groups[df['COUNT'] != 2022],
+                                     groups_test=groups[df['COUNT'] == 2022])
     print("done training")
     metrics(actual, predicted)
     
@@ -0,0 +1,131 @@
+import numpy as np
+import torch
+
+class SequenceWindows:
+    '''
+    SequenceWindows is a dataset of the survey history leading up to every row. The rows of each group (species) are laid out one after
+    another in a single tensor with window - 1 rows of zero padding in front of every group, and a strided view over that tensor (unfold)
+    gives the window of the window - 1 previous rows of the same group plus the row itself for every row without copying them. Windows
+    are only copied when a batch is taken, and the number of real (unpadded) rows of each window is kept as its length so the padding
+    can be masked out.
+    '''
+    def __init__(self, X, groups, window):
+        X = torch.as_tensor(X, dtype=torch.float32)
+        groups = np.asarray(groups)
+        num_rows, num_features = X.shape
+        self.window = window
+
+        # order the rows by group, keeping the original order within each group
+        order = np.argsort(groups, kind='stable')
+        sorted_groups = groups[order]
+        is_start = np.r_[True, sorted_groups[1:] != sorted_groups[:-1]] if num_rows else np.zeros(0, dtype=bool)
+        group_num = np.cumsum(is_start) - 1
+        group_start = np.flatnonzero(is_start)
+
+        # the position of each row in the padded tensor, each group being shifted by the padding of every group up to it
+        padded_pos = np.arange(num_rows) + (group_num + 1) * (window - 1)
+        self.padded = torch.zeros(num_rows + len(group_start) * (window - 1), num_features)
+        self.padded[torch.from_numpy(padded_pos)] = X[torch.from_numpy(order)]
+
+        # the window ending at padded row p starts at row p - window + 1 of the padded tensor
+        self.windows = self.padded.unfold(0, window, 1).transpose(1, 2)
+
+        # map the start of each window and its number of real rows back to the original row order
+        position_in_group = np.arange(num_rows) - group_start[group_num]
+        self.starts = torch.empty(num_rows, dtype=torch.long)
+        self.starts[torch.from_numpy(order)] = torch.from_numpy(padded_pos - (window - 1))
+        self.lengths = torch.empty(num_rows, dtype=torch.long)
+        self.lengths[torch.from_numpy(order)] = torch.from_numpy(np.minimum(position_in_group + 1, window))
+
+    def __len__(self):
+        return len(self.starts)
+
+    def subset(self, idx):
+        '''
+        Returns the windows of a subset of the rows that share the padded tensor of this dataset
+
+        Inputs:
+            - idx (torch.Tensor) - The indices of the rows to keep
+
+        Returns:
+            - subset (SequenceWindows) - The windows of the rows
+        '''
+        subset = SequenceWindows.__new__(SequenceWindows)
+        subset.window = self.window
+        subset.padded = self.padded
+        subset.windows = self.windows
+        subset.starts = self.starts[idx]
+        subset.lengths = self.lengths[idx]
+        return subset
+
+    def __getitem__(self, idx):
+        '''
+        Copies the windows of a batch of rows
+
+        Inputs:
+            - idx (torch.Tensor) - The indices of the rows
+
+        Returns:
+            - windows (torch.Tensor) - The front padded windows with shape [samples, window, features]
+            - lengths (torch.Tensor) - The number of real rows in each window
+        '''
+        return self.windows[self.starts[idx]], self.lengths[idx]
+
+    def mask(self, idx=None):
+        '''
+        Returns a [samples, window] boolean mask that is True for the real rows of each window
+        '''
+        lengths = self.lengths if idx is None else self.lengths[idx]
+        return torch.arange(self.window) >= (self.window - lengths)[:, None]
+
+def get_group_tails(X, groups, num_groups, length):
+    '''
+    Gets the last rows of every group, front padded with zeros the same way as the windows of SequenceWindows
+
+    Inputs:
+        - X (np.ndarray) - The rows with shape (N, F)
+        - groups (np.ndarray) - The group of each row, from 0 to num_groups - 1
+        - num_groups (int) - The number of groups
+        - length (int) - The number of rows to keep from the end of each group
+
+    Returns:
+        - tails (np.ndarray) - The last rows of each group with shape (num_groups, length, F)
+        - lengths (np.ndarray) - The number of real rows in the tail of each group
+    '''
+    # order the rows by group and find where each group ends
+    order = np.argsort(groups, kind='stable')
+    sorted_groups = groups[order]
+    group_ids = np.arange(num_groups)
+    start = np.searchsorted(sorted_groups, group_ids, side='left')
+    end = np.searchsorted(sorted_groups, group_ids, side='right')
+
+    # the k-th row of a tail is length - k rows before the end of the group, which is padding if it is before the start of the group
+    tails = np.zeros((num_groups, length, X.shape[1]), dtype=X.dtype)
+    for k in range(length):
+        pos = end - length + k
+        valid = pos >= start
+        tails[valid, k] = X[order[pos[valid]]]
+
+    return tails, np.minimum(end - start, length)
+
+def append_group_tails(tails, lengths, X, groups):
+    '''
+    Updates the tails from get_group_tails() with new rows, so the tails can be kept up to date without keeping every row
+
+    Inputs:
+        - tails (np.ndarray) - The front padded tails of each group with shape (num_groups, length, F)
+        - lengths (np.ndarray) - The number of real rows in the tail of each group
+        - X (np.ndarray) - The new rows with shape (N, F), which come after every row of the tails
+        - groups (np.ndarray) - The group of each new row
+
+    Returns:
+        - tails (np.ndarray) - The tails of each group after the new rows
+        - lengths (np.ndarray) - The number of real rows in the new tail of each group
+    '''
+    num_groups, length, _ = tails.shape
+
+    # put the real rows of the old tails in front of the new rows and take the tails again
+    real = np.arange(length)[None, :] >= (length - lengths)[:, None]
+    old_groups = np.broadcast_to(np.arange(num_groups)[:, None], real.shape)[real]
+    rows = np.concatenate([tails[real], X.astype(tails.dtype, copy=False)])
+    return get_group_tails(rows, np.concatenate([old_groups, groups]), num_groups, length)
@@ -0,0 +1,311 @@
+import numpy as np
+import pandas as pd
+from scipy.spatial import cKDTree
+
+# the sizes in degrees of the grid cells of each zoom level of the summary (roughly 11 km, 2 km and 500 m)
+GRID_CELL_SIZES = (0.1, 0.02, 0.005)
+
+# the columns the grid is built from and the columns the sightings are grouped by in each cell
+GRID_KEYS = ['COUNT', 'MONTH', 'SPECIES']
+
+# the length of a degree of latitude in km, used to measure distances on the flat projection of the index
+KM_PER_DEGREE = 111.195
+
+def get_grid_cells(lat, lon, cell_size):
+    '''
+    Gets the grid cell of each point. Cells are counted from latitude -90 and longitude -180 so a cell has the same row and column in
+    every summary with the same cell size.
+
+    Inputs:
+        - lat (np.ndarray) - The latitude of each point
+        - lon (np.ndarray) - The longitude of each point
+        - cell_size (float) - The size of a cell in degrees
+
+    Returns:
+        - rows (np.ndarray) - The row of the cell of each point
+        - cols (np.ndarray) - The column of the cell of each point
+    '''
+    rows = np.floor((np.asarray(lat, dtype=np.float64) + 90) / cell_size).astype(np.int32)
+    cols = np.floor((np.asarray(lon, dtype=np.float64) + 180) / cell_size).astype(np.int32)
+    return rows, cols
+
+def get_cell_sums(df, cell_size):
+    '''
+    Sums the sightings of each species in each grid cell for each year and month. The sums of different chunks of rows can be added
+    together, so a summary can be built without keeping every row.
+
+    Inputs:
+        - df (pd.Dataframe) - The output rows with the COUNT, MONTH, SPECIES, NUMBER, LATITUDE and LONGITUDE columns
+        - cell_size (float) - The size of a cell in degrees
+
+    Returns:
+        - sums (pd.Dataframe) - The number of sightings, the number of animals and the sums of the coordinates in each cell
+    '''
+    # sightings without a position or a month can't be placed on the map
+    df = df.dropna(subset=['LATITUDE', 'LONGITUDE', 'MONTH'])
+    rows, cols = get_grid_cells(df['LATITUDE'].to_numpy(), df['LONGITUDE'].to_numpy(), cell_size)
+
+    cells = df[GRID_KEYS].assign(CELL_ROW=rows, CELL_COL=cols, SIGHTINGS=1, NUMBER=df['NUMBER'], LATITUDE=df['LATITUDE'],
+                                 LONGITUDE=df['LONGITUDE'])
+    return cells.groupby(GRID_KEYS + ['CELL_ROW', 'CELL_COL'], as_index=False).sum(min_count=0)
+
+def finish_grid(sums, cell_size):
+    '''
+    Combines cell sums into the summary of a zoom level, with the centroid of the sightings in each cell
+
+    Inputs:
+        - sums (pd.Dataframe) - The cell sums from get_cell_sums() of one or more chunks of rows
+        - cell_size (float) - The size of a cell in degrees
+
+    Returns:
+        - grid (pd.Dataframe) - One row for each species in each cell for each year and month
+    '''
+    grid = sums.groupby(GRID_KEYS + ['CELL_ROW', 'CELL_COL'], as_index=False).sum()
+
+    # the centroid is the mean position of the sightings in the cell
+    grid['LATITUDE'] = grid['LATITUDE'] / grid['SIGHTINGS']
+    grid['LONGITUDE'] = grid['LONGITUDE'] / grid['SIGHTINGS']
+    grid.insert(0, 'CELL_SIZE', cell_size)
+
+    # store the summary with the smallest types that hold it
+    return grid.astype({'CELL_SIZE': np.float32, 'COUNT': np.int16, 'MONTH': np.int8, 'SPECIES': np.uint8, 'SIGHTINGS': np.int32,
+                        'NUMBER': np.float32, 'LATITUDE': np.float32, 'LONGITUDE': np.float32})
+
+def aggregate_grid(df, cell_sizes=GRID_CELL_SIZES):
+    '''
+    Bins the sightings into a fixed latitude / longitude grid for each species in each year and month, at every zoom level
+
+    Inputs:
+        - df (pd.Dataframe) - The output rows with the COUNT, MONTH, SPECIES, NUMBER, LATITUDE and LONGITUDE columns
+        - cell_sizes (tuple) - The cell size in degrees of each zoom level
+
+    Returns:
+        - grid (pd.Dataframe) - The summary of every zoom level, told apart by the CELL_SIZE column
+    '''
+    return pd.concat([finish_grid(get_cell_sums(df, cell_size), cell_size) for cell_size in cell_sizes], ignore_index=True)
+
+class GridSummarySink:
+    '''
+    GridSummarySink builds the grid summary of the output while it is streamed by ForecastWriter. Each chunk is reduced to its cell
+    sums straight away so only the sums are kept, and the summary of every zoom level is written to one Parquet file on close.
+    '''
+    def __init__(self, path, cell_sizes=GRID_CELL_SIZES):
+        self.path = path
+        self.cell_sizes = cell_sizes
+        self.sums = {cell_size: [] for cell_size in cell_sizes}
+
+    def write(self, chunk):
+        for cell_size in self.cell_sizes:
+            self.sums[cell_size].append(get_cell_sums(chunk, cell_size))
+
+    def close(self):
+        grid = pd.concat([finish_grid(pd.concat(self.sums[cell_size]), cell_size) for cell_size in self.cell_sizes], ignore_index=True)
+        grid.to_parquet(self.path, index=False)
+
+def get_species(df):
+    '''
+    Gets the species of each row from the SPECIES column of the output, or from the one-hot encoded species columns of the cleaned
+    dataframe
+
+    Inputs:
+        - df (pd.Dataframe) - The rows
+
+    Returns:
+        - species (np.ndarray) - The species (or species code) of each row
+    '''
+    if 'SPECIES' in df.columns:
+        return df['SPECIES'].to_numpy()
+    species_columns = [col for col in df.columns if col.startswith('SPECIES_')]
+    return df[species_columns].idxmax(axis=1).str.replace('SPECIES_', '').to_numpy()
+
+def points_in_polygon(lat, lon, polygon):
+    '''
+    Checks which points are inside a polygon by counting the edges a ray from each point crosses
+
+    Inputs:
+        - lat (np.ndarray) - The latitude of each point
+        - lon (np.ndarray) - The longitude of each point
+        - polygon (list) - The (latitude, longitude) of each vertex of the polygon
+
+    Returns:
+        - inside (np.ndarray) - True for the points inside the polygon
+    '''
+    vertices = np.asarray(polygon, dtype=np.float64)
+    inside = np.zeros(len(lat), dtype=bool)
+    for (lat1, lon1), (lat2, lon2) in zip(vertices, np.roll(vertices, -1, axis=0)):
+        # flip the points whose eastward ray crosses this edge
+        crosses = (lat1 > lat) != (lat2 > lat)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            edge_lon = lon1 + (lat - lat1) * (lon2 - lon1) / (lat2 - lat1)
+        inside ^= crosses & (lon < edge_lon)
+    return inside
+
+class SightingIndex:
+    '''
+    SightingIndex answers bounding box, radius, polygon and nearest neighbour queries over the sightings of a cleaned or forecast
+    dataframe without scanning every row. The sightings of each species in each year get their own KD-tree over their position,
+    so a query only searches the trees of the species and years it asks for, and the months within those years are filtered from
+    the matches. Positions are projected to km on a flat (equirectangular) projection around the mean latitude, which is accurate
+    over the extent of a park. Queries return the index labels of the matching rows of the dataframe.
+    '''
+    def __init__(self, df, leafsize=16):
+        # sightings without a position can't be found by a spatial query
+        df = df.dropna(subset=['LATITUDE', 'LONGITUDE'])
+        self.ids = df.index.to_numpy()
+        self.lat = df['LATITUDE'].to_numpy(dtype=np.float64)
+        self.lon = df['LONGITUDE'].to_numpy(dtype=np.float64)
+        self.months = df['COUNT'].to_numpy(dtype=np.float64) * 12 + df['MONTH'].to_numpy(dtype=np.float64)
+        self.lon_scale = np.cos(np.radians(self.lat.mean())) if len(df) else 1.0
+        self.points = self.project(self.lat, self.lon)
+
+        # build a tree over the rows of each species and year, keeping the position of each of its points in the dataframe
+        self.trees = {}
+        groups = pd.DataFrame({'species': get_species(df), 'year': df['COUNT'].to_numpy()})
+        for key, positions in groups.groupby(['species', 'year']).indices.items():
+            self.trees[key] = (cKDTree(self.points[positions], leafsize=leafsize), positions)
+
+    def project(self, lat, lon):
+        '''
+        Projects latitudes and longitudes to km
+        '''
+        lat = np.asarray(lat, dtype=np.float64)
+        lon = np.asarray(lon, dtype=np.float64)
+        return np.stack([lat * KM_PER_DEGREE, lon * self.lon_scale * KM_PER_DEGREE], axis=-1)
+
+    def get_trees(self, species=None, start=None, end=None):
+        '''
+        Gets the trees of the species and years of a query
+
+        Inputs:
+            - species (list) - The species to search, every species if not given
+            - start (tuple) - The first (year, month) to search, from the first sighting if not given
+            - end (tuple) - The last (year, month) to search, up to the last sighting if not given
+
+        Returns:
+            - trees (list) - The tree and the positions of its points for each species and year
+        '''
+        species = None if species is None else set(species)
+        return [tree for (tree_species, year), tree in self.trees.items()
+                if (species is None or tree_species in species) and (start is None or year >= start[0])
+                and (end is None or year <= end[0])]
+
+    def in_months(self, positions, start=None, end=None):
+        '''
+        Checks which of the rows at the positions are between the start and end months
+        '''
+        months = self.months[positions]
+        keep = np.ones(len(positions), dtype=bool)
+        if start is not None:
+            keep &= months >= start[0] * 12 + start[1]
+        if end is not None:
+            keep &= months <= end[0] * 12 + end[1]
+        return keep
+
+    def search_box(self, min_lat, min_lon, max_lat, max_lon, species=None, start=None, end=None):
+        '''
+        Finds the positions of the sightings inside a bounding box, see bbox()
+        '''
+        # search the square around the center of the box that covers it and keep the points inside the box
+        low, high = self.project([min_lat, max_lat], [min_lon, max_lon]).T
+        center = (low + high) / 2
+        radius = (high - low).max() / 2
+        positions = [tree_positions[tree.query_ball_point(center, radius, p=np.inf, return_sorted=False)]
+                     for tree, tree_positions in self.get_trees(species, start, end)]
+        positions = np.concatenate(positions + [np.zeros(0, dtype=np.int64)])
+        positions = positions[(self.lat[positions] >= min_lat) & (self.lat[positions] <= max_lat) &
+                              (self.lon[positions] >= min_lon) & (self.lon[positions] <= max_lon)]
+        return np.sort(positions[self.in_months(positions, start, end)])
+
+    def bbox(self, min_lat, min_lon, max_lat, max_lon, species=None, start=None, end=None):
+        '''
+        Finds the sightings inside a bounding box
+
+        Inputs:
+            - min_lat (float) - The southern edge of the box
+            - min_lon (float) - The western edge of the box
+            - max_lat (float) - The northern edge of the box
+            - max_lon (float) - The eastern edge of the box
+            - species (list) - The species to search, every species if not given
+            - start (tuple) - The first (year, month) to search, from the first sighting if not given
+            - end (tuple) - The last (year, month) to search, up to the last sighting if not given
+
+        Returns:
+            - ids (np.ndarray) - The index labels of the matching rows in dataframe order
+        '''
+        return self.ids[self.search_box(min_lat, min_lon, max_lat, max_lon, species, start, end)]
+
+    def radius(self, lat, lon, radius_km, species=None, start=None, end=None):
+        '''
+        Finds the sightings within a distance of a point
+
+        Inputs:
+            - lat (float) - The latitude of the point
+            - lon (float) - The longitude of the point
+            - radius_km (float) - The distance in km
+            - species (list) - The species to search, every species if not given
+            - start (tuple) - The first (year, month) to search, from the first sighting if not given
+            - end (tuple) - The last (year, month) to search, up to the last sighting if not given
+
+        Returns:
+            - ids (np.ndarray) - The index labels of the matching rows in dataframe order
+        '''
+        center = self.project(lat, lon)
+        positions = [tree_positions[tree.query_ball_point(center, radius_km, return_sorted=False)]
+                     for tree, tree_positions in self.get_trees(species, start, end)]
+        positions = np.concatenate(positions + [np.zeros(0, dtype=np.int64)])
+        return self.ids[np.sort(positions[self.in_months(positions, start, end)])]
+
+    def polygon(self, polygon, species=None, start=None, end=None):
+        '''
+        Finds the sightings inside a polygon
+
+        Inputs:
+            - polygon (list) - The (latitude, longitude) of each vertex of the polygon
+            - species (list) - The species to search, every species if not given
+            - start (tuple) - The first (year, month) to search, from the first sighting if not given
+            - end (tuple) - The last (year, month) to search, up to the last sighting if not given
+
+        Returns:
+            - ids (np.ndarray) - The index labels of the matching rows in dataframe order
+        '''
+        # find the sightings in the bounding box of the polygon and keep the ones inside it
+        vertices = np.asarray(polygon, dtype=np.float64)
+        (min_lat, min_lon), (max_lat, max_lon) = vertices.min(axis=0), vertices.max(axis=0)
+        positions = self.search_box(min_lat, min_lon, max_lat, max_lon, species, start, end)
+        return self.ids[positions[points_in_polygon(self.lat[positions], self.lon[positions], vertices)]]
+
+    def nearest(self, lat, lon, k=1, species=None, start=None, end=None):
+        '''
+        Finds the k sightings closest to a point
+
+        Inputs:
+            - lat (float) - The latitude of the point
+            - lon (float) - The longitude of the point
+            - k (int) - The number of sightings to find
+            - species (list) - The species to search, every species if not given
+            - start (tuple) - The first (year, month) to search, from the first sighting if not given
+            - end (tuple) - The last (year, month) to search, up to the last sighting if not given
+
+        Returns:
+            - ids (np.ndarray) - The index labels of the closest rows, closest first
+            - distances (np.ndarray) - The distance to each row in km
+        '''
+        center = self.project(lat, lon)
+        candidates = [(np.zeros(0), np.zeros(0, dtype=np.int64))]
+        for tree, tree_positions in self.get_trees(species, start, end):
+            # ask each tree for more points until k of them are in the months of the query or the tree runs out of points
+            num = min(k, tree.n)
+            while True:
+                distances, idx = tree.query(center, k=num)
+                distances, idx = np.atleast_1d(distances), np.atleast_1d(idx)
+                positions = tree_positions[idx]
+                keep = self.in_months(positions, start, end)
+                if keep.sum() >= k or num == tree.n:
+                    break
+                num = min(num * 4, tree.n)
+            candidates.append((distances[keep][:k], positions[keep][:k]))
+
+        distances = np.concatenate([distances for distances, _ in candidates])
+        positions = np.concatenate([positions for _, positions in candidates])
+        order = np.lexsort((positions, distances))[:k]
+        return self.ids[positions[order]], distances[order]
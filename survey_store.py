@@ -0,0 +1,263 @@
+import json
+import os
+import sys
+import numpy as np
+import pandas as pd
+from sklearn.preprocessing import StandardScaler
+from data_loader import DATA_PATH, CACHE_DIR, file_hash, load_survey, load_clean_survey, read_cache, write_cache, write_json
+import non_dl as ndl
+
+# the directory of the append-only store of cleaned survey rows
+STORE_DIR = './data/store'
+
+# the raw columns the lag features are computed from, and the raw column the rows are grouped by
+LAG_SOURCE_COLUMNS = ['LATITUDE', 'LONGITUDE', 'NUMBER']
+
+# the columns that are not inputs of the StandardScaler fit by scale_inputs()
+SCALER_DROP_COLUMNS = ['ID', 'LATITUDE', 'LONGITUDE', 'NUMBER']
+
+def get_column_stats(df):
+    '''
+    Gets the running statistics of every column: the number of rows, and the number, mean and sum of squared deviations from the
+    mean (M2) of the values that aren't Nan
+
+    Inputs:
+        - df (pd.Dataframe) - The cleaned rows
+
+    Returns:
+        - stats (dict) - The number of rows and the count, mean and M2 of each column
+    '''
+    values = df.to_numpy(dtype=np.float64)
+    count = np.sum(~np.isnan(values), axis=0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.nansum(values, axis=0) / count
+    m2 = np.nansum((values - mean) ** 2, axis=0)
+    return {'rows': len(df), 'count': count.tolist(), 'mean': mean.tolist(), 'm2': m2.tolist()}
+
+def merge_column_stats(a, b):
+    '''
+    Combines the running statistics of two sets of rows as if they were computed over both at once (Chan et al.)
+
+    Inputs:
+        - a (dict) - The statistics of the first rows from get_column_stats()
+        - b (dict) - The statistics of the second rows
+
+    Returns:
+        - stats (dict) - The statistics of both
+    '''
+    count_a, count_b = np.array(a['count'], dtype=np.float64), np.array(b['count'], dtype=np.float64)
+    mean_a, mean_b = np.nan_to_num(np.array(a['mean'])), np.nan_to_num(np.array(b['mean']))
+    count = count_a + count_b
+    delta = mean_b - mean_a
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.where(count > 0, mean_a + delta * count_b / count, np.nan)
+        m2 = np.array(a['m2']) + np.array(b['m2']) + np.where(count > 0, delta ** 2 * count_a * count_b / count, 0)
+    return {'rows': a['rows'] + b['rows'], 'count': count.astype(int).tolist(), 'mean': mean.tolist(), 'm2': m2.tolist()}
+
+def get_species_tails(raw):
+    '''
+    Gets the last 2 rows of each species (as written in the workbook) with the columns the lags are computed from, which is all
+    clean_df() needs from earlier surveys to compute the lags of the rows of a new one
+
+    Inputs:
+        - raw (pd.Dataframe) - The raw rows in survey order
+
+    Returns:
+        - tails (pd.Dataframe) - The SPECIES and lag source columns of the last 2 rows of each species in survey order
+    '''
+    rows = raw[['SPECIES'] + LAG_SOURCE_COLUMNS].dropna(subset=['SPECIES'])
+    return rows.groupby('SPECIES', sort=False).tail(2).reset_index(drop=True)
+
+def read_state(store_dir):
+    '''
+    Reads the state of a store, which holds the categories of the rows and lists its parts each with the dtypes and running
+    statistics of the store once the part was added
+    '''
+    with open(os.path.join(store_dir, 'state.json')) as f:
+        return json.load(f)
+
+def create_store(data=DATA_PATH, store_dir=STORE_DIR, cache_dir=CACHE_DIR):
+    '''
+    Creates the store from a full workbook: the cleaned rows become the first part, and the species and stratum categories are
+    fixed so every survey ingested later is encoded with the same columns
+
+    Inputs:
+        - data (str or pd.Dataframe) - The path of the workbook, or the raw rows
+        - store_dir (str) - The directory of the store
+        - cache_dir (str) - The directory of the workbook caches
+
+    Returns:
+        - state (dict) - The state of the new store
+    '''
+    if isinstance(data, str):
+        raw = load_survey(data, cache_dir)
+        cleaned = load_clean_survey(data, cache_dir=cache_dir)
+        sources = [file_hash(data, cache_dir)]
+    else:
+        raw = data
+        cleaned = ndl.clean_df(data.copy())
+        sources = []
+
+    write_cache(os.path.join(store_dir, 'part-00000.feather'), cleaned)
+    write_cache(os.path.join(store_dir, 'tails-00000.feather'), get_species_tails(raw))
+
+    # the state is written last so the store only changes once every file of the part is in place
+    state = {
+        'columns': list(cleaned.columns),
+        'species_categories': [col.replace('SPECIES_', '') for col in cleaned.columns if col.startswith('SPECIES_')],
+        'stratum_categories': [col.replace('STRATUM_', '') for col in cleaned.columns if col.startswith('STRATUM_')],
+        'parts': [{'file': 'part-00000.feather', 'dtypes': {col: str(dtype) for col, dtype in cleaned.dtypes.items()},
+                   'stats': get_column_stats(cleaned)}],
+        'tails': 'tails-00000.feather',
+        'sources': sources
+    }
+    write_json(os.path.join(store_dir, 'state.json'), state)
+
+    return state
+
+def clean_new_rows(raw, state, tails):
+    '''
+    Cleans the rows of a new survey with the fixed categories of the store and computes their lags from the last rows of each species
+    in the store, giving the same rows as cleaning the whole history again
+
+    Inputs:
+        - raw (pd.Dataframe) - The raw rows of the new survey
+        - state (dict) - The state of the store
+        - tails (pd.Dataframe) - The last rows of each species in the store from get_species_tails()
+
+    Returns:
+        - cleaned (pd.Dataframe) - The cleaned rows
+        - tails (pd.Dataframe) - The last rows of each species including the new rows
+    '''
+    # the one-hot encoded columns are fixed, so a species or stratum the store hasn't seen needs the store to be created again
+    for col, categories in [('SPECIES', state['species_categories']), ('STRATUM', state['stratum_categories'])]:
+        unknown = set(raw[col].dropna().str.lower()) - set(categories)
+        if unknown:
+            raise ValueError(f'The new rows have {col} values that are not in the store: {sorted(unknown)}')
+
+    cleaned = ndl.clean_df(raw.copy(), state['species_categories'], state['stratum_categories'])
+    if list(cleaned.columns) != state['columns']:
+        raise ValueError('The new rows do not have the columns of the store')
+
+    # compute the lags of the new rows after the last rows of each species in the store
+    combined = pd.concat([tails, raw[['SPECIES'] + LAG_SOURCE_COLUMNS]], ignore_index=True)
+    grouped = combined.groupby('SPECIES')[LAG_SOURCE_COLUMNS]
+    lag_1 = grouped.shift(1).iloc[len(tails):]
+    lag_2 = grouped.shift(2).iloc[len(tails):]
+    for lag, (lat, lon, count) in [(lag_1, ('lat_lag1', 'lon_lag1', 'count_lag1')), (lag_2, ('lat_lag2', 'lon_lag2', 'count_lag2'))]:
+        cleaned[lat] = lag['LATITUDE'].to_numpy()
+        cleaned[lon] = lag['LONGITUDE'].to_numpy()
+        cleaned[count] = lag['NUMBER'].to_numpy()
+
+    return cleaned, get_species_tails(combined)
+
+def ingest_survey(new_data, store_dir=STORE_DIR, cache_dir=CACHE_DIR):
+    '''
+    Appends the rows of a new survey to the store. Only the new rows are read and cleaned, their lags come from the last rows of
+    each species in the store and the running statistics are updated with the new rows, so the cost of an ingest depends on the
+    size of the new survey and not on the size of the history.
+
+    Inputs:
+        - new_data (str or pd.Dataframe) - The path of a workbook with only the new rows, or the raw new rows
+        - store_dir (str) - The directory of the store
+        - cache_dir (str) - The directory of the workbook caches
+
+    Returns:
+        - num_rows (int) - The number of rows appended, 0 if the workbook was already ingested
+    '''
+    state = read_state(store_dir)
+
+    if isinstance(new_data, str):
+        source = file_hash(new_data, cache_dir)
+        if source in state['sources']:
+            print(f'{new_data} is already in the store')
+            return 0
+        raw = load_survey(new_data, cache_dir)
+    else:
+        source = None
+        raw = new_data
+
+    tails = read_cache(os.path.join(store_dir, state['tails']))
+    cleaned, tails = clean_new_rows(raw, state, tails)
+
+    # write the part and the new tails before the state so a failed ingest leaves the store as it was
+    num = len(state['parts'])
+    part_name, tails_name = f'part-{num:05d}.feather', f'tails-{num:05d}.feather'
+    write_cache(os.path.join(store_dir, part_name), cleaned)
+    write_cache(os.path.join(store_dir, tails_name), tails)
+
+    # widen the dtype of a column if the new rows need it (e.g. Nan values in a column that was all integers)
+    last_part = state['parts'][-1]
+    part = {'file': part_name,
+            'dtypes': {col: str(np.result_type(np.dtype(dtype), cleaned[col].dtype)) for col, dtype in last_part['dtypes'].items()},
+            'stats': merge_column_stats(last_part['stats'], get_column_stats(cleaned))}
+
+    old_tails = state['tails']
+    state = {**state, 'parts': state['parts'] + [part], 'tails': tails_name,
+             'sources': state['sources'] + ([source] if source is not None else [])}
+    write_json(os.path.join(store_dir, 'state.json'), state)
+    os.remove(os.path.join(store_dir, old_tails))
+
+    return len(cleaned)
+
+def load_store(store_dir=STORE_DIR, num_parts=None):
+    '''
+    Loads the cleaned rows of the store, memory-mapping each part
+
+    Inputs:
+        - store_dir (str) - The directory of the store
+        - num_parts (int) - The number of parts to load, every part if not given (e.g. one less for the rows before the last ingest)
+
+    Returns:
+        - df (pd.Dataframe) - The cleaned rows in the order they were ingested, with the dtypes the store had after the last part loaded
+    '''
+    parts = read_state(store_dir)['parts'][:num_parts]
+    dtypes = parts[-1]['dtypes']
+    return pd.concat([read_cache(os.path.join(store_dir, part['file'])).astype(dtypes) for part in parts], ignore_index=True)
+
+def get_store_means(state, num_parts=None):
+    '''
+    Returns the mean of every column of the first num_parts parts of the store (every part if not given) from its running
+    statistics, the same as df.mean() of load_store()
+    '''
+    return pd.Series(state['parts'][:num_parts][-1]['stats']['mean'], index=state['columns'])
+
+def get_store_scaler(state, num_parts=None):
+    '''
+    Builds the StandardScaler that scale_inputs() would fit on the rows of the first num_parts parts of the store (every part if not
+    given) with their Nan values filled with the column means, from the running statistics instead of a pass over every row. Filled
+    values sit on the mean so they add rows without adding to the sum of squared deviations.
+
+    Inputs:
+        - state (dict) - The state of the store
+        - num_parts (int) - The number of parts to build the scaler of
+
+    Returns:
+        - scaler (StandardScaler) - The fitted scaler
+    '''
+    stats = state['parts'][:num_parts][-1]['stats']
+    columns = [col for col in state['columns'] if col not in SCALER_DROP_COLUMNS]
+    idx = [state['columns'].index(col) for col in columns]
+
+    scaler = StandardScaler()
+    scaler.mean_ = np.array(stats['mean'])[idx]
+    scaler.var_ = np.array(stats['m2'])[idx] / stats['rows']
+    scaler.scale_ = np.sqrt(scaler.var_)
+    scaler.scale_[scaler.scale_ < 10 * np.finfo(np.float64).eps] = 1.0
+    scaler.n_samples_seen_ = stats['rows']
+    scaler.n_features_in_ = len(columns)
+    scaler.feature_names_in_ = np.array(columns, dtype=object)
+    return scaler
+
+def main(new_paths=()):
+    # create the store from the full workbook the first time
+    if not os.path.exists(os.path.join(STORE_DIR, 'state.json')):
+        print(f'Creating the store from {DATA_PATH}')
+        create_store()
+
+    for path in new_paths:
+        print(f'Ingesting {path}')
+        print(f'Appended {ingest_survey(path)} rows')
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,97 @@
+import datetime
+import os
+import sys
+import numpy as np
+import pandas as pd
+import pytest
+import torch
+from sklearn.ensemble import GradientBoostingRegressor
+from sklearn.preprocessing import StandardScaler
+
+# the modules of the repository are imported from its root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from non_dl import clean_df
+from script_lstm import LSTMModel, SEQUENCE_WINDOW
+
+MONTHS = ['January', 'February', 'March', 'April', 'May', 'June', 'July', 'August', 'September', 'October', 'November', 'December']
+
+def make_survey(num_rows=1200, years=(2016, 2018, 2020, 2022), seed=0):
+    '''
+    Makes a synthetic survey with the columns and mixed value types of the workbook (dates as datetimes, strings, day numbers or
+    missing and times as datetime.time or missing), sorted by year like the workbook
+
+    Inputs:
+        - num_rows (int) - The number of sightings
+        - years (tuple) - The survey years the sightings are spread over
+        - seed (int) - The seed of the random values
+
+    Returns:
+        - df (pd.Dataframe) - The raw survey
+    '''
+    rng = np.random.default_rng(seed)
+    count = np.sort(rng.choice(years, num_rows))
+
+    dates = []
+    for year in count:
+        kind, day = rng.random(), int(rng.integers(1, 28))
+        if kind < 0.5:
+            dates.append(datetime.datetime(int(year), 7, day))
+        elif kind < 0.7:
+            dates.append(f'7/{day}/{year}')
+        elif kind < 0.9:
+            dates.append(float(day))
+        else:
+            dates.append(np.nan)
+    times = [datetime.time(int(rng.integers(6, 18)), int(rng.integers(0, 60)), int(rng.integers(0, 60))) if rng.random() < 0.9 else np.nan
+             for _ in range(num_rows)]
+
+    df = pd.DataFrame({
+        'ID': np.arange(1, num_rows + 1), 'COUNT': count, 'MONTH': rng.choice(MONTHS[5:9], num_rows),
+        'DATE': pd.Series(dates, dtype=object), 'TIME': pd.Series(times, dtype=object),
+        'TYPE': rng.choice(['Fixed-wing', 'Helicopter'], num_rows), 'SESSION': rng.integers(1, 4, num_rows),
+        'SPECIES': rng.choice(['Buffalo', 'Elephant', 'Zebra', 'Waterbuck', 'Sable', 'Kudu', 'eland'], num_rows),
+        'STRATUM': rng.choice(['North', 'Central', 'West', 'east'], num_rows),
+        'NUMBER': rng.integers(1, 40, num_rows).astype(float),
+        'LATITUDE': -18.8 + rng.normal(0, 0.1, num_rows), 'LONGITUDE': 34.4 + rng.normal(0, 0.1, num_rows),
+        'MALE': np.nan, 'CALVES': np.nan, 'LINE2002': 0, 'LINE2012': 0, 'COLLAR': 0, 'CONSERVANC': 0, 'SANCTUARY': 0, 'NOTES': None,
+        'LINE2014': rng.integers(0, 30, num_rows), 'IN_STRIP': rng.integers(0, 2, num_rows), 'RIFTVALLEY': rng.integers(0, 2, num_rows),
+    })
+    df.loc[rng.random(num_rows) < 0.02, 'LATITUDE'] = np.nan
+    df.loc[rng.random(num_rows) < 0.02, 'NUMBER'] = np.nan
+    return df
+
+def make_models(train_df, seed=0, window=SEQUENCE_WINDOW):
+    '''
+    Makes small forecasting models for train_df: an untrained LSTM reading windows of window rows for the number of animals and
+    gradient boosting models with a few trees for the latitude and longitude, so the forecast can be run without the cost of
+    training the real models
+    '''
+    torch.manual_seed(seed)
+    X = train_df.drop(columns=['ID', 'LATITUDE', 'LONGITUDE', 'NUMBER'])
+    scaler = StandardScaler().fit(X)
+    X_scaled = scaler.transform(X)
+
+    num_model = LSTMModel(X.shape[1], 16, 2, 1, window)
+    num_model.eval()
+    return {
+        'num_model': [num_model, scaler],
+        'lat_model': [GradientBoostingRegressor(n_estimators=5, random_state=seed).fit(X_scaled, train_df['LATITUDE']), scaler],
+        'long_model': [GradientBoostingRegressor(n_estimators=5, random_state=seed).fit(X_scaled, train_df['LONGITUDE']), scaler]
+    }
+
+@pytest.fixture
+def raw_df():
+    return make_survey()
+
+@pytest.fixture
+def cleaned_df(raw_df):
+    return clean_df(raw_df.copy())
+
+@pytest.fixture
+def train_df(cleaned_df):
+    return cleaned_df.fillna(cleaned_df.mean())
+
+@pytest.fixture
+def models(train_df):
+    return make_models(train_df)
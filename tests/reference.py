@@ -0,0 +1,172 @@
+from datetime import datetime
+import numpy as np
+import pandas as pd
+import torch
+
+def process_date(val):
+    '''
+    The original per-element conversion of a DATE value to the day of the month, used by reference_clean_df()
+    '''
+    if pd.isna(val):
+        return np.nan
+    elif isinstance(val, str):
+        return float(val.split('/')[1])
+    elif isinstance(val, datetime):
+        return val.day
+    else:
+        return float(val)
+
+def reference_clean_df(df):
+    '''
+    The original per-element implementation of clean_df kept as the reference for parity checks
+
+    Inputs:
+        - df (pd.Dataframe) - The original dataframe
+
+    Returns:
+        - df (pd.Dataframe) - The cleaned dataframe
+    '''
+    month_mapping = {
+    'January': 1, 'February': 2, 'March': 3, 'April': 4,
+    'May': 5, 'June': 6, 'July': 7, 'August': 8,
+    'September': 9, 'October': 10, 'November': 11, 'December': 12
+    }
+
+    df.drop(columns=['MALE', 'CALVES'], inplace=True)
+    df.drop(columns=['LINE2002', 'LINE2012', 'COLLAR', 'CONSERVANC', 'SANCTUARY'], inplace=True)
+    df.drop(columns=['NOTES'], inplace=True)
+
+    df['TIME'] = df['TIME'].apply(lambda x: x.hour * 3600 + x.minute * 60 + x.second if pd.notna(x) else x)
+    df['TIME'] = df['TIME'].fillna(0)
+    df['TYPE'] = df['TYPE'].map({'Fixed-wing': 0, 'Helicopter': 1})
+    df['DATE'] = df['DATE'].apply(process_date)
+    df['MONTH'] = df['MONTH'].map(month_mapping)
+    df['MONTH'] = pd.to_numeric(df['MONTH'], errors='coerce')
+
+    df['lat_lag1'] = df.groupby('SPECIES')['LATITUDE'].shift(1)
+    df['lon_lag1'] = df.groupby('SPECIES')['LONGITUDE'].shift(1)
+    df['lat_lag2'] = df.groupby('SPECIES')['LATITUDE'].shift(2)
+    df['lon_lag2'] = df.groupby('SPECIES')['LONGITUDE'].shift(2)
+    df['count_lag1'] = df.groupby('SPECIES')['NUMBER'].shift(1)
+    df['count_lag2'] = df.groupby('SPECIES')['NUMBER'].shift(2)
+
+    df['SPECIES'] = df['SPECIES'].str.lower()
+    df['STRATUM'] = df['STRATUM'].str.lower()
+    df = pd.get_dummies(df, columns=['SPECIES', 'STRATUM'])
+
+    return df
+
+def get_output_years(cleaned_df, num_years):
+    '''
+    Stands in for the survey followed by a forecast by repeating the last survey year
+
+    Inputs:
+        - cleaned_df (pd.Dataframe) - The cleaned dataframe
+        - num_years (int) - The number of copies of the last survey year to append as forecast years
+
+    Returns:
+        - years (list) - The survey followed by a dataframe for each forecast year
+        - species (list) - The species of the one-hot encoded species columns in sorted order
+    '''
+    last_year = cleaned_df['COUNT'].max()
+    last = cleaned_df[cleaned_df['COUNT'] == last_year]
+    years = [cleaned_df] + [last.assign(COUNT=last_year + i) for i in range(1, num_years + 1)]
+    species = sorted(col.replace('SPECIES_', '') for col in cleaned_df.columns if col.startswith('SPECIES_'))
+    return years, species
+
+def reference_final_predict(model, scaler, row):
+    '''
+    The original script_lstm.final_predict, which scales the row, builds a new tensor and runs the model while recording autograd
+    '''
+    row_tensor = torch.FloatTensor(scaler.transform(row)).unsqueeze(1)
+    model.eval()
+    return model(row_tensor).detach().numpy()
+
+def reference_future_predictions(df, models, last_year=2022):
+    '''
+    The original per-row implementation of animal_migration.get_future_predictions kept as the reference for parity checks, with
+    the number model read one row at a time like reference_final_predict()
+
+    Inputs:
+        - df (pd.Dataframe) - The dataframe to generate the predictions from
+        - models (dict) - A dictionary for the model to predict the number of animals, the latitude and the longitude each with their
+                          own scaler
+        - last_year (int) - The previous year to use as a baseline and create synthetic data from
+
+    Returns:
+        - combined_df (pd.Dataframe) - The original dataframe that also contains the synthetic data
+    '''
+    past_year = df[df['COUNT'] == last_year].copy()
+
+    past_year['timestamp'] = pd.to_datetime(past_year['TIME'], unit='s').dt.strftime('%H:%M:%S')
+    past_year['timestamp'] = pd.to_datetime(
+        past_year['COUNT'].astype(int).astype(str) + '-' +
+        past_year['MONTH'].astype(int).astype(str).str.zfill(2) + '-' +
+        past_year['DATE'].astype(float).astype(int).astype(str).str.zfill(2) + ' ' +
+        past_year['timestamp']
+    )
+
+    species_columns = [col for col in df.columns if col.startswith('SPECIES_')]
+    past_year['species'] = past_year[species_columns].idxmax(axis=1).str.replace('SPECIES_', '')
+
+    future_rows = past_year.copy()
+    future_rows['COUNT'] = last_year + 1
+    last_id = past_year['ID'].max()
+    future_rows['ID'] = (future_rows.index - future_rows.index[0]) + 1 + last_id
+
+    grouped = future_rows.groupby('species')
+    out_df = future_rows.copy()
+    out_df = out_df.drop(columns=['timestamp', 'species'])
+
+    for _, group in grouped:
+        last_lat, last_long, last_count = 0, 0, 0
+        last_lat_2, last_long_2, last_count_2 = 0, 0, 0
+
+        if len(group) >= 1:
+            last_lat = group.iloc[-1]['LATITUDE']
+            last_long = group.iloc[-1]['LONGITUDE']
+            last_count = group.iloc[-1]['NUMBER']
+
+            if len(group) >= 2:
+                last_lat_2 = group.iloc[-2]['LATITUDE']
+                last_long_2 = group.iloc[-2]['LONGITUDE']
+                last_count_2 = group.iloc[-2]['NUMBER']
+
+        # the original loop never advanced i, so every row is seeded from the last 2 rows of the previous year
+        i = 0
+        for row_idx, row in group.iterrows():
+            if i == 0:
+                row['lat_lag1'] = last_lat
+                row['lon_lag1'] = last_long
+                row['count_lag1'] = last_count
+                row['lat_lag2'] = last_lat_2
+                row['lon_lag2'] = last_long_2
+                row['count_lag2'] = last_count_2
+            else:
+                row['lat_lag1'] = future_rows.loc[row_idx-1, 'LATITUDE']
+                row['lon_lag1'] = future_rows.loc[row_idx-1, 'LONGITUDE']
+                row['count_lag1'] = future_rows.loc[row_idx-1, 'NUMBER']
+                row['lat_lag2'] = future_rows.loc[row_idx-1, 'lat_lag1']
+                row['lon_lag2'] = future_rows.loc[row_idx-1, 'lon_lag1']
+                row['count_lag2'] = future_rows.loc[row_idx-1, 'count_lag1']
+
+            row['LATITUDE'] = np.nan
+            row['LONGITUDE'] = np.nan
+            row['NUMBER'] = np.nan
+
+            curr_row_df = row.to_frame().T
+            curr_row = curr_row_df.drop(columns=['ID', 'timestamp', 'species', 'LATITUDE', 'LONGITUDE', 'NUMBER'])
+
+            num_pred = reference_final_predict(models['num_model'][0], models['num_model'][1], curr_row)
+            lat_pred = models['lat_model'][0].predict(models['lat_model'][1].transform(curr_row))
+            long_pred = models['long_model'][0].predict(models['long_model'][1].transform(curr_row))
+
+            row['NUMBER'] = np.round(num_pred[0, 0])
+            row['LATITUDE'] = lat_pred[0]
+            row['LONGITUDE'] = long_pred[0]
+
+            row = row.drop(labels=['timestamp', 'species'])
+            out_df.loc[row_idx] = row
+
+    combined_df = pd.concat([df, out_df], ignore_index=True)
+    return combined_df
@@ -0,0 +1,25 @@
+from datetime import datetime, time
+import numpy as np
+import pandas as pd
+from reference import process_date, reference_clean_df
+from non_dl import clean_df, convert_date, convert_time
+from conftest import make_survey
+
+def test_clean_df_matches_reference(raw_df):
+    # the vectorized output must be identical to the reference output including dtypes and column order
+    pd.testing.assert_frame_equal(clean_df(raw_df.copy()), reference_clean_df(raw_df.copy()))
+
+def test_clean_df_matches_reference_on_repeated_survey():
+    # repeating the survey repeats the same TIME and DATE values many times
+    df = pd.concat([make_survey(seed=1)] * 3, ignore_index=True)
+    pd.testing.assert_frame_equal(clean_df(df.copy()), reference_clean_df(df.copy()))
+
+def test_convert_mixed_columns():
+    # a TIME column read back from the cache mixes strings, the timedeltas the times of day were stored as and Nan values
+    times = pd.Series(['10:30:05', pd.Timedelta(hours=7, minutes=1, seconds=2), np.nan, time(6, 0, 9, 500), None,
+                       datetime(2002, 7, 15, 13, 0, 2), '0 days 08:15:00'], dtype=object)
+    pd.testing.assert_series_equal(convert_time(times), pd.Series([37805.0, 25262.0, 0.0, 21609.0, 0.0, 46802.0, 29700.0]))
+
+    # every kind of DATE value is converted as specified in process_date()
+    dates = pd.Series(['7/15/2002', datetime(2004, 3, 9), np.nan, 12, 3.0, '11/2/1998'], dtype=object)
+    pd.testing.assert_series_equal(convert_date(dates), dates.apply(process_date))
@@ -0,0 +1,30 @@
+import numpy as np
+import torch
+from non_dl import get_cv_fold, load_cv_fold
+from tuning import get_fold_windows
+
+def test_cached_fold_is_memory_mapped(cleaned_df, tmp_path):
+    expected = get_cv_fold(cleaned_df, [], 2018)
+    cached = load_cv_fold(get_cv_fold(cleaned_df, [], 2018, cache_dir=str(tmp_path)))
+
+    # every array of the cached fold is read from its own file without loading it into memory
+    assert set(cached) == set(expected)
+    for name, values in cached.items():
+        assert isinstance(values, np.memmap)
+        np.testing.assert_array_equal(values, expected[name])
+
+def test_validation_windows_only_hold_earlier_years(cleaned_df):
+    fold = get_cv_fold(cleaned_df, [], 2018)
+    # replace the inputs with the year of each row to see which years every window holds
+    years = cleaned_df['COUNT'].to_numpy(dtype=float)
+    fold['X_train'] = years[~cleaned_df['COUNT'].isin([2022, 2018]).to_numpy()][:, None]
+    fold['X_test'] = years[(cleaned_df['COUNT'] == 2018).to_numpy()][:, None]
+    train_windows, test_windows = get_fold_windows(fold, 4)
+
+    for windows, rows in [(test_windows, fold['X_test']), (train_windows, fold['X_train'])]:
+        x, lengths = windows[torch.arange(len(windows))]
+        real = windows.mask()
+        # the last row of every window is the row itself and the rows before it are from the same or earlier years
+        np.testing.assert_array_equal(x[:, -1, 0].numpy(), rows[:, 0])
+        assert (x[..., 0][real] <= x[:, -1:, 0].expand_as(real)[real]).all()
+    assert (test_windows.lengths > 1).any()
@@ -0,0 +1,56 @@
+import copy
+import os
+import subprocess
+import sys
+import joblib
+import numpy as np
+import pandas as pd
+import torch
+from animal_migration import get_future_predictions, iter_future_predictions
+from conftest import make_models
+from script_lstm import final_predict_windows, get_final_windows
+from model_store import model_fingerprint
+from reference import reference_future_predictions
+
+def test_cached_forecast_matches_uncached(train_df, models, tmp_path):
+    def forecast(num_years, cache_dir=None):
+        return pd.concat(iter_future_predictions(train_df, models, num_years, cache_dir=cache_dir), ignore_index=True)
+
+    expected = forecast(4)
+    cache_dir = str(tmp_path)
+
+    # a cold cache, a warm cache and a cache extended by more years all give the rows of the uncached forecast
+    pd.testing.assert_frame_equal(forecast(2, cache_dir), expected.iloc[:len(forecast(2))])
+    pd.testing.assert_frame_equal(forecast(2, cache_dir), expected.iloc[:len(forecast(2))])
+    pd.testing.assert_frame_equal(forecast(4, cache_dir), expected)
+
+def test_model_fingerprint_matches_in_next_run(models, tmp_path):
+    # the next run loads the models in a new process, where the cache must find the forecast of the run that trained them
+    path = str(tmp_path / 'models.joblib')
+    joblib.dump(models, path)
+    code = f'import joblib; from model_store import model_fingerprint; print(model_fingerprint(joblib.load({path!r})))'
+    repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    run = subprocess.run([sys.executable, '-c', code], cwd=repo_dir, capture_output=True, text=True, check=True)
+    assert run.stdout.strip() == model_fingerprint(models)
+
+def test_batched_forecast_matches_per_row_reference(train_df):
+    # with single row windows the batched forecast of a year reproduces the original per-row loop
+    models = make_models(train_df, window=1)
+    expected = reference_future_predictions(train_df, models)
+    pd.testing.assert_frame_equal(get_future_predictions(train_df, models), expected)
+
+def test_forecast_reads_training_windows(train_df, models):
+    # scale up the output of the untrained number model so the rounded predictions differ between rows
+    num_model, scaler = copy.deepcopy(models['num_model'][0]), models['num_model'][1]
+    with torch.no_grad():
+        num_model.fc.weight.mul_(1000)
+    models = {**models, 'num_model': [num_model, scaler]}
+
+    # the number of animals of a forecast year is predicted from the windows the model would read with the year appended to the survey
+    year_df = next(iter_future_predictions(train_df, models, 1))
+    combined = pd.concat([train_df, year_df], ignore_index=True)
+    expected = final_predict_windows(num_model, get_final_windows(combined, scaler, num_model.window), np.arange(len(train_df), len(combined)))
+
+    # the predictions may only round differently at the float32 precision of the two paths
+    assert np.abs(expected[:, 0]).max() > 10
+    np.testing.assert_allclose(year_df['NUMBER'].to_numpy(), np.round(expected[:, 0]), atol=1)
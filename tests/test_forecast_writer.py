@@ -0,0 +1,61 @@
+import numpy as np
+import pandas as pd
+import pytest
+from reference import get_output_years
+from forecast_writer import BinarySink, CSVSink, ForecastWriter, IndexedPartitionSink, MultiSink, make_sink, read_binary, read_partitions
+
+def write_outputs(years, species, sinks):
+    with ForecastWriter(MultiSink(sinks), species) as writer:
+        for year in years:
+            writer.write(year)
+
+def test_make_sink_writes_binary_output(cleaned_df, tmp_path):
+    years, species = get_output_years(cleaned_df, 1)
+    binary_path = str(tmp_path / 'out.bin')
+    write_outputs(years, species, [make_sink(binary_path, species)])
+    records, header = read_binary(binary_path)
+    assert header['species'] == species and len(records) == sum(len(year) for year in years)
+    del records
+
+def test_read_partitions_matches_csv_scan(cleaned_df, tmp_path):
+    years, species = get_output_years(cleaned_df, 4)
+    csv_path, export_dir = str(tmp_path / 'out.csv'), str(tmp_path / 'out')
+    write_outputs(years, species, [CSVSink(csv_path), IndexedPartitionSink(export_dir)])
+    df = pd.read_csv(csv_path, index_col=0)
+
+    for query in [(2016, 1, 2016, 12), (2020, 7, 2023, 6), (2024, 8, 2024, 8), (2030, 1, 2030, 12)]:
+        start_year, start_month, end_year, end_month = query
+        month = df['COUNT'] * 12 + df['MONTH']
+        scanned = df[(month >= start_year * 12 + start_month) & (month <= end_year * 12 + end_month)]
+        indexed = read_partitions(export_dir, *query)
+
+        # the indexed rows are grouped by month so compare the rows in the same order
+        order = ['COUNT', 'MONTH', 'ID', 'DATE', 'TIME']
+        scanned = scanned.sort_values(order, kind='stable').reset_index(drop=True)
+        indexed = indexed.sort_values(order, kind='stable').reset_index(drop=True)
+        pd.testing.assert_frame_equal(scanned, indexed, check_dtype=False)
+
+def test_indexed_partitions_reject_a_year_written_before(cleaned_df, tmp_path):
+    sink = IndexedPartitionSink(str(tmp_path))
+    sink.write(cleaned_df[cleaned_df['COUNT'] == 2016])
+
+    # 2016 is flushed when 2018 starts in the same chunk so its rows can't be written again
+    with pytest.raises(ValueError):
+        sink.write(cleaned_df[cleaned_df['COUNT'].isin([2016, 2018])].sort_values('COUNT', ascending=False))
+
+def test_binary_records_match_csv(cleaned_df, tmp_path):
+    years, species = get_output_years(cleaned_df, 3)
+    csv_path, binary_path = str(tmp_path / 'out.csv'), str(tmp_path / 'out.bin')
+    write_outputs(years, species, [CSVSink(csv_path), BinarySink(binary_path, species)])
+    df = pd.read_csv(csv_path, index_col=0)
+    records, header = read_binary(binary_path)
+
+    # the records hold the CSV values up to float32 precision, rounded counts and sentinels for the missing values
+    assert header['species'] == species and len(records) == len(df)
+    for name, col in [('id', 'ID'), ('year', 'COUNT'), ('month', 'MONTH'), ('species', 'SPECIES')]:
+        np.testing.assert_array_equal(records[name], df[col].to_numpy())
+    for name, col in [('day', 'DATE'), ('seconds', 'TIME'), ('count', 'NUMBER')]:
+        np.testing.assert_array_equal(records[name], df[col].round().fillna(header['missing'][name]).to_numpy())
+    for name, col in [('latitude', 'LATITUDE'), ('longitude', 'LONGITUDE')]:
+        np.testing.assert_allclose(records[name], df[col].to_numpy(), rtol=1e-6)
+    del records
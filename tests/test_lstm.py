@@ -0,0 +1,54 @@
+import numpy as np
+import pytest
+import torch
+from sklearn.preprocessing import StandardScaler
+from script_lstm import LSTMModel, LSTMPredictor, SEQUENCE_WINDOW, final_predict, final_predict_scaled
+from sequences import SequenceWindows, get_group_tails
+from training import fit_model, get_available_cores, get_best_epoch, split_validation
+
+def test_predictor_matches_training_windows():
+    model = LSTMModel(6, 16, 2, 1, SEQUENCE_WINDOW).eval()
+    predictor = LSTMPredictor(model)
+    rng = np.random.default_rng(0)
+    survey, survey_groups = rng.standard_normal((30, 6)).astype(np.float32), rng.integers(0, 4, 30)
+    rows, groups = rng.standard_normal((40, 6)).astype(np.float32), rng.integers(0, 5, 40)
+
+    # every row sees the end of the survey and the earlier rows of its group in the batch, like the windows the model trains on
+    windows = SequenceWindows(np.concatenate([survey, rows]), np.concatenate([survey_groups, groups]), SEQUENCE_WINDOW)
+    with torch.no_grad():
+        expected = model(*windows[torch.arange(len(survey), len(windows))]).numpy()
+    history = get_group_tails(survey, survey_groups, 5, SEQUENCE_WINDOW - 1)
+    np.testing.assert_allclose(predictor.predict_scaled(rows, *history, groups), expected, rtol=1e-5, atol=1e-6)
+
+    # rows without any history are a single time step
+    np.testing.assert_allclose(predictor.predict_scaled(rows), final_predict_scaled(model, rows), rtol=1e-6)
+
+def test_predictor_scales_with_its_scaler():
+    model = LSTMModel(6, 16, 2, 1).eval()
+    rows = np.random.default_rng(0).standard_normal((20, 6)) * 5 + 3
+    scaler = StandardScaler().fit(rows)
+    np.testing.assert_allclose(LSTMPredictor(model, scaler).predict(rows), final_predict(model, scaler, rows), rtol=1e-5, atol=1e-6)
+
+    with pytest.raises(ValueError):
+        LSTMPredictor(model).predict(rows)
+
+def test_perf_mode_restores_threads():
+    # a thread count other than the available cores that perf mode trains with
+    previous = torch.get_num_threads()
+    torch.set_num_threads(get_available_cores() + 1)
+    model = LSTMModel(6, 8, 2, 1, SEQUENCE_WINDOW)
+    windows = SequenceWindows(torch.randn(32, 6), np.zeros(32, dtype=int), SEQUENCE_WINDOW)
+    fit_model(model, windows, torch.randn(32, 1), num_epochs=1, verbose=False, perf_mode=True)
+    assert torch.get_num_threads() == get_available_cores() + 1
+    torch.set_num_threads(previous)
+
+def test_validation_holds_out_latest_surveys():
+    times = np.array([2020, 2016, 2022, 2018, 2022, 2016, 2020, 2018, 2016, 2022])
+    X, y = torch.arange(10.0)[:, None], torch.arange(10.0)
+    X_train, y_train, X_val, y_val = split_validation(X, y, val_fraction=0.3, times=times)
+    assert sorted(times[y_val.long().numpy()]) == [2022, 2022, 2022]
+    assert len(X_train) == 7 and times[y_train.long().numpy()].max() <= 2020
+
+    # the refit trains for the epoch whose weights were kept, improvements smaller than min_delta don't count
+    history = [{'epoch': i + 1, 'val_loss': loss} for i, loss in enumerate([5.0, 3.0, 2.0, 1.99999, 2.5])]
+    assert get_best_epoch(history) == 3
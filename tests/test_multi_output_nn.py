@@ -0,0 +1,30 @@
+import torch
+from batching import TensorBatches
+from multi_output_nn import EnsembleMultiOutputNN, MultiOutputNN, ensemble_mse_loss
+
+def test_ensemble_members_train_on_their_own_batches():
+    torch.manual_seed(0)
+    X, y = torch.randn(64, 5), torch.randn(64, 3)
+    members = [MultiOutputNN(5) for _ in range(3)]
+    ensemble = EnsembleMultiOutputNN.from_members(members)
+    X_batch, y_batch = next(iter(TensorBatches(X, y, batch_size=16, num_members=3, generator=torch.Generator().manual_seed(0))))
+
+    # every member draws its own permutation of the rows
+    assert X_batch.shape == (3, 16, 5)
+    assert not torch.equal(X_batch[0], X_batch[1])
+
+    # one step of the ensemble moves each member like a step of the member on its own batch
+    optimizer = torch.optim.Adam(ensemble.parameters(), lr=0.01)
+    ensemble.train()
+    ensemble_mse_loss(ensemble(X_batch), y_batch).backward()
+    optimizer.step()
+
+    for m, (member, trained) in enumerate(zip(members, ensemble.to_members())):
+        optimizer = torch.optim.Adam(member.parameters(), lr=0.01)
+        member.train()
+        torch.nn.functional.mse_loss(member(X_batch[m]), y_batch[m]).backward()
+        optimizer.step()
+        trained_state = trained.state_dict()
+        for name, expected in member.state_dict().items():
+            if not name.endswith('num_batches_tracked'):
+                torch.testing.assert_close(trained_state[name], expected, rtol=1e-5, atol=1e-6)
@@ -0,0 +1,19 @@
+import numpy as np
+import pandas as pd
+from animal_migration import iter_future_predictions
+from scenarios import run_scenarios
+
+def test_noise_free_rollout_matches_forecast(train_df, models):
+    # the median of a single rollout without noise is the forecast
+    forecast = list(iter_future_predictions(train_df, models, 2))
+    rollout = list(run_scenarios(train_df, models, num_rollouts=1, num_years_to_pred=2, lag_noise=0))
+    assert len(rollout) == len(forecast)
+    for year_df, scenario_df in zip(forecast, rollout):
+        for col in ['NUMBER', 'LATITUDE', 'LONGITUDE']:
+            np.testing.assert_allclose(scenario_df[f'{col}_P50'], year_df[col], rtol=1e-6)
+
+def test_quantiles_do_not_depend_on_chunk_size(train_df, models):
+    runs = [list(run_scenarios(train_df, models, num_rollouts=8, num_years_to_pred=2, chunk_size=chunk_size)) for chunk_size in (1, 3, 8)]
+    for years in runs[1:]:
+        for year_df, expected_df in zip(years, runs[0]):
+            pd.testing.assert_frame_equal(year_df, expected_df)
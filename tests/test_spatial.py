@@ -0,0 +1,52 @@
+import numpy as np
+import pandas as pd
+from reference import get_output_years
+from forecast_writer import ForecastWriter
+from spatial import GRID_CELL_SIZES, GridSummarySink, SightingIndex, aggregate_grid, get_species, points_in_polygon
+
+def test_streamed_grid_matches_aggregate(cleaned_df, tmp_path):
+    years, species = get_output_years(cleaned_df, 3)
+    grid_path = str(tmp_path / 'grid.parquet')
+    writer = ForecastWriter(GridSummarySink(grid_path), species)
+    for year in years:
+        writer.write(year)
+    writer.close()
+    grid = pd.read_parquet(grid_path)
+
+    # the summary of the streamed chunks matches the summary of all the rows at once
+    output = pd.concat([writer.to_output(year) for year in years], ignore_index=True)
+    pd.testing.assert_frame_equal(grid, aggregate_grid(output, GRID_CELL_SIZES), rtol=1e-5)
+
+    # every zoom level keeps every sighting and animal
+    placed = output.dropna(subset=['LATITUDE', 'LONGITUDE', 'MONTH'])
+    for _, level in grid.groupby('CELL_SIZE'):
+        assert level['SIGHTINGS'].sum() == len(placed)
+        assert np.isclose(level['NUMBER'].sum(), placed['NUMBER'].sum(), rtol=1e-5)
+
+def test_index_queries_match_scans(cleaned_df):
+    # sightings drawn from the survey and spread over the survey and forecast years
+    rng = np.random.default_rng(0)
+    num_rows = 20000
+    sample = cleaned_df.dropna(subset=['LATITUDE', 'LONGITUDE']).iloc[rng.integers(0, 1000, num_rows)]
+    df = pd.DataFrame({'COUNT': rng.integers(2010, 2031, num_rows), 'MONTH': sample['MONTH'].to_numpy(),
+                       'LATITUDE': sample['LATITUDE'].to_numpy() + rng.normal(0, 0.01, num_rows),
+                       'LONGITUDE': sample['LONGITUDE'].to_numpy() + rng.normal(0, 0.01, num_rows), 'SPECIES': get_species(sample)})
+    index = SightingIndex(df)
+
+    lat, lon = df['LATITUDE'].median(), df['LONGITUDE'].median()
+    species = [df['SPECIES'].iloc[0]]
+    start, end = (2012, 7), (2020, 8)
+    polygon = [(lat - 0.1, lon - 0.1), (lat + 0.05, lon - 0.05), (lat + 0.1, lon + 0.1), (lat - 0.05, lon + 0.08)]
+
+    months = df['COUNT'] * 12 + df['MONTH']
+    in_query = df['SPECIES'].isin(species) & (months >= start[0] * 12 + start[1]) & (months <= end[0] * 12 + end[1])
+    points = index.project(df['LATITUDE'].to_numpy(), df['LONGITUDE'].to_numpy())
+    distances = pd.Series(np.sqrt(((points - index.project(lat, lon)) ** 2).sum(axis=1)), index=df.index)
+
+    in_bbox = df['LATITUDE'].between(lat - 0.05, lat + 0.05) & df['LONGITUDE'].between(lon - 0.05, lon + 0.05)
+    np.testing.assert_array_equal(index.bbox(lat - 0.05, lon - 0.05, lat + 0.05, lon + 0.05, species, start, end), df.index[in_query & in_bbox])
+    np.testing.assert_array_equal(index.radius(lat, lon, 3, species, start, end), df.index[in_query & (distances <= 3)])
+    inside = points_in_polygon(df['LATITUDE'].to_numpy(), df['LONGITUDE'].to_numpy(), polygon)
+    np.testing.assert_array_equal(index.polygon(polygon, species, start, end), df.index[in_query & inside])
+    np.testing.assert_array_equal(index.nearest(lat, lon, 10, species, start, end)[0],
+                                  distances[in_query].sort_values(kind='stable').index[:10])
@@ -0,0 +1,47 @@
+import copy
+import numpy as np
+import pandas as pd
+from sklearn.preprocessing import StandardScaler
+from non_dl import clean_df
+from animal_migration import get_model_trainers, get_store_fingerprint
+from survey_store import create_store, ingest_survey, load_store, read_state, get_store_means, get_store_scaler
+
+def test_ingest_matches_full_rebuild(raw_df, tmp_path):
+    store_dir = str(tmp_path)
+    create_store(raw_df[raw_df['COUNT'] < 2020], store_dir)
+    ingest_survey(raw_df[raw_df['COUNT'] == 2020], store_dir)
+    ingest_survey(raw_df[raw_df['COUNT'] == 2022], store_dir)
+    state = read_state(store_dir)
+
+    # the store holds the same rows as cleaning the whole history, with the same means and scaler
+    expected = clean_df(raw_df.copy())
+    pd.testing.assert_frame_equal(load_store(store_dir), expected)
+    np.testing.assert_allclose(get_store_means(state), expected.mean(), rtol=1e-9)
+    scaler = StandardScaler().fit(expected.fillna(expected.mean()).drop(columns=['ID', 'LATITUDE', 'LONGITUDE', 'NUMBER']))
+    np.testing.assert_allclose(get_store_scaler(state).mean_, scaler.mean_, rtol=1e-9)
+    np.testing.assert_allclose(get_store_scaler(state).scale_, scaler.scale_, rtol=1e-9)
+
+    # the rows before the last ingest are loaded with the dtypes and means the store had then
+    previous = clean_df(raw_df[raw_df['COUNT'] < 2022].copy())
+    pd.testing.assert_frame_equal(load_store(store_dir, 2), previous)
+    np.testing.assert_allclose(get_store_means(state, 2), previous.mean(), rtol=1e-9)
+    previous_scaler = StandardScaler().fit(previous.fillna(previous.mean()).drop(columns=['ID', 'LATITUDE', 'LONGITUDE', 'NUMBER']))
+    np.testing.assert_allclose(get_store_scaler(state, 2).mean_, previous_scaler.mean_, rtol=1e-9)
+
+def test_models_train_with_store_scaler(raw_df, tmp_path):
+    store_dir = str(tmp_path)
+    create_store(raw_df, store_dir)
+    state = read_state(store_dir)
+    train_df = load_store(store_dir).fillna(get_store_means(state))
+
+    # the models are trained with the scaler of the store instead of fitting their own
+    scaler = get_store_scaler(state)
+    model, model_scaler = get_model_trainers(scaler=scaler)['lat_model'](train_df)
+    assert model_scaler is scaler
+
+    # a model given a scaler is stored apart from one that fits its own, and from one given a scaler with other statistics
+    fingerprint = get_store_fingerprint('lat_model', train_df, scaler)
+    assert fingerprint == get_store_fingerprint('lat_model', train_df, copy.deepcopy(scaler))
+    other = copy.deepcopy(scaler)
+    other.scale_ = other.scale_ * 2
+    assert len({fingerprint, get_store_fingerprint('lat_model', train_df), get_store_fingerprint('lat_model', train_df, other)}) == 3
@@ -0,0 +1,28 @@
+import pandas as pd
+import pytest
+import tuning
+from tuning import get_brackets, tune
+
+def test_brackets():
+    assert get_brackets(20, 540, method='halving') == [(27, [20, 60, 180, 540])]
+    assert get_brackets(20, 540) == [(27, [20, 60, 180, 540]), (12, [60, 180, 540]), (6, [180, 540]), (4, [540])]
+
+def test_search_resumes_without_training(cleaned_df, tmp_path, monkeypatch):
+    def search():
+        return tune(cleaned_df, 'gb', method='halving', min_budget=2, max_budget=18, num_splits=2, backend='hist',
+                    db_path=str(tmp_path / 'tuning.sqlite'), cache_dir=str(tmp_path))
+    results = search()
+    assert set(results['budget']) == {2, 6, 18}
+    assert (results['folds'] == 2).all()
+
+    # every result is in the database so running the search again trains nothing
+    def run_trial(*args):
+        raise AssertionError('a stored trial was trained again')
+    monkeypatch.setattr(tuning, 'run_trial', run_trial)
+    pd.testing.assert_frame_equal(search(), results)
+
+@pytest.mark.parametrize('kind', ['nn', 'lstm'])
+def test_dl_trials(cleaned_df, tmp_path, kind):
+    results = tune(cleaned_df, kind, method='halving', min_budget=1, max_budget=3, num_splits=2, db_path=str(tmp_path / 'tuning.sqlite'),
+                   cache_dir=str(tmp_path))
+    assert results['loss'].notna().all()
@@ -0,0 +1,337 @@
+import os
+import time
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import copy
+from contextlib import contextmanager
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.optim as optim
+from threadpoolctl import threadpool_limits
+from sequences import SequenceWindows
+from batching import TensorBatches
+from model_store import make_artifact, dumps_artifact, loads_artifact
+
+# the thread limits of a worker process, kept so they stay applied for the life of the worker
+_worker_limits = None
+
+def get_available_cores():
+    '''
+    Returns the number of cores this process is allowed to run on
+    '''
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+def init_worker(num_threads):
+    '''
+    Limits the torch, BLAS and OpenMP threads of a worker process so concurrent fits don't oversubscribe the cores
+
+    Inputs:
+        - num_threads (int) - The number of threads each worker may use
+    '''
+    global _worker_limits
+
+    # picked up by any library that reads its thread count when it is first used
+    for var in ['OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS']:
+        os.environ[var] = str(num_threads)
+
+    # libraries that were already loaded when the worker started are limited at runtime
+    _worker_limits = threadpool_limits(limits=num_threads)
+    torch.set_num_threads(num_threads)
+
+def configure_cpu_threads(num_threads=None):
+    '''
+    Sets the number of torch threads to the available cores for training on the CPU. Worker processes keep the share of the cores
+    they were given by init_worker().
+
+    Inputs:
+        - num_threads (int) - The number of threads to use, the number of available cores if not given
+
+    Returns:
+        - num_threads (int) - The number of threads torch uses
+    '''
+    if _worker_limits is None:
+        torch.set_num_threads(num_threads or get_available_cores())
+    return torch.get_num_threads()
+
+@contextmanager
+def cpu_threads(enabled=True, num_threads=None):
+    '''
+    Applies configure_cpu_threads() for the duration of the context and restores the previous number of torch threads afterwards,
+    so training in perf mode doesn't change the threads of the code that runs after it
+
+    Inputs:
+        - enabled (bool) - Whether to change the number of threads at all
+        - num_threads (int) - The number of threads to use, the number of available cores if not given
+
+    Returns:
+        - num_threads (int) - The number of threads torch uses inside the context
+    '''
+    previous = torch.get_num_threads()
+    if enabled:
+        configure_cpu_threads(num_threads)
+    try:
+        yield torch.get_num_threads()
+    finally:
+        torch.set_num_threads(previous)
+
+def bf16_supported():
+    '''
+    Returns whether the CPU has native bfloat16 instructions (AVX512-BF16 or AMX), without which bfloat16 autocast is slower than float32
+    '''
+    checks = [getattr(torch.cpu, '_is_avx512_bf16_supported', None), getattr(torch.cpu, '_is_amx_tile_supported', None)]
+    return any(check is not None and check() for check in checks)
+
+def get_autocast(bf16=False):
+    '''
+    Returns a bfloat16 autocast context for the CPU which is only enabled if bf16 is requested and supported by the CPU
+    '''
+    return torch.autocast('cpu', dtype=torch.bfloat16, enabled=bf16 and bf16_supported())
+
+def make_adam(params, lr=1e-3, fused=False):
+    '''
+    Creates an Adam optimizer, using the fused implementation (one kernel for the update of every parameter) if requested and
+    supported by the installed torch
+
+    Inputs:
+        - params (iterable) - The parameters to optimize
+        - lr (float) - The learning rate
+        - fused (bool) - Whether to use the fused implementation
+
+    Returns:
+        - optimizer (optim.Adam) - The optimizer
+    '''
+    params = list(params)
+    if fused:
+        try:
+            return optim.Adam(params, lr=lr, fused=True)
+        except (RuntimeError, TypeError):
+            pass
+    return optim.Adam(params, lr=lr)
+
+def run_training_job(train, train_df, fingerprint, schema=None):
+    '''
+    Trains a model and returns it as a serialized artifact so it can be sent back from a worker process
+
+    Inputs:
+        - train (function) - A module level function (or a partial of one) that takes train_df and returns the trained model and its
+                             scaler
+        - train_df (pd.Dataframe) - The training data
+        - fingerprint (str) - The fingerprint of the training data for the model store
+        - schema (FeatureSchema) - The optional schema of the model inputs
+
+    Returns:
+        - data (bytes) - The artifact serialized with dumps_artifact
+    '''
+    model, scaler = train(train_df)
+    return dumps_artifact(make_artifact(model, scaler, fingerprint, schema))
+
+def train_in_parallel(jobs, max_workers=None):
+    '''
+    Trains independent models concurrently, each in its own process with an equal share of the available cores
+
+    Inputs:
+        - jobs (dict) - The name of each model mapped to the (train, train_df, fingerprint, schema) arguments of run_training_job
+        - max_workers (int) - The maximum number of worker processes, one per job if not given
+
+    Returns:
+        - artifacts (dict) - The name of each model mapped to its trained artifact
+    '''
+    num_cores = get_available_cores()
+    if max_workers is None:
+        max_workers = len(jobs)
+    max_workers = max(1, min(max_workers, len(jobs), num_cores))
+
+    # train in this process if there is nothing to run concurrently
+    if max_workers == 1:
+        return {name: loads_artifact(run_training_job(*args)) for name, args in jobs.items()}
+
+    # spawn fresh workers so they don't inherit the thread pools of this process
+    num_threads = max(1, num_cores // max_workers)
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=max_workers, mp_context=context, initializer=init_worker,
+                             initargs=(num_threads,)) as executor:
+        futures = {name: executor.submit(run_training_job, *args) for name, args in jobs.items()}
+        return {name: loads_artifact(future.result()) for name, future in futures.items()}
+
+def split_validation(X, y, val_fraction=0.1, times=None):
+    '''
+    Holds out the latest fraction of the rows as a validation set, so the model is validated on surveys that come after the ones it is
+    trained on like the years it forecasts
+
+    Inputs:
+        - X (torch.Tensor or SequenceWindows) - The model inputs
+        - y (torch.Tensor) - The targets
+        - val_fraction (float) - The fraction of rows to hold out, no rows are held out if 0
+        - times (np.ndarray) - The time (e.g. survey year) of each row, the rows are taken to be in time order if not given
+
+    Returns:
+        - X_train, y_train (torch.Tensor or SequenceWindows) - The rows to train on
+        - X_val, y_val (torch.Tensor or SequenceWindows) - The held out rows, or None if no rows are held out
+    '''
+    num_val = int(len(X) * val_fraction)
+    if num_val == 0:
+        return X, y, None, None
+
+    order = torch.arange(len(X)) if times is None else torch.from_numpy(np.argsort(np.asarray(times), kind='stable'))
+    train_idx, val_idx = order[:len(X) - num_val], order[len(X) - num_val:]
+    return take_rows(X, train_idx), y[train_idx], take_rows(X, val_idx), y[val_idx]
+
+def get_best_epoch(history, min_delta=1e-4):
+    '''
+    Returns the epoch whose weights fit_model() keeps, the last one that lowered the monitored loss by more than min_delta
+
+    Inputs:
+        - history (list) - The history returned by fit_model()
+        - min_delta (float) - The relative decrease of the monitored loss that counts as an improvement
+
+    Returns:
+        - best_epoch (int) - The best epoch, at least 1
+    '''
+    best_epoch, best_loss = 1, float('inf')
+    for epoch in history:
+        if epoch['val_loss'] < best_loss * (1 - min_delta):
+            best_epoch, best_loss = epoch['epoch'], epoch['val_loss']
+    return best_epoch
+
+def take_rows(X, idx):
+    '''
+    Returns a subset of the rows of the model inputs, sharing the windows of a SequenceWindows instead of copying them
+    '''
+    if isinstance(X, SequenceWindows):
+        return X.subset(idx)
+    return X[idx]
+
+def get_row_tensors(X):
+    '''
+    Returns the tensors with one row per sample that are shuffled into batches, the start and length of each window for a
+    SequenceWindows (so the windows are only copied per batch) or the inputs themselves
+    '''
+    if isinstance(X, SequenceWindows):
+        return (X.starts, X.lengths)
+    return (X,)
+
+def get_model_args(X, rows):
+    '''
+    Returns the model arguments for a batch of the row tensors from get_row_tensors()
+    '''
+    if isinstance(X, SequenceWindows):
+        starts, lengths = rows
+        return X.windows[starts], lengths
+    return rows
+
+def save_checkpoint(path, state):
+    '''
+    Saves the training state by writing a temporary file and renaming it so a partially written checkpoint is never resumed from
+    '''
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    torch.save(state, tmp_path)
+    os.replace(tmp_path, path)
+
+def fit_model(model, X, y, num_epochs=100, batch_size=32, lr=1e-3, val_fraction=0.1, patience=10, lr_patience=3, lr_factor=0.5,
+              min_delta=1e-4, checkpoint_path=None, seed=0, verbose=True, perf_mode=False, bf16=False, times=None):
+    '''
+    Trains a torch model with Adam and an MSE loss, stopping early once the validation loss stops improving. The learning rate is
+    reduced when the validation loss plateaus, the weights with the lowest validation loss are restored at the end and the training
+    state can be checkpointed every epoch so an interrupted run resumes where it stopped.
+
+    Inputs:
+        - model (nn.Module) - The model to train
+        - X (torch.Tensor or SequenceWindows) - The model inputs, or the windows of the rows for a sequence model
+        - y (torch.Tensor) - The targets
+        - num_epochs (int) - The maximum number of epochs
+        - batch_size (int) - The number of rows in each batch
+        - lr (float) - The initial learning rate
+        - val_fraction (float) - The fraction of the latest rows held out to monitor, the training loss is monitored instead if 0
+        - patience (int) - The number of epochs without improvement before training stops
+        - lr_patience (int) - The number of epochs without improvement before the learning rate is reduced
+        - lr_factor (float) - The factor the learning rate is reduced by
+        - min_delta (float) - The relative decrease of the monitored loss that counts as an improvement
+        - checkpoint_path (str) - The optional file to checkpoint the training state to and resume from
+        - seed (int) - The seed of the shuffling
+        - verbose (bool) - Whether to print the loss every 10 epochs
+        - perf_mode (bool) - Whether to train with every available core and the fused Adam optimizer
+        - bf16 (bool) - Whether to run the forward pass under bfloat16 autocast, only used in perf_mode on CPUs that support it
+        - times (np.ndarray) - The time of each row that orders the validation split, see split_validation()
+
+    Returns:
+        - model (nn.Module) - The trained model with the best weights
+        - history (list) - The epoch, training loss, validation loss, learning rate and epochs per second of every epoch
+    '''
+    X_train, y_train, X_val, y_val = split_validation(X, y, val_fraction, times)
+
+    # shuffle with a seeded generator so its state can be checkpointed
+    generator = torch.Generator().manual_seed(seed)
+    train_batches = TensorBatches(*get_row_tensors(X_train), y_train, batch_size=batch_size, generator=generator)
+
+    # use every available core in perf mode, restoring the previous number of threads when training ends
+    with cpu_threads(perf_mode):
+        criterion = nn.MSELoss()
+        optimizer = make_adam(model.parameters(), lr=lr, fused=perf_mode)
+        scheduler = optim.lr_scheduler.ReduceLROnPlateau(optimizer, factor=lr_factor, patience=lr_patience, threshold=min_delta)
+
+        state = {'epoch': 0, 'best_loss': float('inf'), 'best_state': copy.deepcopy(model.state_dict()), 'bad_epochs': 0, 'history': []}
+
+        # resume from the checkpoint of an interrupted run
+        if checkpoint_path is not None and os.path.exists(checkpoint_path):
+            checkpoint = torch.load(checkpoint_path, weights_only=True)
+            model.load_state_dict(checkpoint['model'])
+            optimizer.load_state_dict(checkpoint['optimizer'])
+            scheduler.load_state_dict(checkpoint['scheduler'])
+            generator.set_state(checkpoint['generator'])
+            torch.set_rng_state(checkpoint['rng'])
+            state = checkpoint['state']
+
+        while state['epoch'] < num_epochs and state['bad_epochs'] < patience:
+            start = time.perf_counter()
+            model.train()
+            total_loss = 0.0
+            for *rows, batch_y in train_batches:
+                optimizer.zero_grad()
+                with get_autocast(perf_mode and bf16):
+                    predictions = model(*get_model_args(X_train, rows))
+                loss = criterion(predictions.float(), batch_y)
+                loss.backward()
+                optimizer.step()
+                total_loss += loss.item() * len(batch_y)
+            train_loss = total_loss / len(y_train)
+
+            # monitor the validation loss (or the training loss if nothing was held out)
+            val_loss = train_loss
+            if X_val is not None:
+                model.eval()
+                with torch.no_grad():
+                    val_loss = criterion(model(*get_model_args(X_val, get_row_tensors(X_val))), y_val).item()
+
+            scheduler.step(val_loss)
+            state['epoch'] += 1
+            state['history'].append({'epoch': state['epoch'], 'train_loss': train_loss, 'val_loss': val_loss,
+                                     'lr': optimizer.param_groups[0]['lr'], 'epochs_per_s': 1 / (time.perf_counter() - start)})
+
+            # keep the weights with the lowest monitored loss
+            if val_loss < state['best_loss'] * (1 - min_delta):
+                state['best_loss'] = val_loss
+                state['best_state'] = copy.deepcopy(model.state_dict())
+                state['bad_epochs'] = 0
+            else:
+                state['bad_epochs'] += 1
+
+            if verbose and state['epoch'] % 10 == 0:
+                print(f"Epoch [{state['epoch']}/{num_epochs}], Loss: {train_loss:.4f}, Validation Loss: {val_loss:.4f}")
+
+            if checkpoint_path is not None:
+                save_checkpoint(checkpoint_path, {'model': model.state_dict(), 'optimizer': optimizer.state_dict(),
+                                                  'scheduler': scheduler.state_dict(), 'generator': generator.get_state(), 'rng': torch.get_rng_state(),
+                                                  'state': state})
+
+        if verbose and state['bad_epochs'] >= patience:
+            print(f"Stopped early after {state['epoch']} epochs, best loss: {state['best_loss']:.4f}")
+        if verbose and state['history']:
+            epochs_per_s = len(state['history']) / sum(1 / epoch['epochs_per_s'] for epoch in state['history'])
+            print(f"Trained at {epochs_per_s:.2f} epochs/s, final loss: {state['history'][-1]['train_loss']:.4f}")
+
+        model.load_state_dict(state['best_state'])
+        return model, state['history']
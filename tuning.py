@@ -0,0 +1,313 @@
+import json
+import math
+import os
+import sqlite3
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import time
+import numpy as np
+import pandas as pd
+import torch
+from non_dl import CV_TARGETS, CV_CACHE_DIR, get_cv_fold, get_cv_years, load_cv_fold, make_gb_model
+from multi_output_nn import MultiOutputNN, train_dl_model
+from script_lstm import LSTMModel
+from batching import TensorBatches
+from sequences import SequenceWindows
+from training import fit_model, get_available_cores, init_worker, get_model_args, get_row_tensors
+from model_store import data_fingerprint
+from data_loader import load_clean_survey
+
+# the database the result of every trial is stored in so an interrupted search resumes where it stopped
+TUNING_DB = './data/tuning.sqlite'
+
+# the values each hyperparameter is sampled from for each kind of model
+SEARCH_SPACES = {
+    'gb': {'learning_rate': [0.01, 0.03, 0.1, 0.3], 'max_depth': [2, 3, 4, 6], 'min_samples_leaf': [1, 2, 5, 10, 20]},
+    'nn': {'lr': [1e-4, 3e-4, 1e-3, 3e-3, 1e-2], 'batch_size': [16, 32, 64, 128, 256]},
+    'lstm': {'lr': [1e-4, 3e-4, 1e-3, 3e-3], 'batch_size': [16, 32, 64, 128], 'hidden_size': [32, 64, 128], 'num_layers': [2, 3],
+             'window': [1, 2, 4, 8]}
+}
+
+# the smallest and largest budget of a trial for each kind of model, the number of trees of the gradient boosting model and the
+# number of epochs of the dl models
+BUDGETS = {'gb': (20, 540), 'nn': (3, 81), 'lstm': (3, 81)}
+
+# the targets each kind of model is tuned for if none are given, the LSTM and gradient boosting models predict one target each
+DEFAULT_TARGETS = {'gb': ['NUMBER'], 'nn': CV_TARGETS, 'lstm': ['NUMBER']}
+
+def get_brackets(min_budget, max_budget, eta=3, method='hyperband'):
+    '''
+    Gets the brackets of a search. Each bracket is a run of successive halving that starts num_configs trials at its smallest budget,
+    and keeps the best 1 / eta of them for the next budget which is eta times larger until max_budget is reached. Hyperband runs a
+    bracket for every smallest budget from min_budget up to max_budget so a configuration that only does well with a large budget
+    isn't always dropped early, and successive halving only runs the bracket that starts at min_budget.
+
+    Inputs:
+        - min_budget (int) - The smallest budget of a trial
+        - max_budget (int) - The largest budget of a trial
+        - eta (int) - The factor the number of trials is divided by and the budget is multiplied by at every rung
+        - method (str) - 'hyperband' or 'halving'
+
+    Returns:
+        - brackets (list) - The number of configurations and the budget of every rung of each bracket
+    '''
+    if method not in ('hyperband', 'halving'):
+        raise ValueError(f'Unknown search method: {method}')
+
+    s_max = int(math.floor(math.log(max_budget / min_budget, eta) + 1e-9))
+    brackets = []
+    for s in range(s_max, -1, -1):
+        num_configs = int(math.ceil((s_max + 1) / (s + 1) * eta ** s))
+        budgets = [int(round(max_budget * eta ** (i - s))) for i in range(s + 1)]
+        brackets.append((num_configs, budgets))
+        if method == 'halving':
+            break
+
+    return brackets
+
+def sample_configs(space, num_configs, rng):
+    '''
+    Samples configurations by picking every hyperparameter at random from its values
+
+    Inputs:
+        - space (dict) - The values of each hyperparameter
+        - num_configs (int) - The number of configurations
+        - rng (np.random.Generator) - The random generator
+
+    Returns:
+        - configs (list) - The hyperparameters of each configuration
+    '''
+    return [{name: values[rng.integers(len(values))] for name, values in space.items()} for _ in range(num_configs)]
+
+def get_loss(y_true, y_pred):
+    '''
+    Returns the mean squared error of each target divided by the variance of the target (1 - R2), averaged over the targets so
+    targets on different scales count the same
+    '''
+    y_true = np.asarray(y_true, dtype=float).reshape(len(y_true), -1)
+    y_pred = np.asarray(y_pred, dtype=float).reshape(len(y_true), -1)
+    mse = np.mean((y_true - y_pred) ** 2, axis=0)
+    var = np.var(y_true, axis=0)
+    return float(np.mean(mse / np.where(var > 0, var, 1.0)))
+
+def get_fold_windows(fold, window):
+    '''
+    Builds the windows over the survey history of each species for the training and validation rows of a fold. The validation rows
+    are put back in their place in the history by the order of the rows in the survey, so their windows only hold the years before
+    them instead of every training year.
+
+    Inputs:
+        - fold (dict) - The arrays of a fold from load_cv_fold()
+        - window (int) - The number of rows in each window
+
+    Returns:
+        - train_windows (SequenceWindows) - The windows of the training rows
+        - test_windows (SequenceWindows) - The windows of the validation rows
+    '''
+    X_train, X_test = np.asarray(fold['X_train']), np.asarray(fold['X_test'])
+
+    # stack the rows of both splits in the order of the survey and find where each row ends up
+    order = np.argsort(np.r_[fold['order_train'], fold['order_test']], kind='stable')
+    position = np.empty(len(order), dtype=np.int64)
+    position[order] = np.arange(len(order))
+    windows = SequenceWindows(np.vstack([X_train, X_test])[order], np.r_[fold['groups_train'], fold['groups_test']][order], window)
+
+    # pick the rows of each split out by their position
+    return windows.subset(torch.from_numpy(position[:len(X_train)])), windows.subset(torch.from_numpy(position[len(X_train):]))
+
+def run_trial(kind, params, budget, fold, targets, backend='exact', seed=0):
+    '''
+    Trains a model with the given hyperparameters and budget on the training rows of a cross-validation fold and evaluates it on the
+    validation year
+
+    Inputs:
+        - kind (str) - 'gb', 'nn' or 'lstm'
+        - params (dict) - The hyperparameters of the model
+        - budget (int) - The number of trees of the gradient boosting model or the number of epochs of the dl models
+        - fold (dict) - The fold returned by get_cv_fold()
+        - targets (list) - The targets to predict
+        - backend (str) - The gradient boosting backend to use as specified in make_gb_model()
+        - seed (int) - The seed of the weights and the shuffling
+
+    Returns:
+        - result (dict) - The loss on the validation year and the time taken to fit
+    '''
+    # memory-map the cached fold instead of reading it into memory
+    fold = load_cv_fold(fold)
+
+    idx = [CV_TARGETS.index(target) for target in targets]
+    X_train, X_test = np.asarray(fold['X_train']), np.asarray(fold['X_test'])
+    y_train, y_test = np.asarray(fold['y_train'])[:, idx], np.asarray(fold['y_test'])[:, idx]
+    torch.manual_seed(seed)
+
+    start = time.perf_counter()
+    if kind == 'gb':
+        # the histogram backend counts its trees in max_iter
+        num_trees = 'max_iter' if backend == 'hist' else 'n_estimators'
+        model = make_gb_model(backend, {**params, num_trees: budget, 'random_state': seed})
+        model.fit(X_train, y_train.ravel())
+        y_pred = model.predict(X_test)
+    elif kind == 'nn':
+        model = MultiOutputNN(X_train.shape[1], len(idx))
+        # drop the last partial batch so batch normalization never sees a batch of one row
+        train_loader = TensorBatches(torch.tensor(X_train, dtype=torch.float32), torch.tensor(y_train, dtype=torch.float32),
+                                     batch_size=params['batch_size'], drop_last=True)
+        model = train_dl_model(model, train_loader, epochs=budget, lr=params['lr'])
+        model.eval()
+        with torch.no_grad():
+            y_pred = model(torch.tensor(X_test, dtype=torch.float32)).numpy()
+    elif kind == 'lstm':
+        train_windows, test_windows = get_fold_windows(fold, params['window'])
+
+        model = LSTMModel(X_train.shape[1], params['hidden_size'], params['num_layers'], len(idx), params['window'])
+        # train for the whole budget, the validation year is what the trial is scored on
+        model, _ = fit_model(model, train_windows, torch.tensor(y_train, dtype=torch.float32), num_epochs=budget,
+                             batch_size=params['batch_size'], lr=params['lr'], val_fraction=0, patience=budget, seed=seed, verbose=False)
+        model.eval()
+        with torch.no_grad():
+            y_pred = model(*get_model_args(test_windows, get_row_tensors(test_windows))).numpy()
+    else:
+        raise ValueError(f'Unknown kind of model: {kind}')
+    fit_time = time.perf_counter() - start
+
+    return {'loss': get_loss(y_test, y_pred), 'fit_s': fit_time}
+
+def open_results(db_path=TUNING_DB):
+    '''
+    Opens the results database, creating its tables if they don't exist yet
+    '''
+    os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+    conn = sqlite3.connect(db_path)
+    conn.execute('CREATE TABLE IF NOT EXISTS studies (study TEXT PRIMARY KEY, kind TEXT, settings TEXT)')
+    conn.execute('CREATE TABLE IF NOT EXISTS trials (study TEXT, trial INTEGER, bracket INTEGER, params TEXT, PRIMARY KEY (study, trial))')
+    conn.execute('CREATE TABLE IF NOT EXISTS results (study TEXT, trial INTEGER, budget INTEGER, year INTEGER, loss REAL, fit_s REAL, '
+                 'PRIMARY KEY (study, trial, budget, year))')
+    conn.commit()
+    return conn
+
+def read_results(conn, study):
+    '''
+    Reads the results of a study as a dataframe with one row per trial, budget and validation year
+    '''
+    return pd.read_sql_query('SELECT r.trial, t.bracket, t.params, r.budget, r.year, r.loss, r.fit_s FROM results r '
+                             'JOIN trials t ON r.study = t.study AND r.trial = t.trial WHERE r.study = ?', conn, params=(study,))
+
+def tune(df, kind, targets=None, method='hyperband', eta=3, min_budget=None, max_budget=None, num_splits=3, seed=0, backend='exact',
+         test_year=2022, max_workers=None, db_path=TUNING_DB, cache_dir=CV_CACHE_DIR):
+    '''
+    Searches the hyperparameters of a kind of model with Hyperband (or successive halving) and year based cross-validation. Every
+    trial is trained on the folds of run_cv() with a small budget first and only the best trials of each rung are trained again with
+    a larger one, so weak configurations are dropped after a fraction of the cost of a full training. The folds of the trials of a
+    rung are trained at the same time in separate processes and every result is written to the results database as soon as it
+    finishes, so running the same search again skips everything that was already trained.
+
+    Inputs:
+        - df (pd.Dataframe) - The pre-processed dataframe
+        - kind (str) - 'gb' for the gradient boosting model, 'nn' for the MultiOutputNN or 'lstm' for the LSTM
+        - targets (list) - The targets to predict, DEFAULT_TARGETS of the kind if not given
+        - method (str) - 'hyperband' or 'halving'
+        - eta (int) - The factor the number of trials is divided by and the budget is multiplied by at every rung
+        - min_budget (int) - The smallest budget of a trial, from BUDGETS if not given
+        - max_budget (int) - The largest budget of a trial, from BUDGETS if not given
+        - num_splits (int) - The number of survey years used as validation folds
+        - seed (int) - The seed of the validation years, the sampled configurations and the training
+        - backend (str) - The gradient boosting backend to use as specified in make_gb_model()
+        - test_year (int) - The year held out as the true test set which is never trained or validated on
+        - max_workers (int) - The number of trials to train at once in separate processes, one per core if not given
+        - db_path (str) - The path of the results database
+        - cache_dir (str) - The directory the scaled matrices of each fold are cached in
+
+    Returns:
+        - results (pd.Dataframe) - The hyperparameters and mean validation loss of every trial at every budget it was trained with,
+                                   best first at the largest budget
+    '''
+    if kind not in SEARCH_SPACES:
+        raise ValueError(f'Unknown kind of model: {kind}')
+    targets = list(targets or DEFAULT_TARGETS[kind])
+    if kind == 'gb' and len(targets) != 1:
+        raise ValueError('The gradient boosting model predicts a single target')
+    min_budget = min_budget or BUDGETS[kind][0]
+    max_budget = max_budget or BUDGETS[kind][1]
+    brackets = get_brackets(min_budget, max_budget, eta, method)
+
+    # a study is identified by the data and every setting that changes its trials so a resumed search continues the same one
+    settings = {'kind': kind, 'targets': targets, 'method': method, 'eta': eta, 'min_budget': min_budget, 'max_budget': max_budget,
+                'num_splits': num_splits, 'seed': seed, 'backend': backend, 'test_year': test_year, 'space': SEARCH_SPACES[kind]}
+    study = data_fingerprint(df, extra=settings)[:16]
+
+    # build (or load) every fold before training so the workers only receive the scaled matrices
+    folds = [get_cv_fold(df, [], cv_year, test_year, cache_dir) for cv_year in get_cv_years(df, num_splits, seed, test_year=test_year)]
+
+    conn = open_results(db_path)
+    conn.execute('INSERT OR IGNORE INTO studies VALUES (?, ?, ?)', (study, kind, json.dumps(settings)))
+    conn.commit()
+    done = {(row.trial, row.budget, row.year): row.loss for row in read_results(conn, study).itertuples()}
+    if done:
+        print(f'Resuming study {study} with {len(done)} results')
+
+    max_workers = max(1, min(max_workers or get_available_cores(), get_available_cores()))
+    executor = None
+    if max_workers > 1:
+        # each worker gets an equal share of the cores so the trials don't oversubscribe them
+        context = multiprocessing.get_context('spawn')
+        executor = ProcessPoolExecutor(max_workers=max_workers, mp_context=context, initializer=init_worker,
+                                       initargs=(max(1, get_available_cores() // max_workers),))
+
+    try:
+        first_trial = 0
+        for bracket, (num_configs, budgets) in enumerate(brackets):
+            # the configurations of a bracket are sampled the same way on every run so a resumed search trains the same trials
+            configs = sample_configs(SEARCH_SPACES[kind], num_configs, np.random.default_rng([seed, bracket]))
+            trials = {first_trial + i: config for i, config in enumerate(configs)}
+            first_trial += num_configs
+            conn.executemany('INSERT OR IGNORE INTO trials VALUES (?, ?, ?, ?)',
+                             [(study, trial, bracket, json.dumps(config)) for trial, config in trials.items()])
+            conn.commit()
+
+            alive = list(trials)
+            for rung, budget in enumerate(budgets):
+                tasks = [(trial, fold) for trial in alive for fold in folds if (trial, budget, int(fold['year'])) not in done]
+                print(f'Bracket {bracket + 1}/{len(brackets)}: {len(alive)} trials with a budget of {budget}, {len(tasks)} folds to train')
+                args = [(kind, trials[trial], budget, fold, targets, backend, seed + trial) for trial, fold in tasks]
+
+                # write every result as soon as its trial finishes
+                if executor is None:
+                    finished = ((task, run_trial(*task_args)) for task, task_args in zip(tasks, args))
+                else:
+                    futures = {executor.submit(run_trial, *task_args): task for task, task_args in zip(tasks, args)}
+                    finished = ((futures[future], future.result()) for future in as_completed(futures))
+                for (trial, fold), result in finished:
+                    conn.execute('INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?)',
+                                 (study, trial, budget, int(fold['year']), result['loss'], result['fit_s']))
+                    conn.commit()
+                    done[(trial, budget, int(fold['year']))] = result['loss']
+
+                # keep the best 1 / eta of the trials by their mean loss over the folds for the next budget
+                if rung < len(budgets) - 1:
+                    losses = {trial: np.mean([done[(trial, budget, int(fold['year']))] for fold in folds]) for trial in alive}
+                    alive = sorted(alive, key=losses.get)[:max(1, len(alive) // eta)]
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    # the mean loss of every trial at every budget over the folds
+    results = read_results(conn, study)
+    conn.close()
+    results = results.groupby(['trial', 'bracket', 'params', 'budget'], as_index=False).agg(loss=('loss', 'mean'), loss_std=('loss', 'std'),
+                                                                                           fit_s=('fit_s', 'sum'), folds=('year', 'count'))
+    results = pd.concat([results.drop(columns='params'), pd.DataFrame([json.loads(params) for params in results['params']])], axis=1)
+    return results.sort_values(['budget', 'loss'], ascending=[False, True], ignore_index=True)
+
+def main(kinds=('gb', 'nn', 'lstm')):
+    print('Reading in dataframe')
+    cleaned_df = load_clean_survey() # read in the pre-processed dataframe from the cache (built from the workbook on the first run)
+    print('Successfuly loaded dataframe')
+
+    for kind in kinds:
+        print('-' * 50)
+        print(f'Tuning the {kind} model')
+        results = tune(cleaned_df, kind)
+        print(results.head(10).to_string(index=False))
+
+if __name__ == '__main__':
+    main()